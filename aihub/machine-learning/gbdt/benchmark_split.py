@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import numpy as np
+from cart import ClassificationTree, RegressionTree
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark CART split search methods and compiled prediction")
+    parser.add_argument("-n", "--n_samples", type=int, default=200000, help="number of training samples")
+    parser.add_argument("-f", "--n_features", type=int, default=10, help="number of features")
+    parser.add_argument("-d", "--max_depth", type=int, default=4, help="max depth of each tree")
+    parser.add_argument("-b", "--max_bins", type=int, default=256, help="max bins of the hist split method")
+    parser.add_argument("-m", "--methods", type=str, default="exact,hist", help="comma separated split methods")
+    parser.add_argument("-s", "--seed", type=int, default=13, help="random seed")
+    return parser.parse_args()
+
+
+### 生成模拟数据集
+def make_dataset(n_samples, n_features, seed):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n_samples, n_features))
+    coef = rng.normal(size=n_features)
+    y_reg = X.dot(coef) + 0.1 * rng.normal(size=n_samples)
+    y_cls = (y_reg > np.median(y_reg)).astype(int)
+    return X, y_reg, y_cls
+
+
+### 统计拟合耗时、逐样本与编译后预测耗时和训练集效果
+def run(tree_cls, X, y, metric, **kwargs):
+    tree = tree_cls(**kwargs)
+    start = time.perf_counter()
+    tree.fit(X, y)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = np.array(tree.predict(X), dtype=float)
+    predict_elapsed = time.perf_counter() - start
+
+    tree.compile()
+    start = time.perf_counter()
+    tree.predict(X)
+    compiled_elapsed = time.perf_counter() - start
+    return elapsed, predict_elapsed, compiled_elapsed, metric(y, y_pred)
+
+
+def mse(y, y_pred):
+    return np.mean((y - y_pred) ** 2)
+
+
+def accuracy(y, y_pred):
+    return np.mean(y == y_pred)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    X, y_reg, y_cls = make_dataset(args.n_samples, args.n_features, args.seed)
+
+    for name, tree_cls, y, metric in [("RegressionTree", RegressionTree, y_reg, mse),
+                                      ("ClassificationTree", ClassificationTree, y_cls, accuracy)]:
+        baseline = None
+        for method in args.methods.split(","):
+            elapsed, predict_elapsed, compiled_elapsed, score = run(
+                tree_cls, X, y, metric, max_depth=args.max_depth, split_method=method, max_bins=args.max_bins)
+            baseline = baseline or elapsed
+            print("%-20s %-6s fit %8.3fs  speedup %7.1fx  predict %7.3fs  compiled %7.3fs  %s %.4f"
+                  % (name, method, elapsed, baseline / elapsed, predict_elapsed, compiled_elapsed,
+                     metric.__name__, score))
+
+    # 整数特征：hist 按 x >= 阈值 划分，结果须与取值相同的浮点特征一致
+    X_int = np.round(X * 10).astype(np.int64)
+    for name, tree_cls, y, metric in [("RegressionTree", RegressionTree, y_reg, mse),
+                                      ("ClassificationTree", ClassificationTree, y_cls, accuracy)]:
+        _, _, _, int_score = run(tree_cls, X_int, y, metric, max_depth=args.max_depth, split_method="hist", max_bins=args.max_bins)
+        _, _, _, float_score = run(tree_cls, X_int.astype(np.float64), y, metric, max_depth=args.max_depth, split_method="hist", max_bins=args.max_bins)
+        assert np.isclose(int_score, float_score), "%s hist on integer X: %s %.4f != %.4f" % (name, metric.__name__, int_score, float_score)
+        print("%-20s hist   integer X  %s %.4f  same as float X" % (name, metric.__name__, int_score))
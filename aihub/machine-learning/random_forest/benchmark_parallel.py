@@ -0,0 +1,54 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from cart import ClassificationTree
+from parallel import fit_trees_parallel
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark process-parallel random forest fitting")
+    parser.add_argument("-n", "--n_samples", type=int, default=50000, help="number of training samples")
+    parser.add_argument("-f", "--n_features", type=int, default=20, help="number of features")
+    parser.add_argument("-t", "--n_estimators", type=int, default=16, help="number of trees")
+    parser.add_argument("-d", "--max_depth", type=int, default=6, help="max depth of each tree")
+    parser.add_argument("-mf", "--max_features", type=int, default=None, help="features sampled by each tree")
+    parser.add_argument("-w", "--workers", type=str, default="1,2,4,8", help="comma separated worker counts")
+    parser.add_argument("-j", "--tree_jobs", type=int, default=1, help="feature-parallel threads inside each tree")
+    parser.add_argument("-sm", "--split_method", type=str, default="exact", help="exact or hist")
+    parser.add_argument("-s", "--seed", type=int, default=2, help="random seed")
+    return parser.parse_args()
+
+
+### 生成模拟二分类数据集
+def make_dataset(n_samples, n_features, seed):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n_samples, n_features))
+    coef = rng.normal(size=n_features)
+    y = (X.dot(coef) + rng.normal(size=n_samples) > 0).astype(int)
+    return X, y
+
+
+### 多数投票预测
+def forest_predict(trees, X):
+    y_preds = np.array([tree.predict(X[:, tree.feature_indices]) for tree in trees]).T
+    return np.array([np.bincount(y_p.astype('int')).argmax() for y_p in y_preds])
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args, "cpu_count=%d" % os.cpu_count())
+    X, y = make_dataset(args.n_samples, args.n_features, args.seed)
+
+    baseline = None
+    for n_jobs in [int(w) for w in args.workers.split(",")]:
+        trees = [ClassificationTree(max_depth=args.max_depth, split_method=args.split_method,
+                                    n_jobs=args.tree_jobs) for _ in range(args.n_estimators)]
+        start = time.perf_counter()
+        fit_trees_parallel(trees, X, y, max_features=args.max_features, n_jobs=n_jobs, seed=args.seed)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        accuracy = np.mean(forest_predict(trees, X) == y)
+        print("workers %2d  fit %8.3fs  speedup %5.2fx  accuracy %.4f"
+              % (n_jobs, elapsed, baseline / elapsed, accuracy))
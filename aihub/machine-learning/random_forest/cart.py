@@ -1,5 +1,10 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from utils import feature_split, calculate_gini
+from utils import split_mask, calculate_gini, feature_binning, build_histogram, sorted_split_statistics, as_float64
+
+# 编译后树的扁平数组字段
+COMPILED_FIELDS = ("feature", "threshold", "left", "right", "value")
 
 ### 定义树结点
 class TreeNode():
@@ -21,7 +26,7 @@ class TreeNode():
 class BinaryDecisionTree(object):
     ### 决策树初始参数
     def __init__(self, min_samples_split=2, min_gini_impurity=999,
-                 max_depth=float("inf"), loss=None):
+                 max_depth=float("inf"), loss=None, split_method="exact", max_bins=256, n_jobs=1):
         # 根结点
         self.root = None  
         # 节点最小分裂样本数
@@ -36,75 +41,198 @@ class BinaryDecisionTree(object):
         self._leaf_value_calculation = None
         # 损失函数
         self.loss = loss
+        # 分裂查找方式，exact为精确查找，hist为直方图查找
+        self.split_method = split_method
+        # 直方图分箱数，不超过256
+        self.max_bins = max_bins
+        # 编译后的扁平数组，用于批量预测
+        self.compiled_arrays = None
+        # 结点内特征并行查找分裂的线程数，适用于特征较多的数据
+        self.n_jobs = n_jobs
+        # 特征并行线程池，仅在拟合期间存在
+        self._executor = None
 
     ### 决策树拟合函数
     def fit(self, X, y, loss=None):
+        # 重新拟合后原有编译结果失效
+        self.compiled_arrays = None
+        X = as_float64(X)
         # 递归构建决策树
-        self.root = self._build_tree(X, y)
+        if self.split_method == "hist":
+            self.root = self._build_hist_tree(X, y)
+        elif self.split_method == "exact":
+            # 特征并行查找分裂时创建线程池
+            self._executor = ThreadPoolExecutor(self.n_jobs) if self.n_jobs > 1 else None
+            try:
+                self.root = self._build_tree(X, y)
+            finally:
+                if self._executor is not None:
+                    self._executor.shutdown()
+                self._executor = None
+        else:
+            raise ValueError("split_method must be 'exact' or 'hist', got %r" % self.split_method)
         self.loss = None
 
     ### 决策树构建函数
-    def _build_tree(self, X, y, current_depth=0):
+    # X和y为全部训练数据，各结点只传递样本索引idx，不复制数据
+    def _build_tree(self, X, y, idx=None, current_depth=0, stats=None):
         # 初始化最小基尼不纯度
         init_gini_impurity = 999
         # 初始化最佳特征索引和阈值
-        best_criteria = None    
-        # 初始化数据子集
-        best_sets = None        
-        
+        best_criteria = None
+
         if len(np.shape(y)) == 1:
             y = np.expand_dims(y, axis=1)
+        if idx is None:
+            idx = np.arange(X.shape[0])
+            # 子类支持且特征为float64时，使用排序前缀和一次评估所有阈值
+            # 整数特征的阈值不是 int/float 实例，split_mask 按取值相等划分，仍逐个阈值查找
+            if X.dtype == np.float64:
+                stats = self._sample_statistics(y)
 
-        # 合并输入和标签
-        Xy = np.concatenate((X, y), axis=1)
+        # 当前结点的标签
+        y_node = y[idx]
+        # 当前结点的分裂统计量
+        stats_node = stats[idx] if stats is not None else None
         # 获取样本数和特征数
-        n_samples, n_features = X.shape
+        n_samples, n_features = len(idx), X.shape[1]
         # 设定决策树构建条件
         # 训练样本数量大于节点最小分裂样本数且当前树深度小于最大深度
         if n_samples >= self.min_samples_split and current_depth <= self.max_depth:
-            # 遍历计算每个特征的基尼不纯度
-            for feature_i in range(n_features):
-                # 获取第i特征的所有取值
-                feature_values = np.expand_dims(X[:, feature_i], axis=1)
-                # 获取第i个特征的唯一取值
-                unique_values = np.unique(feature_values)
-
-                # 遍历取值并寻找最佳特征分裂阈值
-                for threshold in unique_values:
-                    # 特征节点二叉分裂
-                    Xy1, Xy2 = feature_split(Xy, feature_i, threshold)
-                    # 如果分裂后的子集大小都不为0
-                    if len(Xy1) > 0 and len(Xy2) > 0:
-                        # 获取两个子集的标签值
-                        y1 = Xy1[:, n_features:]
-                        y2 = Xy2[:, n_features:]
-
-                        # 计算基尼不纯度
-                        impurity = self.impurity_calculation(y, y1, y2)
-
-                        # 获取最小基尼不纯度
-                        # 最佳特征索引和分裂阈值
-                        if impurity < init_gini_impurity:
-                            init_gini_impurity = impurity
-                            best_criteria = {"feature_i": feature_i, "threshold": threshold}
-                            best_sets = {
-                                "leftX": Xy1[:, :n_features],   
-                                "lefty": Xy1[:, n_features:],   
-                                "rightX": Xy2[:, :n_features],  
-                                "righty": Xy2[:, n_features:]   
-                                }
-        
+            # 遍历计算每个特征的最佳分裂，特征并行时由线程池并发计算
+            search = lambda feature_i: self._feature_best_split(X[idx, feature_i], y_node, stats_node)
+            if self._executor is not None:
+                results = self._executor.map(search, range(n_features))
+            else:
+                results = map(search, range(n_features))
+
+            # 按特征顺序比较，保证与串行查找结果一致
+            for feature_i, (impurity, threshold) in enumerate(results):
+                # 获取最小基尼不纯度
+                # 最佳特征索引和分裂阈值
+                if impurity < init_gini_impurity:
+                    init_gini_impurity = impurity
+                    best_criteria = {"feature_i": feature_i, "threshold": threshold}
+
         # 如果计算的最小不纯度小于设定的最小不纯度
         if init_gini_impurity < self.min_gini_impurity:
+            # 划分左右子树样本索引
+            mask = split_mask(X[idx, best_criteria["feature_i"]], best_criteria["threshold"])
+            left_idx, right_idx = idx[mask], idx[~mask]
+            # 释放当前结点标签和统计量
+            del y_node, stats_node, mask
             # 分别构建左右子树
-            left_branch = self._build_tree(best_sets["leftX"], best_sets["lefty"], current_depth + 1)
-            right_branch = self._build_tree(best_sets["rightX"], best_sets["righty"], current_depth + 1)
+            left_branch = self._build_tree(X, y, left_idx, current_depth + 1, stats)
+            right_branch = self._build_tree(X, y, right_idx, current_depth + 1, stats)
             return TreeNode(feature_i=best_criteria["feature_i"], threshold=best_criteria["threshold"], left_branch=left_branch, right_branch=right_branch)
 
         # 计算叶子计算取值
-        leaf_value = self._leaf_value_calculation(y)
+        leaf_value = self._leaf_value_calculation(y_node)
+        return TreeNode(leaf_value=leaf_value)
+
+    ### 查找单个特征的最佳分裂阈值，返回(不纯度, 阈值)
+    def _feature_best_split(self, feature_values, y_node, stats_node):
+        best_impurity, best_threshold = np.inf, None
+
+        if stats_node is not None:
+            # 单次排序，按升序阈值获取左右子树统计量
+            thresholds, left, right = sorted_split_statistics(feature_values, stats_node)
+            if len(thresholds) > 0:
+                # 一次向量化计算所有阈值的不纯度
+                impurity = self._split_impurity(left, right)
+                best_i = np.argmin(impurity)
+                best_impurity, best_threshold = impurity[best_i], thresholds[best_i]
+            return best_impurity, best_threshold
+
+        n_samples = len(feature_values)
+        # 获取特征的唯一取值
+        unique_values = np.unique(feature_values)
+        # 遍历取值并寻找最佳特征分裂阈值
+        for threshold in unique_values:
+            # 特征节点二叉分裂掩码
+            mask = split_mask(feature_values, threshold)
+            n_left = np.count_nonzero(mask)
+            # 如果分裂后的子集大小都不为0
+            if 0 < n_left < n_samples:
+                # 获取两个子集的标签值
+                y1 = y_node[mask]
+                y2 = y_node[~mask]
+
+                # 计算基尼不纯度
+                impurity = self.impurity_calculation(y_node, y1, y2)
+                if impurity < best_impurity:
+                    best_impurity, best_threshold = impurity, threshold
+        return best_impurity, best_threshold
+
+    ### 直方图决策树构建函数
+    def _build_hist_tree(self, X, y):
+        if len(np.shape(y)) == 1:
+            y = np.expand_dims(y, axis=1)
+        # 每个特征只分箱一次
+        X_binned, bin_thresholds = feature_binning(X, self.max_bins)
+        n_bins = max(len(thresholds) for thresholds in bin_thresholds)
+        stats = self._sample_statistics(y)
+        if stats is None:
+            raise NotImplementedError("split_method='hist' is not supported by %s" % type(self).__name__)
+        idx = np.arange(X.shape[0])
+        hist = build_histogram(X_binned, stats, idx, n_bins)
+        return self._grow_hist_tree(X_binned, bin_thresholds, y, stats, idx, hist)
+
+    ### 直方图结点递归生长
+    def _grow_hist_tree(self, X_binned, bin_thresholds, y, stats, idx, hist, current_depth=0):
+        # 初始化最小基尼不纯度
+        init_gini_impurity = 999
+        n_samples = len(idx)
+        if n_samples >= self.min_samples_split and current_depth <= self.max_depth:
+            # 特征值>=阈值的样本划入左子树，对应分箱的后缀累加和
+            left = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+            right = hist.sum(axis=1, keepdims=True) - left
+            # 阈值必须是当前结点出现过的取值，且分裂后两侧均有样本
+            valid = (hist[:, :, 0] > 0) & (right[:, :, 0] > 0)
+            if valid.any():
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    impurity = np.where(valid, self._split_impurity(left, right), np.inf)
+                feature_i, bin_i = np.unravel_index(np.argmin(impurity), impurity.shape)
+                if impurity[feature_i, bin_i] < init_gini_impurity:
+                    init_gini_impurity = impurity[feature_i, bin_i]
+
+        # 如果计算的最小不纯度小于设定的最小不纯度
+        if init_gini_impurity < self.min_gini_impurity:
+            mask = X_binned[idx, feature_i] >= bin_i
+            left_idx, right_idx = idx[mask], idx[~mask]
+            # 样本较少的子结点直接统计直方图，兄弟结点由父结点直方图相减得到
+            if len(left_idx) <= len(right_idx):
+                left_hist = build_histogram(X_binned, stats, left_idx, hist.shape[1])
+                right_hist = hist - left_hist
+            else:
+                right_hist = build_histogram(X_binned, stats, right_idx, hist.shape[1])
+                left_hist = hist - right_hist
+            # 释放父结点直方图
+            del hist
+            left_branch = self._grow_hist_tree(X_binned, bin_thresholds, y, stats, left_idx, left_hist, current_depth + 1)
+            right_branch = self._grow_hist_tree(X_binned, bin_thresholds, y, stats, right_idx, right_hist, current_depth + 1)
+            # 直方图按 x >= 阈值 划分，阈值存为float，predict_value 与 compile 才使用相同的划分方式
+            return TreeNode(feature_i=feature_i, threshold=float(bin_thresholds[feature_i][bin_i]), left_branch=left_branch, right_branch=right_branch)
+
+        # 计算叶子计算取值
+        leaf_value = self._leaf_value_calculation(y[idx])
         return TreeNode(leaf_value=leaf_value)
 
+    ### 样本分裂统计量，第0列为样本数，其余列由子类定义
+    def _sample_statistics(self, y):
+        stats = self._split_statistics(y)
+        if stats is None:
+            return None
+        return np.concatenate((np.ones((len(y), 1)), stats), axis=1)
+
+    ### 样本分裂统计量，由子类实现，返回None表示只能逐个阈值计算不纯度
+    def _split_statistics(self, y):
+        return None
+
+    ### 由左右子树统计量批量计算不纯度，由子类实现
+    def _split_impurity(self, left, right):
+        raise NotImplementedError("%s does not support vectorized split scoring" % type(self).__name__)
+
     ### 定义二叉树值预测函数
     def predict_value(self, x, tree=None):
         if tree is None:
@@ -115,8 +243,9 @@ class BinaryDecisionTree(object):
         # 选择特征并获取特征值
         feature_value = x[tree.feature_i]
         # 判断落入左子树还是右子树
+        # 与训练时的 split_mask 一致，由阈值的类型决定按 >= 还是按相等划分
         branch = tree.right_branch
-        if isinstance(feature_value, int) or isinstance(feature_value, float):
+        if isinstance(tree.threshold, int) or isinstance(tree.threshold, float):
             if feature_value >= tree.threshold:
                 branch = tree.left_branch
         elif feature_value == tree.threshold:
@@ -126,9 +255,83 @@ class BinaryDecisionTree(object):
 
     ### 数据集预测函数
     def predict(self, X):
+        X = as_float64(X)
+        # 已编译的树按层批量预测
+        if self.compiled_arrays is not None:
+            return self._predict_compiled(X)
         y_pred = [self.predict_value(sample) for sample in X]
         return y_pred
 
+    ### 将拟合好的树编译为并列的扁平数组
+    # 叶子结点的特征索引为-1，左右子结点为-1
+    def compile(self):
+        nodes = [self.root]
+        feature, threshold, left, right = [], [], [], []
+        # 按层遍历，为每个结点分配数组下标
+        for node in nodes:
+            if node.leaf_value is not None:
+                feature.append(-1)
+                threshold.append(0.0)
+                left.append(-1)
+                right.append(-1)
+                continue
+            if not (isinstance(node.threshold, int) or isinstance(node.threshold, float)):
+                raise ValueError("compile only supports numeric thresholds, got %r" % (node.threshold,))
+            feature.append(node.feature_i)
+            threshold.append(node.threshold)
+            left.append(len(nodes))
+            right.append(len(nodes) + 1)
+            nodes.extend([node.left_branch, node.right_branch])
+
+        # 非叶子结点的取值以0填充
+        leaf_value = next(np.asarray(node.leaf_value) for node in nodes if node.leaf_value is not None)
+        value = np.zeros((len(nodes),) + leaf_value.shape, dtype=leaf_value.dtype)
+        for i, node in enumerate(nodes):
+            if node.leaf_value is not None:
+                value[i] = node.leaf_value
+
+        self.compiled_arrays = {
+            "feature": np.array(feature, dtype=np.int32),
+            "threshold": np.array(threshold, dtype=np.float64),
+            "left": np.array(left, dtype=np.int32),
+            "right": np.array(right, dtype=np.int32),
+            "value": value
+        }
+        return self
+
+    ### 编译后的批量预测
+    # 所有样本同时从根结点出发，每轮向下移动一层
+    def _predict_compiled(self, X):
+        feature = self.compiled_arrays["feature"]
+        threshold = self.compiled_arrays["threshold"]
+        left = self.compiled_arrays["left"]
+        right = self.compiled_arrays["right"]
+        node = np.zeros(X.shape[0], dtype=np.intp)
+        # 尚未到达叶子结点的样本
+        active = np.flatnonzero(feature[node] >= 0)
+        while len(active) > 0:
+            current = node[active]
+            go_left = X[active, feature[current]] >= threshold[current]
+            node[active] = np.where(go_left, left[current], right[current])
+            active = active[feature[node[active]] >= 0]
+        return self.compiled_arrays["value"][node]
+
+    ### 保存编译后的数组，每个字段一个.npy文件
+    def save_compiled(self, path):
+        if self.compiled_arrays is None:
+            self.compile()
+        os.makedirs(path, exist_ok=True)
+        for name in COMPILED_FIELDS:
+            np.save(os.path.join(path, name + ".npy"), self.compiled_arrays[name])
+
+    ### 加载编译后的数组，默认以mmap方式打开，无需重建树结构
+    @classmethod
+    def load_compiled(cls, path, mmap_mode="r"):
+        tree = cls()
+        tree.compiled_arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                                for name in COMPILED_FIELDS}
+        return tree
+
 				
 class ClassificationTree(BinaryDecisionTree):
     ### 定义基尼不纯度计算过程
@@ -137,6 +340,19 @@ class ClassificationTree(BinaryDecisionTree):
         gini = calculate_gini(y)
         gini_impurity = p * calculate_gini(y1) + (1-p) * calculate_gini(y2)
         return gini_impurity
+
+    ### 类别独热计数，作为直方图统计量
+    def _split_statistics(self, y):
+        classes = np.unique(y)
+        return (y[:, :1] == classes).astype(float)
+
+    ### 由左右子树类别计数批量计算基尼不纯度
+    def _split_impurity(self, left, right):
+        n_left, n_right = left[..., 0], right[..., 0]
+        gini_left = 1 - np.sum((left[..., 1:] / n_left[..., None]) ** 2, axis=-1)
+        gini_right = 1 - np.sum((right[..., 1:] / n_right[..., None]) ** 2, axis=-1)
+        p = n_left / (n_left + n_right)
+        return p * gini_left + (1 - p) * gini_right
     
     ### 多数投票
     def _majority_vote(self, y):
@@ -170,6 +386,25 @@ class RegressionTree(BinaryDecisionTree):
         variance_reduction = var_tot - (frac_1 * var_y1 + frac_2 * var_y2)
         return sum(variance_reduction)
 
+    ### 标签和与平方和，作为直方图统计量
+    def _split_statistics(self, y):
+        return np.concatenate((y, y ** 2), axis=1)
+
+    ### 由左右子树标签和与平方和批量计算方差减少量
+    def _split_impurity(self, left, right):
+        n_outputs = (left.shape[-1] - 1) // 2
+        total = left + right
+
+        def variance(stats):
+            n = stats[..., :1]
+            mean = stats[..., 1:1 + n_outputs] / n
+            return stats[..., 1 + n_outputs:] / n - mean ** 2
+
+        frac_1 = left[..., :1] / total[..., :1]
+        frac_2 = right[..., :1] / total[..., :1]
+        variance_reduction = variance(total) - (frac_1 * variance(left) + frac_2 * variance(right))
+        return np.sum(variance_reduction, axis=-1)
+
     # 节点值取平均
     def _mean_of_y(self, y):
         value = np.mean(y, axis=0)
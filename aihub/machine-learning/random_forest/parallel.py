@@ -0,0 +1,72 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# 工作进程中挂载的共享训练数据
+_shared = {}
+
+
+### 将数组复制到共享内存，返回共享内存对象和描述信息
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+### 根据描述信息挂载共享内存数组
+def attach_array(desc):
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+### 工作进程初始化，只挂载一次训练数据，不随任务序列化
+def _init_worker(X_desc, y_desc):
+    _shared["X_shm"], _shared["X"] = attach_array(X_desc)
+    _shared["y_shm"], _shared["y"] = attach_array(y_desc)
+
+
+### 拟合单棵树，行抽样和列抽样在工作进程内完成
+def _fit_tree(tree, seed, max_features):
+    X, y = _shared["X"], _shared["y"]
+    n_samples, n_features = X.shape
+    rng = np.random.RandomState(seed)
+    # 第一个随机性，行抽样
+    sample_idx = rng.choice(n_samples, n_samples, replace=True)
+    # 第二个随机性，列抽样
+    feature_idx = rng.choice(n_features, max_features, replace=True)
+    tree.fit(X[np.ix_(sample_idx, feature_idx)], y[sample_idx])
+    # 保存每次列抽样的列索引，方便预测时每棵树调用
+    tree.feature_indices = feature_idx
+    return tree
+
+
+### 多进程并行拟合随机森林中的每棵树
+# 训练数据放在共享内存中，进程间只传递树对象和随机种子
+def fit_trees_parallel(trees, X, y, max_features=None, n_jobs=4, seed=None):
+    if max_features is None:
+        max_features = int(np.sqrt(X.shape[1]))
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=len(trees))
+
+    if n_jobs <= 1:
+        # 单进程时直接在当前进程拟合
+        _shared["X"], _shared["y"] = X, y
+        try:
+            fitted = [_fit_tree(tree, s, max_features) for tree, s in zip(trees, seeds)]
+        finally:
+            _shared.clear()
+    else:
+        X_shm, X_desc = share_array(X)
+        y_shm, y_desc = share_array(y)
+        try:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(X_desc, y_desc)) as executor:
+                fitted = list(executor.map(_fit_tree, trees, seeds, [max_features] * len(trees)))
+        finally:
+            for shm in (X_shm, y_shm):
+                shm.close()
+                shm.unlink()
+    # 用拟合后的树替换原有对象
+    trees[:] = fitted
+    return trees
@@ -1,16 +1,16 @@
 import numpy as np
 
-### 定义二叉特征分裂函数
-def feature_split(X, feature_i, threshold):
-    split_func = None
+### 特征分裂掩码
+# 数值型特征按 >= 阈值划分，其余按 == 阈值划分
+def split_mask(feature_values, threshold):
     if isinstance(threshold, int) or isinstance(threshold, float):
-        split_func = lambda sample: sample[feature_i] >= threshold
-    else:
-        split_func = lambda sample: sample[feature_i] == threshold
+        return feature_values >= threshold
+    return feature_values == threshold
 
-    X_left = np.array([sample for sample in X if split_func(sample)])
-    X_right = np.array([sample for sample in X if not split_func(sample)])
-    return np.array([X_left, X_right])
+### 定义二叉特征分裂函数
+def feature_split(X, feature_i, threshold):
+    mask = split_mask(X[:, feature_i], threshold)
+    return X[mask], X[~mask]
 
 ### 计算基尼指数
 def calculate_gini(y):
@@ -18,6 +18,67 @@ def calculate_gini(y):
     probs = [y.count(i)/len(y) for i in np.unique(y)]
     gini = sum([p*(1-p) for p in probs])
     return gini
+
+### 其他精度的浮点特征转为float64
+# 阈值为float实例时 split_mask 与 predict_value 才按 x >= threshold 划分，拟合时也才能使用排序前缀和查找
+def as_float64(X):
+    X = np.asarray(X)
+    if X.dtype.kind == 'f' and X.dtype != np.float64:
+        X = X.astype(np.float64)
+    return X
+
+
+### 特征分箱函数
+# 每个特征只量化一次，分箱数不超过max_bins
+# 分箱阈值取样本中的真实取值，保证 x >= threshold 的划分语义不变
+# 分箱编号以uint8存储，max_bins须在2~256之间
+def feature_binning(X, max_bins=256):
+    if not 2 <= max_bins <= 256:
+        raise ValueError("max_bins must be between 2 and 256, got %r" % max_bins)
+    n_samples, n_features = X.shape
+    X_binned = np.empty((n_samples, n_features), dtype=np.uint8)
+    bin_thresholds = []
+    for feature_i in range(n_features):
+        feature_values = X[:, feature_i]
+        unique_values = np.unique(feature_values)
+        # 取值数不超过分箱数时，每个取值单独一箱
+        if len(unique_values) <= max_bins:
+            thresholds = unique_values
+        else:
+            # 按分位数选取分箱下界
+            sorted_values = np.sort(feature_values)
+            positions = np.linspace(0, n_samples, max_bins, endpoint=False).astype(int)
+            thresholds = np.unique(sorted_values[positions])
+        X_binned[:, feature_i] = np.searchsorted(thresholds, feature_values, side='right') - 1
+        bin_thresholds.append(thresholds)
+    return X_binned, bin_thresholds
+
+
+### 排序前缀和分裂统计
+# 特征取值只排序一次，返回升序阈值及对应左(>=阈值)右子树的统计量
+def sorted_split_statistics(feature_values, stats):
+    order = np.argsort(feature_values, kind='stable')[::-1]
+    sorted_values = feature_values[order]
+    cum_stats = np.cumsum(stats[order], axis=0)
+    # 每组相同取值的末尾位置即该阈值左子树的结束位置，最小取值右子树为空不参与
+    ends = np.flatnonzero(sorted_values[:-1] != sorted_values[1:])[::-1]
+    left = cum_stats[ends]
+    right = cum_stats[-1] - left
+    return sorted_values[ends], left, right
+
+### 构建特征直方图
+# 返回形状为(特征数, 分箱数, 统计量数)的直方图
+def build_histogram(X_binned, stats, idx, n_bins):
+    n_features = X_binned.shape[1]
+    n_stats = stats.shape[1]
+    # 将(特征, 分箱)编码为一维下标，一次bincount完成所有特征的累加
+    codes = (X_binned[idx].astype(np.intp) + np.arange(n_features) * n_bins).ravel()
+    hist = np.empty((n_features * n_bins, n_stats))
+    for k in range(n_stats):
+        weights = np.repeat(stats[idx, k], n_features)
+        hist[:, k] = np.bincount(codes, weights=weights, minlength=n_features * n_bins)
+    return hist.reshape(n_features, n_bins, n_stats)
+
 	
 ### 打乱数据
 def data_shuffle(X, y, seed=None):
@@ -20,6 +20,9 @@ from aiohttp.web import middleware
 import aiohttp_cors   # 支持跨域请求
 from util.prometheus_util import *
 from util.config import *
+from util.exposition import CONTENT_TYPE_LATEST, CONTENT_TYPE_OPENMETRICS
+from util.alert_queue import AlertQueue
+from util.ingest import BulkBatch
 import prometheus_client
 from prometheus_client import Counter,Gauge
 from prometheus_client.core import CollectorRegistry
@@ -37,15 +40,13 @@ Sender = os.getenv('sender', 'TME_DataInfra')
 Receiver = os.getenv('receiver', '')
 Sender_type = os.getenv('Sender_type', 'wechat')
 
+# 告警不在请求处理中同步推送, 放入队列后由后台worker发送
 def push_message(sender_type,**args):
-    if sender_type=='wechat':
-        push_wechat(args['message'],args['sender'],args['receiver'])
-    if sender_type=='rtx_group':
-        push_rtx_group(args['message'],args['sender'])
+    alert_queue.submit(sender_type,args['message'],args['sender'],args['receiver'])
 
 
 # 微信公共号告警，指向个人推送
-def push_wechat(message,sender,receiver):
+async def push_wechat(session,message,sender,receiver):
     if not sender or not receiver or not message:
         logging.info('no sender %s, or not receiver %s, or no message %s '%(sender,receiver,message))
         return
@@ -59,15 +60,12 @@ def push_wechat(message,sender,receiver):
     }
     jsondata = json.dumps(data)
     logging.info('begin to send wechat %s' % jsondata)
-    import urllib
-    import urllib.parse
-    import urllib.request
-    values = urllib.parse.urlencode({"data": jsondata})
-    resp = urllib.request.urlopen('http://api.weixin.oa.com/itilalarmcgi/sendmsg?%s'%values, timeout=10)
-    logging.info('reveive resp from wechat: %s'% resp.read().decode("unicode_escape"))
+    async with session.get('http://api.weixin.oa.com/itilalarmcgi/sendmsg', params={"data": jsondata}) as resp:
+        resp.raise_for_status()
+        logging.info('reveive resp from wechat: %s'% (await resp.read()).decode("unicode_escape"))
 
 # 企业微信群推送，sender为企业微信群的的key,message为字典数据
-def push_rtx_group(message,sender):
+async def push_rtx_group(session,message,sender,receiver=None):
     data = {
         "msgtype": "text",
         "text": {
@@ -76,8 +74,19 @@ def push_rtx_group(message,sender):
     }
     url = 'http://in.qyapi.weixin.qq.com/cgi-bin/webhook/send?key=%s'%sender
     logging.info('begin to send rtx group %s'%url)
-    resp = requests.post(url,timeout=10,json=data)
-    logging.info('reveive resp from rtx: %s'%resp.content)
+    async with session.post(url,json=data) as resp:
+        resp.raise_for_status()
+        logging.info('reveive resp from rtx: %s'% await resp.read())
+
+
+alert_queue = AlertQueue(
+    promethus.store,
+    senders={'wechat': push_wechat, 'rtx_group': push_rtx_group},
+    maxsize=ALERT_QUEUE_SIZE,
+    workers=ALERT_WORKERS,
+    coalesce_window=ALERT_COALESCE_WINDOW,
+    max_retries=ALERT_MAX_RETRIES
+)
 
 
 # 推送数据
@@ -90,14 +99,54 @@ async def post_data(request):   # 异步监听，只要一有握手就开始触
         return web.json_response(write_response(ERROR_FILE_LARGE,"image file too large or cannot convert to json",{}))
 
     logging.info('receive metrics data %s' % datetime.datetime.now())
-    status = await promethus.label_data(data['metrics'])     # 包含记录信息，处理图片，存储图片，token过期以后要请求license服务器
+    try:
+        results = await promethus.label_data_bulk(data['metrics'])     # 包含记录信息，处理图片，存储图片，token过期以后要请求license服务器
+    except Exception as e:
+        logging.error(e)
+        results = {'metrics': 'error: %s' % e}
+    status = all(result_ok(result) for result in results.values())
 
     logging.info('save metrics data finish %s, %s' % (datetime.datetime.now(),str(status)))
     header = {"Access-Control-Allow-Origin": "*", 'Access-Control-Allow-Methods': 'GET,POST'}
     if status:
-        return web.json_response(write_response(0,"success",{}),headers=header)
+        return web.json_response(write_response(0,"success",{'results': results}),headers=header)
+    else:
+        return web.json_response(write_response(1, "error", {'results': results}), headers=header)
+
+
+# 批量推送数据, 请求体为ndjson或Prometheus text格式, 边接收边解析, 全部解析完成后一次性写入
+@routes.post('/metrics/bulk')
+async def post_bulk_data(request):
+    text_format = request.content_type in ('text/plain', 'application/openmetrics-text')
+    defaults = {'exist_update_type': 'update', 'not_exist_update_type': 'update'} if text_format else {}
+    defaults.update(request.query)    # url参数中的更新规则作用于本次推送的所有metric
+    batch = BulkBatch(defaults)
+
+    size = 0
+    pending = b''
+    async for chunk in request.content.iter_chunked(1 << 16):
+        size += len(chunk)
+        if size > BULK_MAX_SIZE * 1024 ** 2:
+            return web.json_response(write_response(ERROR_FILE_LARGE, "request body too large", {}), status=413)
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            batch.add_line(line.decode('utf-8'), text_format)
+    if pending:
+        batch.add_line(pending.decode('utf-8'), text_format)
+
+    # 解析出错的metric不写入
+    posts = dict((metric_name, post) for metric_name, post in batch.metrics.items() if metric_name not in batch.errors)
+    results = await promethus.label_data_bulk(posts, allow_no_labels=text_format)
+    results.update(batch.errors)
+    logging.info('receive bulk metrics data %s, %d metrics, %d samples' % (datetime.datetime.now(), len(results), batch.samples))
+
+    header = {"Access-Control-Allow-Origin": "*", 'Access-Control-Allow-Methods': 'GET,POST'}
+    result = {'results': results, 'samples': batch.samples, 'line_errors': batch.line_errors[:100]}
+    if all(result_ok(status) for status in results.values()) and not batch.line_errors:
+        return web.json_response(write_response(0, "success", result), headers=header)
     else:
-        return web.json_response(write_response(1, "error", {}), headers=header)
+        return web.json_response(write_response(1, "error", result), headers=header)
 
 
 # 推送数据
@@ -208,8 +257,14 @@ async def default(request):
 
 @routes.get('/metrics')
 async def get_data(request):
-    data = await promethus.get_metrics_prometheus()
-    return web.Response(body=data, content_type="text/plain")  # 将计数器的值返回
+    # 按请求头协商 OpenMetrics 格式与 gzip 压缩
+    openmetrics = 'application/openmetrics-text' in request.headers.get('Accept', '')
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    data = await promethus.get_metrics_prometheus(openmetrics=openmetrics, compress=compress)
+    headers = {'Content-Type': CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_LATEST}
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    return web.Response(body=data, headers=headers)  # 将计数器的值返回
 
 
 if __name__ == '__main__':
@@ -218,6 +273,13 @@ if __name__ == '__main__':
 
     app = web.Application(client_max_size=int(LOCAL_SERVER_SIZE)*1024**2,debug=True)    # 创建app，设置最大接收图片大小为2M
     app.add_routes(routes)     # 添加路由映射
+    # 告警投递队列随app启动和关闭
+    async def start_alert_queue(app):
+        await alert_queue.start()
+    async def stop_alert_queue(app):
+        await alert_queue.stop()
+    app.on_startup.append(start_alert_queue)
+    app.on_cleanup.append(stop_alert_queue)
     # 编写支持跨域的路由
     core = aiohttp_cors.setup(app,defaults={
         '*':aiohttp_cors.ResourceOptions(
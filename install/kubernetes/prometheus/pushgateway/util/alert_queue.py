@@ -0,0 +1,143 @@
+# coding=utf-8
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+
+
+class AlertQueue():
+    """
+    告警推送的异步投递队列
+        webhook 处理函数只把告警放入有界队列后立即返回, 由若干个worker协程
+        通过共享连接池的 aiohttp.ClientSession 推送, 失败时按指数退避重试。
+        相同的告警(推送类型、推送者、接收者、内容都相同)在队列中等待时合并为一条,
+        发送后 coalesce_window 秒内再次出现的相同告警不再推送。
+        队列长度、投递延迟等统计以 pushgateway_alert_* 的metric写入 store, 随 /metrics 一起暴露
+    """
+
+    def __init__(self, store, senders, maxsize=1000, workers=4, coalesce_window=60, max_retries=3, backoff=1, timeout=10):
+        self.store = store
+        self.senders = senders              # sender_type -> async def send(session, message, sender, receiver)
+        self.maxsize = maxsize
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.queue = None
+        self.session = None
+        self.tasks = []
+        self.pending = {}                   # 队列中等待发送的告警, key -> [重复次数, 入队时间]
+        self.recent = {}                    # 最近发送过的告警, key -> 合并窗口结束时间
+        self.latency = deque(maxlen=1000)
+        self.counts = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers * 2),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        for metric_name, describe, labels in [
+            ('pushgateway_alert_total', 'alerts by delivery result', ['sender_type', 'result']),
+            ('pushgateway_alert_queue_depth', 'alerts waiting for delivery', []),
+            ('pushgateway_alert_latency_seconds', 'seconds from enqueue to delivery', ['quantile']),
+        ]:
+            metric = self.store.create(metric_name, labels, describe)
+            metric.exist_update_type = 'update'
+            metric.not_exist_update_type = 'update'
+            # 统计值由队列维护, 不随过期淘汰
+            metric.ttl = 0
+        self._set_depth()
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    def _count(self, sender_type, result):
+        key = (str(sender_type), result)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.store['pushgateway_alert_total'].apply({key: self.counts[key]})
+
+    def _set_depth(self):
+        self.store['pushgateway_alert_queue_depth'].apply({(): self.queue.qsize()})
+
+    def _observe(self, seconds):
+        self.latency.append(seconds)
+        values = sorted(self.latency)
+        self.store['pushgateway_alert_latency_seconds'].apply({
+            ('0.5',): values[int(0.5 * (len(values) - 1))],
+            ('0.99',): values[int(0.99 * (len(values) - 1))],
+        })
+
+    def submit(self, sender_type, message, sender, receiver):
+        """放入投递队列, 不等待发送结果
+        :return 是否入队(合并或丢弃时为 False)"""
+        if sender_type not in self.senders:
+            logging.info('unknown sender_type %s' % sender_type)
+            return False
+        if isinstance(receiver, list):
+            receiver = ','.join(str(x) for x in receiver)
+        key = (sender_type, sender, receiver, message)
+        now = time.time()
+
+        if key in self.pending:
+            self.pending[key][0] += 1
+            self._count(sender_type, 'coalesced')
+            return False
+        if self.recent.get(key, 0) > now:
+            self._count(sender_type, 'coalesced')
+            return False
+        try:
+            self.queue.put_nowait(key)
+        except asyncio.QueueFull:
+            logging.error('alert queue is full, drop alert to %s %s' % (sender_type, receiver))
+            self._count(sender_type, 'dropped')
+            return False
+        self.pending[key] = [1, now]
+        self._count(sender_type, 'enqueued')
+        self._set_depth()
+        return True
+
+    async def _deliver(self, key, message):
+        sender_type, sender, receiver, _ = key
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.senders[sender_type](self.session, message, sender, receiver)
+                return True
+            except Exception as e:
+                logging.error('push %s failed (attempt %d): %s' % (sender_type, attempt + 1, e))
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        return False
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            try:
+                repeat, enqueue_time = self.pending.pop(key)
+                self._set_depth()
+                # 发送中以及发送后 coalesce_window 秒内的相同告警直接合并
+                now = time.time()
+                self.recent[key] = now + self.coalesce_window
+                if len(self.recent) > self.maxsize:
+                    self.recent = dict((k, t) for k, t in self.recent.items() if t > now)
+
+                message = key[3]
+                if repeat > 1:
+                    message = '%s\n(%d 条相同告警已合并)' % (message, repeat)
+                delivered = await self._deliver(key, message)
+                self._count(key[0], 'delivered' if delivered else 'failed')
+                if delivered:
+                    self._observe(time.time() - enqueue_time)
+            except Exception as e:
+                logging.error(e)
+            finally:
+                self.queue.task_done()
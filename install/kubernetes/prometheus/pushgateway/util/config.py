@@ -12,6 +12,17 @@ LOCAL_SERVER_PORT = 80   # 服务器的端口号
 LOCAL_SERVER_KEY = '123456'    # 华为发送来的常数秘钥
 LOCAL_SERVER_SIZE = 5    # 图片大小限制  5M
 
+METRIC_SHARDS = int(os.getenv('METRIC_SHARDS', 16))              # 每个metric的序列分片数
+METRIC_MAX_SERIES = int(os.getenv('METRIC_MAX_SERIES', 10000))   # 每个metric的序列数量上限, 0 为不限制
+METRIC_SERIES_TTL = int(os.getenv('METRIC_SERIES_TTL', 3600))    # 序列超过该秒数没有推送则被淘汰, 0 为不淘汰
+
+BULK_MAX_SIZE = int(os.getenv('BULK_MAX_SIZE', 64))                  # 批量推送请求体大小限制  64M
+
+ALERT_QUEUE_SIZE = int(os.getenv('ALERT_QUEUE_SIZE', 1000))          # 告警投递队列长度上限, 队列满时丢弃新告警
+ALERT_WORKERS = int(os.getenv('ALERT_WORKERS', 4))                   # 告警投递的并发数
+ALERT_COALESCE_WINDOW = int(os.getenv('ALERT_COALESCE_WINDOW', 60))  # 相同告警的合并窗口(秒)
+ALERT_MAX_RETRIES = int(os.getenv('ALERT_MAX_RETRIES', 3))           # 推送失败的重试次数, 间隔按指数退避
+
 # response响应字典，根据arctern_req和result和response生成arctern_reply
 def write_response(error, message, result):
     response = {
@@ -0,0 +1,106 @@
+# coding=utf-8
+import gzip
+import math
+
+# 两种格式的 Content-Type
+CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def format_value(value):
+    """与 prometheus_client 相同的数值格式"""
+    value = float(value)
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    s = repr(value)
+    dot = s.find('.')
+    # Go 比 Python 更早使用科学计数法
+    if value > 0 and dot > 6:
+        mantissa = '{0}.{1}{2}'.format(s[0], s[1:dot], s[dot + 1:]).rstrip('0.')
+        return '{0}e+0{1}'.format(mantissa, dot - 1)
+    return s
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def escape_help(text, openmetrics=False):
+    text = text.replace('\\', r'\\').replace('\n', r'\n')
+    return text.replace('"', r'\"') if openmetrics else text
+
+
+class ExpositionCache():
+    """
+    /metrics 渲染结果的缓存
+        每个metric的每个分片的样本行单独缓存, 以分片的版本号判断是否需要重新渲染,
+        一次拉取只重新渲染上次拉取以后数据有变化的分片。
+        所有metric都没有变化时直接返回上次的完整结果(包括gzip压缩后的结果)
+    """
+
+    def __init__(self):
+        self.samples = {}     # metric_name -> (metric, [(分片版本号, 样本行)])
+        self.body = {}        # (openmetrics, gzip) -> (所有metric的版本, 输出)
+
+    def _shard_text(self, metric, index):
+        labelnames = metric.labels
+        lines = []
+        for attr, series in metric.shards[index].items():
+            if labelnames:
+                labels = ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in zip(labelnames, attr))
+                lines.append('%s{%s} %s\n' % (metric.name, labels, format_value(series[0])))
+            else:
+                lines.append('%s %s\n' % (metric.name, format_value(series[0])))
+        return ''.join(lines)
+
+    def _samples(self, metric):
+        cached = self.samples.get(metric.name)
+        if cached is None or cached[0] is not metric:
+            # 新建或重新创建的metric
+            cached = (metric, [(None, '')] * len(metric.shards))
+            self.samples[metric.name] = cached
+        shards = cached[1]
+        for index, version in enumerate(metric.versions):
+            if shards[index][0] != version:
+                shards[index] = (version, self._shard_text(metric, index))
+        return ''.join(text for _, text in shards)
+
+    def _header(self, metric, openmetrics):
+        return '# HELP %s %s\n# TYPE %s gauge\n' % (metric.name, escape_help(metric.describe, openmetrics), metric.name)
+
+    def render_metric(self, metric, openmetrics=False):
+        """渲染单个metric"""
+        text = self._header(metric, openmetrics) + self._samples(metric)
+        return (text + '# EOF\n' if openmetrics else text).encode('utf-8')
+
+    def render(self, store, openmetrics=False, compress=False):
+        """渲染 store 中的所有metric
+        :param openmetrics  输出 OpenMetrics 格式, 否则为 Prometheus text 格式
+        :param compress     返回 gzip 压缩后的结果"""
+        key = (openmetrics, compress)
+        state = tuple((metric_name, id(store[metric_name]), store[metric_name].version) for metric_name in store)
+        cached = self.body.get(key)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        # 已删除的metric不再保留缓存
+        for metric_name in list(self.samples):
+            if metric_name not in store:
+                del self.samples[metric_name]
+
+        parts = []
+        for metric_name in store:
+            metric = store[metric_name]
+            parts.append(self._header(metric, openmetrics))
+            parts.append(self._samples(metric))
+        if openmetrics:
+            parts.append('# EOF\n')
+        body = ''.join(parts).encode('utf-8')
+        if compress:
+            body = gzip.compress(body, compresslevel=6)
+        self.body[key] = (state, body)
+        return body
@@ -0,0 +1,124 @@
+# coding=utf-8
+import json
+
+
+class BulkBatch():
+    """
+    批量写入的数据, 逐行解析请求体并按metric合并, 最后与 POST /metrics 的 metrics 字段格式相同
+        ndjson: 每行为一个 {metric_name: {labels, describe, ..., data}} 字典, 同一个metric的data依次拼接,
+                其余字段以后出现的为准
+        Prometheus text: # HELP 行作为 describe, 样本行 name{label="value",...} value [timestamp],
+                同一个metric的labels以第一条样本为准, 更新规则由 defaults 给出
+    """
+
+    def __init__(self, defaults=None):
+        self.defaults = defaults or {}
+        self.metrics = {}
+        self.errors = {}           # metric_name -> 解析错误
+        self.line_errors = []      # 无法确定metric的错误行
+        self.samples = 0
+
+    def _metric(self, metric_name):
+        metric_post = self.metrics.get(metric_name)
+        if metric_post is None:
+            metric_post = dict(self.defaults)
+            metric_post['data'] = []
+            self.metrics[metric_name] = metric_post
+        return metric_post
+
+    def add_json_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        for metric_name, post in json.loads(line).items():
+            metric_post = self._metric(metric_name)
+            for key, value in post.items():
+                if key == 'data':
+                    metric_post['data'].extend(value)
+                    self.samples += len(value)
+                else:
+                    metric_post[key] = value
+
+    def add_text_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] == 'HELP':
+                self._metric(parts[2])['describe'] = unescape_help(parts[3]) if len(parts) > 3 else ''
+            return
+
+        metric_name, labels, value = parse_sample(line)
+        metric_post = self._metric(metric_name)
+        names = [name for name, _ in labels]
+        if 'labels' not in metric_post:
+            metric_post['labels'] = names
+        elif sorted(names) != sorted(metric_post['labels']):
+            raise ValueError('labels %s of %s differ from %s' % (names, metric_name, metric_post['labels']))
+        values = dict(labels)
+        metric_post['data'].append([[values[name] for name in metric_post['labels']], value])
+        self.samples += 1
+
+    def add_line(self, line, text_format=False):
+        """解析一行, 出错时记录错误并继续解析后续行"""
+        try:
+            if text_format:
+                self.add_text_line(line)
+            else:
+                self.add_json_line(line)
+        except Exception as e:
+            metric_name = line.split('{', 1)[0].split(None, 1)[0] if text_format and line.strip() else None
+            if metric_name and not metric_name.startswith('#'):
+                self.errors.setdefault(metric_name, 'error: %s' % e)
+            else:
+                self.line_errors.append('error: %s' % e)
+
+
+def unescape_help(text):
+    return text.replace('\\n', '\n').replace('\\\\', '\\')
+
+
+def parse_sample(line):
+    """解析 Prometheus text 格式的一条样本
+    :return metric_name, [(label_name, label_value)], value"""
+    brace = line.find('{')
+    if brace < 0:
+        parts = line.split()
+        if len(parts) < 2:
+            raise ValueError('invalid sample: %s' % line)
+        return parts[0], [], float(parts[1])
+
+    metric_name = line[:brace].strip()
+    labels = []
+    i = brace + 1
+    n = len(line)
+    while True:
+        while i < n and line[i] in ' ,':
+            i += 1
+        if i < n and line[i] == '}':
+            i += 1
+            break
+        eq = line.find('=', i)
+        if eq < 0 or eq + 1 >= n or line[eq + 1] != '"':
+            raise ValueError('invalid labels: %s' % line)
+        name = line[i:eq].strip()
+        # 逐字符读取带转义的label取值
+        chars = []
+        i = eq + 2
+        while i < n and line[i] != '"':
+            if line[i] == '\\' and i + 1 < n:
+                i += 1
+                chars.append('\n' if line[i] == 'n' else line[i])
+            else:
+                chars.append(line[i])
+            i += 1
+        if i >= n:
+            raise ValueError('unterminated label value: %s' % line)
+        labels.append((name, ''.join(chars)))
+        i += 1
+
+    parts = line[i:].split()
+    if not parts:
+        raise ValueError('missing value: %s' % line)
+    return metric_name, labels, float(parts[0])
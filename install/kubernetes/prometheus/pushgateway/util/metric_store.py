@@ -0,0 +1,196 @@
+# coding=utf-8
+import time
+import logging
+from collections import OrderedDict
+
+
+class Metric():
+    """
+    单个metric的所有序列(一组labels的取值为一条序列)
+        序列按 hash(labels取值) 分散到多个分片中, 每个分片是按最近一次推送时间排序的 OrderedDict,
+        单条序列的 update/add/reset/clear 都是O(1), 过期的序列总在分片头部,
+        淘汰时只访问过期的序列。
+        每个分片有一个版本号, 分片中的数据变化时加一, 供 /metrics 只重新渲染变化过的分片
+        所有修改都在事件循环中同步完成(中间没有await), 不需要加锁
+    """
+
+    def __init__(self, name, labels, describe='', shards=16, max_series=10000, ttl=3600):
+        self.name = name
+        self.labels = list(labels)
+        self.describe = describe
+        self.exist_not_update_type = None
+        self.exist_update_type = None
+        self.not_exist_update_type = None
+        self.pull_finish_deal_type = None
+
+        self.shards = [OrderedDict() for _ in range(max(shards, 1))]
+        self.versions = [0] * len(self.shards)
+        self.version = 0                 # 所有分片版本号之和
+        self.max_series = max_series     # 序列数量上限, <=0 时不限制
+        self.ttl = ttl                   # 超过ttl秒没有推送的序列会被淘汰, <=0 时不淘汰
+        self.size = 0
+        self.dropped = 0                 # 超出序列数量上限而被丢弃的新序列数
+        self.evicted = 0                 # 因过期被淘汰的序列数
+
+    def _index(self, attr):
+        return hash(attr) % len(self.shards)
+
+    def _shard(self, attr):
+        return self.shards[self._index(attr)]
+
+    def _changed(self, index):
+        self.versions[index] += 1
+        self.version += 1
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, attr):
+        return attr in self._shard(attr)
+
+    def get(self, attr, default=None):
+        series = self._shard(attr).get(attr)
+        return default if series is None else series[0]
+
+    def items(self):
+        for shard in self.shards:
+            for attr, series in shard.items():
+                yield attr, series[0]
+
+    def _insert(self, index, attr, value, now):
+        if 0 < self.max_series <= self.size:
+            self.evict_expired(now)
+            if self.size >= self.max_series:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logging.warning('metric %s reach max series %d, drop %d new series' % (self.name, self.max_series, self.dropped))
+                return
+        self.shards[index][attr] = [value, now]
+        self.size += 1
+        self._changed(index)
+
+    def _touch(self, shard, attr, series, now):
+        series[1] = now
+        shard.move_to_end(attr)
+
+    def apply(self, data, now=None):
+        """按更新规则合入一次推送的数据
+        :param data  {labels取值tuple: value}"""
+        now = time.time() if now is None else now
+
+        # 对已存在但是没有更新的数据的处理,默认不变化
+        if self.exist_not_update_type in ('clear', 'reset'):
+            for index, shard in enumerate(self.shards):
+                stale = [attr for attr in shard if attr not in data]
+                for attr in stale:
+                    if self.exist_not_update_type == 'clear':
+                        del shard[attr]
+                        self.size -= 1
+                    else:
+                        shard[attr][0] = 0
+                if stale:
+                    self._changed(index)
+
+        for attr, value in data.items():
+            index = self._index(attr)
+            shard = self.shards[index]
+            series = shard.get(attr)
+            if series is not None:
+                # 对已存在,同时也更新的数据进行处理,默认不变化
+                old_value = series[0]
+                if self.exist_update_type == 'update':
+                    series[0] = value
+                elif self.exist_update_type == 'add':
+                    series[0] += value
+                elif self.exist_update_type == 'reset':
+                    series[0] = 0
+                elif self.exist_update_type == 'clear':
+                    del shard[attr]
+                    self.size -= 1
+                    self._changed(index)
+                    continue
+                if series[0] != old_value:
+                    self._changed(index)
+                self._touch(shard, attr, series, now)
+            else:
+                # 对不存在,同时更新的数据进行处理.默认不变化
+                if self.not_exist_update_type == 'reset':
+                    self._insert(index, attr, 0, now)
+                elif self.not_exist_update_type in ('add', 'update'):
+                    self._insert(index, attr, value, now)
+
+    def evict_expired(self, now=None):
+        """淘汰超过ttl没有推送的序列"""
+        if self.ttl <= 0:
+            return 0
+        deadline = (time.time() if now is None else now) - self.ttl
+        evicted = 0
+        for index, shard in enumerate(self.shards):
+            size = len(shard)
+            while shard and next(iter(shard.values()))[1] < deadline:
+                shard.popitem(last=False)
+            if len(shard) < size:
+                evicted += size - len(shard)
+                self._changed(index)
+        self.size -= evicted
+        self.evicted += evicted
+        return evicted
+
+    def pull_finish(self):
+        """处理被拉取以后的逻辑"""
+        if self.pull_finish_deal_type not in ('clear', 'reset'):
+            return
+        for index, shard in enumerate(self.shards):
+            if not shard:
+                continue
+            if self.pull_finish_deal_type == 'clear':
+                shard.clear()
+            else:
+                for series in shard.values():
+                    series[0] = 0
+            self._changed(index)
+        if self.pull_finish_deal_type == 'clear':
+            self.size = 0
+
+    def to_dict(self):
+        """与原先 all_metric[metric_name] 相同的结构"""
+        return {
+            'labels': self.labels,
+            'describe': self.describe,
+            'exist_not_update_type': self.exist_not_update_type,
+            'exist_update_type': self.exist_update_type,
+            'not_exist_update_type': self.not_exist_update_type,
+            'pull_finish_deal_type': self.pull_finish_deal_type,
+            'data': dict(self.items()),
+        }
+
+
+class MetricStore():
+    """所有metric的容器, 以 Name-Metric 形式维护"""
+
+    def __init__(self, shards=16, max_series=10000, ttl=3600):
+        self.shards = shards
+        self.max_series = max_series
+        self.ttl = ttl
+        self.metrics = {}
+
+    def __contains__(self, metric_name):
+        return metric_name in self.metrics
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def __getitem__(self, metric_name):
+        return self.metrics[metric_name]
+
+    def create(self, metric_name, labels, describe=''):
+        metric = Metric(metric_name, labels, describe, shards=self.shards, max_series=self.max_series, ttl=self.ttl)
+        self.metrics[metric_name] = metric
+        return metric
+
+    def delete(self, metric_name):
+        del self.metrics[metric_name]
+
+    def evict_expired(self, now=None):
+        now = time.time() if now is None else now
+        return sum(metric.evict_expired(now) for metric in self.metrics.values())
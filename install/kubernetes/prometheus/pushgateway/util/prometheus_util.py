@@ -5,183 +5,163 @@ import json,datetime,time
 import logging
 import os
 import io
+import re
 import prometheus_client
 from prometheus_client import Counter,Gauge
 from prometheus_client.core import CollectorRegistry
 from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
 
+from util.config import METRIC_SHARDS, METRIC_MAX_SERIES, METRIC_SERIES_TTL
+from util.metric_store import MetricStore
+from util.exposition import ExpositionCache
+
+METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+LABEL_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+# 单个metric的处理结果是否算作成功: success, 'success: 丢弃了部分数据', 'skipped: ...' 都不算失败
+def result_ok(result):
+    return result == 'success' or result.startswith(('success:', 'skipped:'))
+
 class Promethus():
 
     def __init__(self):
         self.loop = asyncio.get_event_loop()  # 获取全局轮训器
         self.registry = CollectorRegistry()   # 存放所有Metrics的容器，以Name-Metric（Key-Value）形式维护其中的Metric对象。
-        self.all_metric={}
+        # 按labels取值分片存储, 限制每个metric的序列数量, 并淘汰长时间没有推送的序列
+        self.store = MetricStore(shards=METRIC_SHARDS, max_series=METRIC_MAX_SERIES, ttl=METRIC_SERIES_TTL)
+        # 缓存每个metric渲染后的文本, 拉取时只重新渲染有变化的部分
+        self.exposition = ExpositionCache()
 
-    # 可以包含多个metric,以字典的形式传输
+    # 可以包含多个metric,以字典的形式传输, 没有失败的metric时返回True, 每个metric的处理结果见 label_data_bulk
     async def label_data(self,json_data):
-        # print(json_data)
         try:
-            for metric_name in json_data:
-
-                metric_post=json_data[metric_name]
-                print(metric_post)
-                labels=metric_post.get('labels',[])
-                describe=metric_post.get('describe','')
-
-                # update 覆盖原有值
-                # clear 删除
-                # keep 保留原样
-                # add 值添加
-                # reset 值设置为0
-                exist_not_update_type= metric_post.get('exist_not_update_type',None)
-                exist_update_type = metric_post.get('exist_update_type', None)
-                not_exist_update_type = metric_post.get('not_exist_update_type', None)
-                pull_finish_deal_type = metric_post.get('pull_finish_deal_type', None)   # 被拉取以后的处理行为
-                # 创建metric
-                if metric_name not in self.all_metric:
-                    if labels:
-                        await self.create_metric(metric_name,labels,describe)     # labels 是不能变的.只不过每种labels取值时的metric_value 是否要保留是不一定了.
-                    else:
-                        continue
-                # 更新metric属性
-                if exist_not_update_type:
-                    self.all_metric[metric_name]['exist_not_update_type']=exist_not_update_type
-                if exist_update_type:
-                    self.all_metric[metric_name]['exist_update_type']=exist_update_type
-                if not_exist_update_type:
-                    self.all_metric[metric_name]['not_exist_update_type']=not_exist_update_type
-                if pull_finish_deal_type:
-                    self.all_metric[metric_name]['pull_finish_deal_type']=pull_finish_deal_type
-
-
-                exist_not_update_type = self.all_metric[metric_name]['exist_not_update_type']
-                exist_update_type = self.all_metric[metric_name]['exist_update_type']
-                not_exist_update_type = self.all_metric[metric_name]['not_exist_update_type']
-
-
-                # 对数据做一下变形
-                data_tuple={}
-                if 'data' in metric_post:
-                    for one_data in metric_post['data']:
-                        attr,value=one_data
-                        attr=tuple(attr)
-                        data_tuple[attr]=value
-                # print(data_tuple)
-                # 按规则更新数据
-                # 对已存在但是没有更新的数据的处理,默认不变化
-                if exist_not_update_type=='clear':
-                    for attr in self.all_metric[metric_name]['data']:
-                        if attr not in data_tuple:
-                            del self.all_metric[metric_name]['data']
-                elif exist_not_update_type=='reset':
-                    for attr in self.all_metric[metric_name]['data']:
-                        if attr not in data_tuple:
-                            self.all_metric[metric_name]['data']=0
-
-                # 对已存在,同时也更新的数据进行处理,默认不变化
-                if exist_update_type == 'update':
-                    for attr in data_tuple:
-                        if attr in self.all_metric[metric_name]['data']:
-                            self.all_metric[metric_name]['data'][attr] = data_tuple[attr]
-                elif exist_update_type == 'add':
-                    for attr in data_tuple:
-                        if attr in self.all_metric[metric_name]['data']:
-                            self.all_metric[metric_name]['data'][attr] += data_tuple[attr]
-                elif exist_update_type == 'clear':
-                    for attr in data_tuple:
-                        if attr in self.all_metric[metric_name]['data']:
-                            del self.all_metric[metric_name]['data'][attr]
-                elif exist_update_type == 'reset':
-                    for attr in data_tuple:
-                        if attr in self.all_metric[metric_name]['data']:
-                            self.all_metric[metric_name]['data'][attr]=0
-
-                # 对不存在,同时更新的数据进行处理.默认不变化
-                if not_exist_update_type == 'reset':
-                    for attr in data_tuple:
-                        if attr not in self.all_metric[metric_name]['data']:
-                            self.all_metric[metric_name]['data'][attr] = 0
-                elif not_exist_update_type == 'add' or not_exist_update_type == 'update' :
-                    for attr in data_tuple:
-                        if attr not in self.all_metric[metric_name]['data']:
-                            self.all_metric[metric_name]['data'][attr] = data_tuple[attr]
-
-                return True
-
+            results = await self.label_data_bulk(json_data)
         except Exception as e:
-            print(e)
+            logging.error(e)
             return False
-        return False
+        for metric_name, result in results.items():
+            if not result_ok(result):
+                logging.error('label metric %s %s' % (metric_name, result))
+        return all(result_ok(result) for result in results.values())
+
+    # 批量写入多个metric, 中间没有await, 一次拉取不会只看到一部分metric的更新. 返回每个metric的处理结果
+    #   allow_no_labels  不存在的metric没有labels时也创建(Prometheus text格式中没有labels的样本), 否则与原先一样跳过
+    async def label_data_bulk(self,json_data,allow_no_labels=False):
+        now = time.time()
+        self.store.evict_expired(now)
+        results = {}
+        for metric_name in json_data:
+            try:
+                results[metric_name] = self._label_metric(metric_name, json_data[metric_name], now, allow_no_labels)
+            except Exception as e:
+                logging.error('label metric %s error: %s' % (metric_name, e))
+                results[metric_name] = 'error: %s' % e
+        return results
+
+    def _label_metric(self,metric_name,metric_post,now,allow_no_labels=False):
+        logging.debug('receive metric %s' % metric_name)
+        labels=metric_post.get('labels',None)
+        describe=metric_post.get('describe','')
+
+        # update 覆盖原有值
+        # clear 删除
+        # keep 保留原样
+        # add 值添加
+        # reset 值设置为0
+        exist_not_update_type= metric_post.get('exist_not_update_type',None)
+        exist_update_type = metric_post.get('exist_update_type', None)
+        not_exist_update_type = metric_post.get('not_exist_update_type', None)
+        pull_finish_deal_type = metric_post.get('pull_finish_deal_type', None)   # 被拉取以后的处理行为
+        # 创建metric
+        if metric_name not in self.store:
+            if labels is None or (not labels and not allow_no_labels):
+                return 'skipped: metric not exist and no labels'
+            self._create_metric(metric_name,labels,describe)     # labels 是不能变的.只不过每种labels取值时的metric_value 是否要保留是不一定了.
+        metric = self.store[metric_name]
+        # 更新metric属性
+        if exist_not_update_type:
+            metric.exist_not_update_type=exist_not_update_type
+        if exist_update_type:
+            metric.exist_update_type=exist_update_type
+        if not_exist_update_type:
+            metric.not_exist_update_type=not_exist_update_type
+        if pull_finish_deal_type:
+            metric.pull_finish_deal_type=pull_finish_deal_type
+
+        # 推送的labels与已有metric的labels名称必须一致, 顺序不同时按已有metric的顺序重排取值
+        order = None
+        if labels is not None and list(labels) != metric.labels:
+            if sorted(labels) != sorted(metric.labels):
+                return 'error: labels %s differ from %s' % (list(labels), metric.labels)
+            order = [list(labels).index(label) for label in metric.labels]
+
+        # 对数据做一下变形, 丢弃labels数量不一致或值不是数值的数据
+        data_tuple={}
+        dropped=0
+        if 'data' in metric_post:
+            for one_data in metric_post['data']:
+                attr,value=one_data
+                if len(attr) != len(metric.labels) or not isinstance(value, (int, float)):
+                    dropped+=1
+                    continue
+                if order is not None:
+                    attr = [attr[i] for i in order]
+                data_tuple[tuple(attr)]=value
+        # 按规则更新数据
+        metric.apply(data_tuple, now)
+        if dropped:
+            return 'success: dropped %d samples with wrong labels number or non-numeric value' % dropped
+        return 'success'
 
 
     # 删除matric
     async def delete(self,metric_name):
-        del self.all_metric[metric_name]
+        self.store.delete(metric_name)
 
     # 读取metric的数据
-    async def get_metric_prometheus(self,metric_name):
-        if metric_name in self.all_metric[metric_name]:
-            # 根据data生成prometheus格式数据,
-            metric = Gauge(metric_name, self.all_metric[metric_name]['describe'], self.all_metric[metric_name]['labels'])
-
-            for attr in self.all_metric[metric_name]['data']:
-                metric.labels(*attr).set(self.all_metric[metric_name]['data'][attr])
-            prometheus_data = prometheus_client.generate_latest(metric)
+    async def get_metric_prometheus(self,metric_name,openmetrics=False):
+        if metric_name in self.store:
+            metric = self.store[metric_name]
+            prometheus_data = self.exposition.render_metric(metric, openmetrics)
 
             # 处理拉取数据后逻辑
-            if self.all_metric[metric_name]['pull_finish_deal_type']=='clear':
-                self.all_metric[metric_name]['data']={}
-            elif self.all_metric[metric_name]['pull_finish_deal_type']=='reset':
-                for attr in self.all_metric[metric_name]['data']:
-                    self.all_metric[metric_name]['data'][attr]=0
+            metric.pull_finish()
 
             return prometheus_data
 
         return None
 
-    # 获取所有的metrics数据
-    async def get_metrics_prometheus(self,onlyread=False):
-        self.registry= CollectorRegistry()
-        for metric_name in self.all_metric:
-            # Gauge默认存放在全局register中,且全局register中不能存在相同名称的metric
-            metric = Gauge(name=metric_name, documentation=self.all_metric[metric_name]['describe'],labelnames=self.all_metric[metric_name]['labels'],registry=self.registry)
-
-            for attr in self.all_metric[metric_name]['data']:
-                metric.labels(*attr).set(self.all_metric[metric_name]['data'][attr])
+    # 获取所有的metrics数据, 只重新渲染上次拉取后有变化的数据
+    async def get_metrics_prometheus(self,onlyread=False,openmetrics=False,compress=False):
+        self.store.evict_expired()
+        prometheus_data = self.exposition.render(self.store, openmetrics, compress)
 
-            if not onlyread:
+        if not onlyread:
+            for metric_name in self.store:
                 # 处理拉取数据后逻辑
-                if self.all_metric[metric_name]['pull_finish_deal_type']=='clear':
-                    self.all_metric[metric_name]['data']={}
-                elif self.all_metric[metric_name]['pull_finish_deal_type']=='reset':
-                    for attr in self.all_metric[metric_name]['data']:
-                        self.all_metric[metric_name]['data'][attr]=0
+                self.store[metric_name].pull_finish()
 
-        return prometheus_client.generate_latest(self.registry)
+        return prometheus_data
 
     #读取metric的信息和数据
     async def get_metric(self,metric_name):
-        return self.all_metric[metric_name]
+        return self.store[metric_name].to_dict()
 
     # 获取所有metric信息
     async def get_metrics(self):
-        return self.all_metric
+        return dict((metric_name, self.store[metric_name].to_dict()) for metric_name in self.store)
 
     # labels为可以为该数据打的标签
     async def create_metric(self,metric_name,labels,describe=''):
-        print('create metric %s'%metric_name)
-
-        if metric_name in self.all_metric:
-            del self.all_metric[metric_name]
-        metric={
-            'labels':labels,
-            'describe':describe,
-            'data':{},
-        }
-        self.all_metric[metric_name] = metric
-
-
-
-
-
-
+        self._create_metric(metric_name,labels,describe)
+
+    def _create_metric(self,metric_name,labels,describe=''):
+        logging.info('create metric %s'%metric_name)
+        # 不再经过 prometheus_client 渲染, 在创建时检查名称是否合法
+        if not METRIC_NAME_RE.match(metric_name):
+            raise ValueError('invalid metric name %s' % metric_name)
+        for label in labels:
+            if not LABEL_NAME_RE.match(label) or label.startswith('__'):
+                raise ValueError('invalid label name %s of metric %s' % (label, metric_name))
+        self.store.create(metric_name, labels, describe)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import common
+import argparse
+import time
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark KV round trips of the embedding cache, with an in-memory KV in place of Redis")
+	parser.add_argument("-n", "--n_ids", type=int, default=1000000, help="number of distinct ids")
+	parser.add_argument("-a", "--zipf", type=float, default=1.2, help="zipf exponent of the id distribution")
+	parser.add_argument("-b", "--batch_size", type=int, default=1024, help="ids per step")
+	parser.add_argument("-s", "--steps", type=int, default=2000, help="number of steps")
+	parser.add_argument("-d", "--dim", type=int, default=36, help="embedding size")
+	parser.add_argument("-c", "--capacity", type=str, default="10000,100000", help="comma separated cache capacities")
+	parser.add_argument("-p", "--policy", type=str, default="lru,lfu", help="comma separated cache policies")
+	parser.add_argument("-f", "--flush_steps", type=int, default=100, help="write back every flush_steps steps")
+	parser.add_argument("-l", "--latency_ms", type=float, default=0.5, help="simulated latency of each KV round trip")
+	parser.add_argument("-k", "--key_latency_us", type=float, default=2.0, help="simulated cost of each key read or written")
+	return parser.parse_args()
+
+
+class InMemoryKV(object):
+	"""代替 Redis 表, lookup/upsert 与 tfra.dynamic_embedding.Variable 一致,
+	每次调用计为一次往返, 耗时为往返延迟加上与 key 数成正比的传输与处理时间"""
+
+	def __init__(self, dim, latency_ms=0.0, key_latency_us=0.0):
+		self.dim = dim
+		self.latency = latency_ms / 1000.0
+		self.key_latency = key_latency_us / 1e6
+		self.table = {}
+		self.round_trips = 0
+		self.keys_read = 0
+		self.keys_written = 0
+
+	def _default(self, key):
+		return np.full(self.dim, (key % 1000) / 1000.0, dtype=np.float32)
+
+	def lookup(self, ids, return_exists=False):
+		if not len(ids):
+			values = np.zeros((0, self.dim), dtype=np.float32)
+			return (values, np.zeros(0, dtype=bool)) if return_exists else values
+		self.round_trips += 1
+		self.keys_read += len(ids)
+		time.sleep(self.latency + self.key_latency * len(ids))
+		values = np.stack([self.table[key] if key in self.table else self._default(key) for key in ids.tolist()])
+		if return_exists:
+			return values, np.array([key in self.table for key in ids.tolist()])
+		return values
+
+	def upsert(self, ids, values):
+		if not len(ids):
+			return
+		self.round_trips += 1
+		self.keys_written += len(ids)
+		time.sleep(self.latency + self.key_latency * len(ids))
+		for key, value in zip(ids.tolist(), values):
+			self.table[key] = value.copy()
+
+
+def make_batches(n_ids, zipf, batch_size, steps, dim):
+	rng = np.random.RandomState(13)
+	batches = []
+	for _ in range(steps):
+		ids = np.unique((rng.zipf(zipf, batch_size) - 1) % n_ids).astype(np.int64)
+		batches.append((ids, rng.normal(0, 1, (len(ids), dim)).astype(np.float32)))
+	return batches
+
+
+# 不经过缓存: 每步查询全部id, 更新后全部写回
+def run_direct(kv, batches, learning_rate):
+	start = time.perf_counter()
+	for ids, grads in batches:
+		values = kv.lookup(ids)
+		kv.upsert(ids, values - learning_rate * grads)
+	return time.perf_counter() - start
+
+
+# 与 model_fn_builder.cache_write_back 一致: 增量加到KV中的当前值上, 与直接写回的行一起写入, 合并后的取值放回缓存
+def write_back(kv, cache, force=False):
+	ids, deltas, values, through_ids, through_values = cache.drain(force)
+	current, exists = kv.lookup(ids, return_exists=True)
+	merged = np.where(exists[:, None], current + deltas, values)
+	kv.upsert(np.concatenate([ids, through_ids]), np.concatenate([merged, through_values]))
+	cache.refresh(ids, merged)
+
+# 与 model_fn_builder.cached_embedding_lookup 中的图一致: 缓存查询 -> 未命中的查询KV -> 放入缓存 -> 更新 -> 按步写回
+def cached_step(kv, cache, ids, grads):
+	hit, values = cache.lookup(ids)
+	miss_ids = ids[~hit]
+	miss_values = kv.lookup(miss_ids)
+	cache.insert(miss_ids, miss_values)
+	values[~hit] = miss_values
+	cache.apply_gradients(ids, grads)
+	write_back(kv, cache)
+
+def run_cached(kv, cache, batches):
+	start = time.perf_counter()
+	for ids, grads in batches:
+		cached_step(kv, cache, ids, grads)
+	write_back(kv, cache, force=True)
+	return time.perf_counter() - start
+
+# 两个 worker 各自的缓存共用一个KV, 交替训练
+def run_shared(kv, caches, batches):
+	for i, (ids, grads) in enumerate(batches):
+		cached_step(kv, caches[i % len(caches)], ids, grads)
+	for cache in caches:
+		write_back(kv, cache, force=True)
+
+def check_equal(kv, direct, name):
+	assert set(kv.table) == set(direct.table), name
+	for key, value in direct.table.items():
+		assert np.allclose(kv.table[key], value, atol=1e-4), '%s: embedding of %d differs' % (name, key)
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	print(args)
+	learning_rate = 0.01
+	batches = make_batches(args.n_ids, args.zipf, args.batch_size, args.steps, args.dim)
+
+	direct = InMemoryKV(args.dim, args.latency_ms, args.key_latency_us)
+	direct_elapsed = run_direct(direct, batches, learning_rate)
+	print('%-16s %8s %10d round trips %12d keys read %12d keys written %8.2fs' % ('direct', 'hit rate', direct.round_trips, direct.keys_read, direct.keys_written, direct_elapsed))
+
+	for policy in args.policy.split(','):
+		for capacity in [int(x) for x in args.capacity.split(',')]:
+			kv = InMemoryKV(args.dim, args.latency_ms, args.key_latency_us)
+			cache = EmbeddingCache(args.dim, capacity=capacity, policy=policy, learning_rate=learning_rate, flush_steps=args.flush_steps)
+			elapsed = run_cached(kv, cache, batches)
+			# 单个 worker 时缓存只改变访问KV的方式, 最终的 embedding 与直接更新一致
+			check_equal(kv, direct, '%s/%d' % (policy, capacity))
+			print('%-16s %8.3f %10d round trips %12d keys read %12d keys written %8.2fs   keys read %5.1f%%  speedup %5.2fx' % (
+				'%s/%d' % (policy, capacity), cache.hit_rate(), kv.round_trips, kv.keys_read, kv.keys_written, elapsed,
+				100.0 * kv.keys_read / direct.keys_read, direct_elapsed / elapsed))
+
+			# 梯度与取值无关, 两个 worker 的更新都写回时结果同样与直接更新一致
+			kv = InMemoryKV(args.dim)
+			caches = [EmbeddingCache(args.dim, capacity=capacity, policy=policy, learning_rate=learning_rate, flush_steps=args.flush_steps) for _ in range(2)]
+			run_shared(kv, caches, batches)
+			check_equal(kv, direct, '%s/%d shared' % (policy, capacity))
+			print('%-16s two workers sharing one KV: ok' % ('%s/%d' % (policy, capacity)))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import common
+import os
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import input_fn_builder
+from input_fn_builder import write_tfrecords
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark examples/sec of the input_fn* variants")
+	parser.add_argument("-v", "--variants", type=str, default="input_fn,input_fn2,input_fn4,input_fn5", help="comma separated input_fn names")
+	parser.add_argument("-d", "--data_files", type=str, default="", help="TFRecord/Parquet glob for input_fn5, synthetic shards are written when empty")
+	parser.add_argument("-b", "--batch_size", type=int, default=1024, help="batch size of input_fn5")
+	parser.add_argument("-n", "--n_examples", type=int, default=1000000, help="number of synthetic examples")
+	parser.add_argument("-s", "--num_shards", type=int, default=16, help="number of synthetic shards")
+	parser.add_argument("-t", "--seconds", type=float, default=20, help="time budget of each variant")
+	parser.add_argument("-p", "--parquet", action="store_true", help="write the synthetic shards as Parquet instead of TFRecord")
+	return parser.parse_args()
+
+
+# 生成模拟数据的分片
+def make_shards(output_dir, n_examples, num_shards, parquet=False):
+	rng = np.random.RandomState(13)
+	columns = {
+		'movie_id': rng.randint(0, 100000, size=n_examples).astype(np.int64),
+		'user_id': rng.randint(0, 1000000, size=n_examples).astype(np.int64),
+		'user_rating': rng.uniform(1, 5, size=n_examples).astype(np.float32),
+	}
+	if not parquet:
+		return write_tfrecords(tf.data.Dataset.from_tensor_slices(columns), output_dir, num_shards)
+
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	for i in range(num_shards):
+		table = pa.table(dict((name, values[i::num_shards]) for name, values in columns.items()))
+		pq.write_table(table, os.path.join(output_dir, 'part-%05d.parquet' % i))
+	return os.path.join(output_dir, '*.parquet')
+
+
+# 在时间预算内尽量多地读取batch, 第一个batch作为预热不计入
+def measure(dataset, seconds):
+	iterator = iter(dataset)
+	next(iterator)
+	n_examples = 0
+	start = time.perf_counter()
+	while time.perf_counter() - start < seconds:
+		try:
+			batch = next(iterator)
+		except StopIteration:
+			break
+		n_examples += int(tf.shape(batch['user_id'])[0])
+	elapsed = time.perf_counter() - start
+	return n_examples, elapsed
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	print(args)
+
+	tmp_dir = None
+	data_files = args.data_files
+	if 'input_fn5' in args.variants and not data_files:
+		tmp_dir = tempfile.mkdtemp()
+		data_files = make_shards(tmp_dir, args.n_examples, args.num_shards, args.parquet)
+
+	try:
+		for name in args.variants.split(','):
+			# 任何一个实现出错都直接失败, 不跳过
+			if name == 'input_fn5':
+				dataset = input_fn_builder.input_fn5(data_files=data_files, batch_size=args.batch_size)
+			else:
+				dataset = getattr(input_fn_builder, name)()
+			n_examples, elapsed = measure(dataset, args.seconds)
+			print('%-10s %12d examples %8.2fs %14.0f examples/sec' % (name, n_examples, elapsed, n_examples / elapsed))
+	finally:
+		if tmp_dir:
+			shutil.rmtree(tmp_dir)
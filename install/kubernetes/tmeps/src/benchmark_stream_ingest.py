@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import common
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+from google.protobuf import json_format
+from sample_pb2 import Sample
+
+from stream_ingest import StreamIngest, CSV_COLUMNS, decode_samples
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark samples/sec of the cdmq stream ingest, with an in-process fake consumer")
+	parser.add_argument("-n", "--n_samples", type=int, default=200000, help="number of synthetic samples")
+	parser.add_argument("-b", "--batch_size", type=int, default=1024, help="batch size of StreamIngest")
+	parser.add_argument("-r", "--max_poll_records", type=int, default=5000, help="max records of each poll")
+	parser.add_argument("-w", "--workers", type=str, default="0,2,4", help="comma separated decode worker numbers")
+	return parser.parse_args()
+
+
+Record = namedtuple('Record', ['value'])
+
+
+class FakeConsumer(object):
+	"""按 KafkaConsumer.poll 的返回格式依次产出事先序列化好的消息"""
+
+	def __init__(self, messages, partitions=4):
+		self.messages = messages
+		self.partitions = partitions
+		self.offset = 0
+
+	def poll(self, timeout_ms=0, max_records=500):
+		if self.offset >= len(self.messages):
+			time.sleep(timeout_ms / 1000.0)
+			return {}
+		records = self.messages[self.offset: self.offset + max_records]
+		self.offset += len(records)
+		# 每个分区取连续的一段, 拼接后与原顺序一致, 便于和逐条解码的结果比较
+		step = (len(records) + self.partitions - 1) // self.partitions
+		return dict((partition, [Record(value) for value in records[partition * step: (partition + 1) * step]]) for partition in range(self.partitions))
+
+	def close(self):
+		pass
+
+
+def make_messages(n_samples):
+	rng = np.random.RandomState(13)
+	messages = []
+	for i in range(n_samples):
+		sample = Sample(timestamp=int(time.time()), joinKey=str(i), valid=True)
+		sample.csv['qv_avg_pt_7d'] = '%.4f' % rng.uniform(0, 100)
+		sample.csv['sex'] = str(rng.randint(0, 3))
+		sample.csv['age'] = str(rng.randint(0, 100))
+		sample.csv['vid'] = 'v%08d' % rng.randint(0, 10 ** 8)
+		messages.append(sample.SerializeToString())
+	return messages
+
+
+# 原先 cdmq_gen_init 的逐条解码: MessageToDict + mask
+def legacy_decode(message):
+	sample = Sample()
+	sample.ParseFromString(message)
+	csv_dict = json_format.MessageToDict(sample)['csv']
+	return dict((name, csv_dict[key]) for name, (key, _) in CSV_COLUMNS.items())
+
+
+def run_legacy(messages):
+	start = time.perf_counter()
+	rows = [legacy_decode(message) for message in messages]
+	return rows, time.perf_counter() - start
+
+
+def run_stream(messages, batch_size, max_poll_records, workers):
+	consumer = FakeConsumer(messages)
+	ingest = StreamIngest(lambda: consumer, batch_size=batch_size, max_poll_records=max_poll_records, workers=workers)
+	# FakeConsumer 取完后只返回空结果, 取够样本后主动停止
+	columns = dict((name, []) for name in CSV_COLUMNS)
+	n_samples = 0
+	start = time.perf_counter()
+	for batch in ingest.batches():
+		for name, array in batch.items():
+			columns[name].append(array)
+		n_samples += len(batch['user_id'])
+		if n_samples >= len(messages):
+			break
+	elapsed = time.perf_counter() - start
+	ingest.stop()
+	return dict((name, np.concatenate(arrays)) for name, arrays in columns.items()), elapsed
+
+
+# 缺少字段、无法转换、nan 的样本都应被丢弃
+def check_invalid_samples():
+	fields = [
+		{'qv_avg_pt_7d': '1.5', 'sex': '1', 'age': '20'},
+		{'qv_avg_pt_7d': '2.5', 'sex': '2'},
+		{'qv_avg_pt_7d': 'x', 'sex': '1', 'age': '30'},
+		{'qv_avg_pt_7d': 'nan', 'sex': '1', 'age': '40'},
+		{'qv_avg_pt_7d': '3.5', 'sex': '0', 'age': '50'},
+	]
+	messages = []
+	for csv in fields:
+		sample = Sample()
+		sample.csv.update(csv)
+		messages.append(sample.SerializeToString())
+	batch = decode_samples(messages)
+	assert batch['movie_id'].tolist() == [20, 50], batch
+	assert batch['user_id'].tolist() == [1, 0], batch
+	assert batch['user_rating'].tolist() == [1.5, 3.5], batch
+
+
+# 队列已满时 stop 不能阻塞
+def check_stop(messages):
+	consumer = FakeConsumer(messages)
+	ingest = StreamIngest(lambda: consumer, batch_size=16, max_poll_records=1000, workers=0, max_pending=2)
+	batches = ingest.batches()
+	next(batches)
+	time.sleep(0.5)
+	start = time.perf_counter()
+	batches.close()
+	ingest.stop()
+	assert time.perf_counter() - start < 5, 'stop blocked'
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	print(args)
+	messages = make_messages(args.n_samples)
+	check_invalid_samples()
+	check_stop(messages)
+
+	rows, elapsed = run_legacy(messages)
+	print('%-12s %10d samples %8.2fs %12.0f samples/sec' % ('legacy', len(rows), elapsed, len(rows) / elapsed))
+
+	for workers in [int(x) for x in args.workers.split(',')]:
+		columns, elapsed = run_stream(messages, args.batch_size, args.max_poll_records, workers)
+		for name, (_, dtype) in CSV_COLUMNS.items():
+			expected = np.array([row[name] for row in rows], dtype=np.float64).astype(dtype)
+			assert np.array_equal(columns[name], expected), 'column %s differs from the legacy decoding' % name
+		n_samples = len(columns['user_id'])
+		print('%-12s %10d samples %8.2fs %12.0f samples/sec' % ('workers=%d' % workers, n_samples, elapsed, n_samples / elapsed))
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import numpy as np
+
+EMPTY_IDS = np.zeros(0, dtype=np.int64)
+EMPTY_SLOTS = np.zeros(0, dtype=np.int64)
+
+
+class EmbeddingCache(object):
+	"""
+	worker 本地的热点 embedding 缓存, 位于 Redis 动态 embedding 表之前
+		命中缓存的 id 不再访问 Redis, 未命中的 id 由调用方一次从 Redis 查询后通过 insert 放入缓存。
+		梯度直接在缓存中以 SGD 更新, 同时累计每行自上次写回以来的增量, 每 flush_steps 步由 drain 批量取出增量,
+		调用方把增量加到 Redis 中的当前值上再写回, 多个 worker 对同一个 id 的更新不会互相覆盖,
+		合并后的取值通过 refresh 放回缓存, 写回时读到的取值不再浪费, 热点行一直留在缓存中。
+		只有最近两个写回周期内第二次未命中的 id 才放入缓存, 只出现一次的长尾 id 与不经过缓存时一样,
+		在本步更新后由 drain 直接取出写回取值, 不必在写回时再读一次 Redis。
+		连续 max_stale_flushes 次写回都没有更新过的行移出缓存, 下次重新读取 Redis,
+		因此缓存中的行与其他 worker 的更新最多相差 max_stale_flushes * flush_steps 步。
+		有增量的行被淘汰时先放入待写回区, 待写回的行仍可被查询到。
+		缓存满时批量淘汰 capacity/64 行, policy 为 lru 时淘汰最久未访问的行, 为 lfu 时淘汰访问次数最少的行,
+		访问次数在每次写回时减半。
+		当前 batch 中的 id 在本步结束(apply_gradients)之前不会被淘汰, batch 中的 id 数超过容量时,
+		放不下的行在本步更新后直接写回或进入待写回区
+	"""
+
+	def __init__(self, dim, capacity=100000, policy='lru', learning_rate=0.01, flush_steps=100, max_pending=10000,
+				 max_stale_flushes=10):
+		if policy not in ('lru', 'lfu'):
+			raise ValueError('unknown cache policy %s' % policy)
+		self.dim = dim
+		self.capacity = capacity
+		self.policy = policy
+		self.learning_rate = learning_rate
+		self.flush_steps = flush_steps
+		self.max_pending = max_pending
+		self.max_stale_flushes = max_stale_flushes
+
+		# 以下数组均以 slot 为下标
+		self.rows = np.zeros((capacity, dim), dtype=np.float32)
+		self.deltas = np.zeros((capacity, dim), dtype=np.float32)   # 上次写回以来的累计更新
+		self.keys = np.zeros(capacity, dtype=np.int64)
+		self.used = np.zeros(capacity, dtype=bool)
+		self.pinned = np.zeros(capacity, dtype=bool)       # 本步访问过的slot, 不淘汰
+		self.dirty = np.zeros(capacity, dtype=bool)        # 被更新过、还没有写回
+		self.freq = np.zeros(capacity, dtype=np.int64)
+		self.last_used = np.zeros(capacity, dtype=np.int64)
+		self.synced = np.zeros(capacity, dtype=np.int64)   # 最近一次与 Redis 同步时的写回次数
+		self.slots = {}                                    # id -> slot
+		self.free = list(range(capacity - 1, -1, -1))
+		self.pending = {}                                  # 已被淘汰、等待写回的行, id -> (取值, 增量)
+		self.uncached = {}                                 # 本步放不进缓存的待写回行, id -> (取值, 增量)
+		self.through_ids = []                              # 直接写回的行, 每步由 drain 取出
+		self.through_values = []
+		self.seen = set()                                  # 本写回周期内未命中过一次、没有放入缓存的 id
+		self.seen_before = set()                           # 上一个写回周期的 seen
+		self.step_slots = EMPTY_SLOTS                      # 本步 batch 中每个 id 的slot, 不在缓存中为 -1
+		self.step_misses = EMPTY_SLOTS                     # 本步未命中的 id 在 batch 中的位置
+		self.step_through = EMPTY_SLOTS                    # 本步不放入缓存的 id 在 batch 中的位置
+		self.step_through_values = None                    # 以及从 Redis 读到的取值
+		self.steps = 0
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.flushes = 0
+		self.written = 0
+
+	def __len__(self):
+		return len(self.slots)
+
+	def _evict(self):
+		"""腾出至少一个空闲slot, 当前 batch 中的 id 不淘汰
+		:return 是否腾出"""
+		candidates = np.flatnonzero(self.used & ~self.pinned)
+		if not len(candidates):
+			return False
+		n = min(len(candidates), max(1, self.capacity // 64))
+		scores = self.freq if self.policy == 'lfu' else self.last_used
+		victims = candidates[np.argpartition(scores[candidates], n - 1)[:n]] if n < len(candidates) else candidates
+		for slot in victims[self.dirty[victims]]:
+			self.pending[int(self.keys[slot])] = (self.rows[slot].copy(), self.deltas[slot].copy())
+		self._release(victims)
+		self.evictions += len(victims)
+		return True
+
+	def _release(self, slots):
+		for key in self.keys[slots].tolist():
+			del self.slots[key]
+		self.used[slots] = False
+		self.dirty[slots] = False
+		self.free.extend(slots.tolist())
+
+	def _admit(self, key, value, delta=None):
+		"""放入一行, delta 不为空时是还没有写回的行
+		:return slot, 放不进缓存时为 -1"""
+		if not self.free and not self._evict():
+			if delta is not None:
+				self.uncached[key] = (value, delta)
+			return -1
+		slot = self.free.pop()
+		self.slots[key] = slot
+		self.keys[slot] = key
+		self.rows[slot] = value
+		self.deltas[slot] = 0 if delta is None else delta
+		self.dirty[slot] = delta is not None
+		self.used[slot] = True
+		self.pinned[slot] = True
+		self.freq[slot] = 1
+		self.last_used[slot] = self.steps
+		self.synced[slot] = self.flushes
+		return slot
+
+	def lookup(self, ids):
+		"""查询一个 batch 中去重后的 id
+		:return 是否命中, 取值(未命中的行为0)"""
+		with self.lock:
+			keys = ids.tolist()
+			get = self.slots.get
+			slots = np.array([get(key, -1) for key in keys], dtype=np.int64)
+			hit = slots >= 0
+			hit_slots = slots[hit]
+			values = np.zeros((len(keys), self.dim), dtype=np.float32)
+			values[hit] = self.rows[hit_slots]
+			self.freq[hit_slots] += 1
+			self.last_used[hit_slots] = self.steps
+			self.pinned[hit_slots] = True
+			# 待写回的行重新放入缓存, 写回时一起写出
+			if self.pending:
+				for i in np.flatnonzero(~hit).tolist():
+					row = self.pending.pop(keys[i], None)
+					if row is not None:
+						values[i] = row[0]
+						slots[i] = self._admit(keys[i], row[0], row[1])
+						hit[i] = True
+
+			self.step_slots = slots
+			self.step_misses = np.flatnonzero(~hit)
+			n_hit = int(hit.sum())
+			self.hits += n_hit
+			self.misses += len(keys) - n_hit
+			return hit, values
+
+	def insert(self, ids, values):
+		"""放入从 Redis 查询到的未命中的行, ids 为 lookup 中未命中的 id, 顺序不变"""
+		with self.lock:
+			keys = ids.tolist()
+			if len(keys) != len(self.step_misses):
+				raise ValueError('insert expects the %d ids missed by lookup, got %d' % (len(self.step_misses), len(keys)))
+			# 不放入缓存的行在本步更新后直接写回
+			seen, seen_before = self.seen, self.seen_before
+			through = []
+			for i, key in enumerate(keys):
+				if key in seen or key in seen_before:
+					slot = self._admit(key, values[i])
+					if slot >= 0:
+						self.step_slots[self.step_misses[i]] = slot
+						continue
+				else:
+					seen.add(key)
+				through.append(i)
+			self.step_through = self.step_misses[through]
+			self.step_through_values = values[through]
+			return np.int64(len(keys))
+
+	def apply_gradients(self, ids, grads):
+		"""以 SGD 更新本步查询过的行, 本步结束"""
+		with self.lock:
+			slots = self.step_slots
+			if len(slots) != len(ids):
+				raise ValueError('apply_gradients expects the %d ids of lookup, got %d' % (len(slots), len(ids)))
+			updates = -self.learning_rate * grads
+			cached = slots >= 0
+			cached_slots = slots[cached]
+			self.rows[cached_slots] += updates[cached]
+			self.deltas[cached_slots] += updates[cached]
+			self.dirty[cached_slots] = True
+			if len(self.step_through):
+				self.through_ids.append(ids[self.step_through])
+				self.through_values.append(self.step_through_values + updates[self.step_through])
+				cached[self.step_through] = True
+			# 其余不在缓存中的行是有未写回增量的行, 更新后进入待写回区
+			if not cached.all():
+				keys = ids.tolist()
+				for i in np.flatnonzero(~cached).tolist():
+					row = self.uncached.pop(keys[i], None)
+					if row is None:
+						row = self.pending.get(keys[i])
+					if row is not None:
+						self.pending[keys[i]] = (row[0] + updates[i], row[1] + updates[i])
+
+			self.uncached.clear()
+			self.pinned[cached_slots] = False
+			self.step_slots = EMPTY_SLOTS
+			self.step_misses = EMPTY_SLOTS
+			self.step_through = EMPTY_SLOTS
+			self.step_through_values = None
+			self.steps += 1
+			return np.int64(len(ids))
+
+	def drain(self, force=False):
+		"""取出需要写回 Redis 的行
+		每步取出本步直接写回的行; 每 flush_steps 步(或待写回的行过多、force 时)再取出所有有增量的行,
+		连续 max_stale_flushes 次写回都没有更新过的行移出缓存
+		:return ids, 增量, 取值(Redis 中还没有该 id 时直接写入取值)     需要与 Redis 中的当前值合并的行
+		:return through_ids, through_values                           直接写入的行"""
+		with self.lock:
+			if self.through_ids:
+				through_ids = np.concatenate(self.through_ids)
+				through_values = np.concatenate(self.through_values).astype(np.float32)
+			else:
+				through_ids, through_values = EMPTY_IDS, np.zeros((0, self.dim), dtype=np.float32)
+			self.through_ids = []
+			self.through_values = []
+			self.written += len(through_ids)
+			if not force and self.steps % self.flush_steps and len(self.pending) < self.max_pending:
+				empty = np.zeros((0, self.dim), dtype=np.float32)
+				return EMPTY_IDS, empty, empty, through_ids, through_values
+			slots = np.flatnonzero(self.dirty)
+			keys = self.keys[slots]
+			deltas = self.deltas[slots]
+			values = self.rows[slots]
+			self.deltas[slots] = 0
+			self.dirty[slots] = False
+			if self.pending:
+				keys = np.concatenate([keys, np.fromiter(self.pending.keys(), dtype=np.int64, count=len(self.pending))])
+				deltas = np.concatenate([deltas, np.stack([row[1] for row in self.pending.values()])])
+				values = np.concatenate([values, np.stack([row[0] for row in self.pending.values()])])
+				self.pending.clear()
+			self.flushes += 1
+			# 写回的行随后由 refresh 与 Redis 同步
+			self.synced[slots] = self.flushes
+			stale = np.flatnonzero(self.used & ~self.pinned & (self.flushes - self.synced >= self.max_stale_flushes))
+			if len(stale):
+				self._release(stale)
+			if self.policy == 'lfu':
+				self.freq >>= 1
+			self.seen_before, self.seen = self.seen, set()
+			self.written += len(keys)
+			return keys, deltas.astype(np.float32), values.astype(np.float32), through_ids, through_values
+
+	def refresh(self, ids, values):
+		"""写回之后放入与其他 worker 的更新合并后的取值"""
+		with self.lock:
+			get = self.slots.get
+			slots = np.array([get(key, -1) for key in ids.tolist()], dtype=np.int64)
+			cached = slots >= 0
+			slots = slots[cached]
+			self.rows[slots] = values[cached] + self.deltas[slots]
+			self.synced[slots] = self.flushes
+			return np.int64(len(ids))
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		return np.float32(self.hits / total if total else 0.0)
+
+	def stats(self):
+		return {
+			'size': len(self.slots),
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': float(self.hit_rate()),
+			'evictions': self.evictions,
+			'flushes': self.flushes,
+			'written': self.written,
+		}
+
+
+_caches = {}
+
+def get_cache(name, dim, **kwargs):
+	"""每个 embedding 表在 worker 进程内只有一个缓存, model_fn 多次构图时共用"""
+	cache = _caches.get(name)
+	if cache is None:
+		cache = EmbeddingCache(dim, **kwargs)
+		_caches[name] = cache
+	return cache
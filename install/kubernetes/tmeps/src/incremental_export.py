@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import common
+import os,sys
+import json
+import glob
+import time
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import traceback
+
+import numpy as np
+
+# model_path 下的目录, tf serving 只加载数字命名的版本目录, 不会读取这两个目录
+CHANGES_DIR = 'changes'
+DELTAS_DIR = 'deltas'
+
+def _write_npz(path, arrays):
+	# 先写临时文件再改名, 读取方不会读到写了一半的文件
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		np.savez(f, **arrays)
+	os.rename(tmp_path, path)
+
+def _read_npz(path):
+	with np.load(path) as data:
+		return dict((name, data[name]) for name in data.files)
+
+def _remove(files):
+	for file_name in files:
+		try:
+			os.remove(file_name)
+		except OSError:
+			pass
+
+
+class ChangeTracker(object):
+	"""
+	训练侧记录更新过的 embedding key
+		每步把写入过 embedding 表的 key 按表名记下, 每 flush_secs 秒去重后写出到 changes_dir 下的一个文件,
+		由 saver 增量导出时读取并删除
+	"""
+
+	def __init__(self, changes_dir, flush_secs=5):
+		self.changes_dir = changes_dir
+		self.flush_secs = flush_secs
+		self.name = '%s-%d' % (socket.gethostname(), os.getpid())
+		self.changed = {}                # 表名 -> [ids]
+		self.last_flush = time.time()
+		self.seq = 0
+		self.lock = threading.Lock()
+		if not os.path.exists(changes_dir):
+			os.makedirs(changes_dir, exist_ok=True)
+
+	def record(self, table, ids):
+		with self.lock:
+			if len(ids):
+				self.changed.setdefault(table, []).append(np.array(ids, dtype=np.int64))
+			if time.time() - self.last_flush >= self.flush_secs:
+				self._flush()
+			return np.int64(len(ids))
+
+	def flush(self):
+		with self.lock:
+			self._flush()
+
+	def _flush(self):
+		self.last_flush = time.time()
+		if not self.changed:
+			return
+		arrays = dict((table, np.unique(np.concatenate(ids))) for table, ids in self.changed.items())
+		self.changed = {}
+		self.seq += 1
+		# 文件名以时间开头, saver 按文件名排序即为写出顺序
+		_write_npz(os.path.join(self.changes_dir, '%d-%s-%d.npz' % (time.time() * 1e6, self.name, self.seq)), arrays)
+
+
+_trackers = {}
+
+def get_tracker(changes_dir, **kwargs):
+	"""worker 进程内共用一个 ChangeTracker"""
+	tracker = _trackers.get(changes_dir)
+	if tracker is None:
+		tracker = ChangeTracker(changes_dir, **kwargs)
+		_trackers[changes_dir] = tracker
+	return tracker
+
+
+class IncrementalExporter(object):
+	"""
+	saver 的增量导出
+		export_dir 下:
+			<version>/                    export_full_fn 导出的全量模型, 由 tf serving 加载
+			deltas/<version>/<seq>.npz    该全量模型之后的增量, 包含各表更新过的 key(<表名>.keys) 与取值(<表名>.values)
+			changes/                      训练侧 ChangeTracker 记录的更新过的 key
+		每 delta_secs 秒读取 changes/ 下的 key, 只查询并写出这些行; 每 full_secs 秒做一次全量导出,
+		全量导出之前记录的 key 已包含在全量模型中, 直接删除, 旧版本的增量随之删除
+	"""
+
+	def __init__(self, export_dir, export_full_fn, lookup_fn, delta_secs=10, full_secs=600):
+		self.export_dir = export_dir
+		self.changes_dir = os.path.join(export_dir, CHANGES_DIR)
+		self.deltas_dir = os.path.join(export_dir, DELTAS_DIR)
+		self.export_full_fn = export_full_fn    # 全量导出, 返回版本号
+		self.lookup_fn = lookup_fn              # lookup_fn(表名, ids) -> values
+		self.delta_secs = delta_secs
+		self.full_secs = full_secs
+		self.version = None
+		self.seq = 0
+		for path in (self.changes_dir, self.deltas_dir):
+			if not os.path.exists(path):
+				os.makedirs(path, exist_ok=True)
+
+	def _pending_changes(self):
+		return sorted(glob.glob(os.path.join(self.changes_dir, '*.npz')))
+
+	def export_full(self):
+		files = self._pending_changes()
+		version = str(self.export_full_fn())
+		_remove(files)
+		os.makedirs(os.path.join(self.deltas_dir, version), exist_ok=True)
+		for name in os.listdir(self.deltas_dir):
+			if name != version:
+				shutil.rmtree(os.path.join(self.deltas_dir, name), ignore_errors=True)
+		self.version = version
+		self.seq = 0
+		return version
+
+	def export_delta(self):
+		"""
+		:return 增量文件路径, 没有更新时为 None"""
+		files = self._pending_changes()
+		if not files:
+			return None
+		changed = {}
+		for file_name in files:
+			for table, ids in _read_npz(file_name).items():
+				changed.setdefault(table, []).append(ids)
+
+		arrays = {}
+		for table, ids in changed.items():
+			ids = np.unique(np.concatenate(ids))
+			arrays[table + '.keys'] = ids
+			arrays[table + '.values'] = np.asarray(self.lookup_fn(table, ids))
+		self.seq += 1
+		path = os.path.join(self.deltas_dir, self.version, '%08d.npz' % self.seq)
+		_write_npz(path, arrays)
+		_remove(files)
+		return path
+
+	def run(self):
+		start = time.time()
+		self.export_full()
+		logging.info("Full export {} cost {}s".format(self.version, time.time() - start))
+		last_full = time.time()
+		while True:
+			time.sleep(self.delta_secs)
+			start = time.time()
+			try:
+				if start - last_full >= self.full_secs:
+					self.export_full()
+					last_full = time.time()
+					logging.info("Full export {} cost {}s".format(self.version, last_full - start))
+				else:
+					path = self.export_delta()
+					if path:
+						logging.info("Delta export {} cost {}s".format(path, time.time() - start))
+			except Exception as e:
+				logging.error(traceback.format_exc())
+
+
+class DeltaApplier(object):
+	"""
+	serving 侧应用增量
+		找到 export_dir 下最新的全量版本, 按顺序应用其后的增量, apply_fn(表名, keys, values)。
+		出现新的全量版本后从它的第一个增量开始, upsert 可以重复应用
+	"""
+
+	def __init__(self, export_dir, apply_fn, poll_secs=2):
+		self.export_dir = export_dir
+		self.deltas_dir = os.path.join(export_dir, DELTAS_DIR)
+		self.apply_fn = apply_fn
+		self.poll_secs = poll_secs
+		self.version = None
+		self.applied = 0
+
+	def latest_version(self):
+		versions = [name for name in os.listdir(self.export_dir) if name.isdigit()]
+		return max(versions, key=int) if versions else None
+
+	def poll(self):
+		"""
+		:return 本次应用的增量数"""
+		version = self.latest_version()
+		if version is None:
+			return 0
+		if version != self.version:
+			self.version = version
+			self.applied = 0
+
+		n = 0
+		for path in sorted(glob.glob(os.path.join(self.deltas_dir, version, '*.npz'))):
+			seq = int(os.path.basename(path).split('.')[0])
+			if seq <= self.applied:
+				continue
+			try:
+				arrays = _read_npz(path)
+			except (IOError, OSError):
+				# 新的全量导出后旧的增量会被删除
+				break
+			for name in arrays:
+				if name.endswith('.keys'):
+					table = name[:-len('.keys')]
+					self.apply_fn(table, arrays[name], arrays[table + '.values'])
+			self.applied = seq
+			n += 1
+		return n
+
+	def run(self):
+		while True:
+			try:
+				n = self.poll()
+				if n:
+					logging.info("Applied {} deltas of version {}, up to {}".format(n, self.version, self.applied))
+			except Exception as e:
+				logging.error(traceback.format_exc())
+			time.sleep(self.poll_secs)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Apply the incremental exports of the saver to the serving embedding tables")
+	parser.add_argument("-e", "--export_dir", type=str, default=os.getenv('model_path', ''), help="export dir of the saver")
+	parser.add_argument("-p", "--ps_num", type=int, default=0, help="ps number of the training cluster, read from ps_cluster_config when 0")
+	parser.add_argument("-s", "--poll_secs", type=float, default=2, help="seconds between polls")
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	print(args)
+	ps_num = args.ps_num or len(json.loads(os.environ.get('ps_cluster_config') or '{}')['cluster']['ps'])
+
+	# serving 的 embedding 表由 model_tfra_redis_config_path 指定
+	from model_fn_builder import embedding_table_fns
+	lookup_fn, upsert_fn = embedding_table_fns({"ps_num": ps_num})
+	DeltaApplier(args.export_dir, upsert_fn, args.poll_secs).run()
@@ -2,7 +2,9 @@
 import common
 import sys,os
 import json
+import glob
 import time
+import logging
 import traceback
 import csv
 import random
@@ -22,13 +24,17 @@ def data_map_fn(x):
 			"user_rating": x["user_rating"]
 		}
 
-def input_fn():
+def input_fn(input_context=None):
 	data_path = os.getenv('data_path') + '/' 
-	dataset = tfds.load("movielens/100k-ratings", split="train", data_dir=data_path).repeat(1000000)
-	dataset = dataset.map(data_map_fn)
-	#dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
-	dataset = dataset.batch(10)
-	return dataset
+	dataset = tfds.load("movielens/100k-ratings", split="train", data_dir=data_path)
+	if input_context:
+		dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+	# 原始记录中有变长的 movie_genres 等字段, 不能直接batch, 先只保留用到的三个字段
+	dataset = dataset.map(lambda x: {"movie_id": x["movie_id"], "user_id": x["user_id"], "user_rating": x["user_rating"]})
+	# 先batch再map, data_map_fn 对整个batch做一次向量化的转换
+	dataset = dataset.repeat(1000000).batch(10)
+	dataset = dataset.map(data_map_fn, num_parallel_calls=tf.data.AUTOTUNE)
+	return dataset.prefetch(tf.data.AUTOTUNE)
 
 def data_gen_init():
 	data_path = os.getenv('data_path') + '/' 
@@ -57,20 +63,23 @@ class CdmqPollError(BaseException):
 	def __str__(self):
 		return self.msg
 
+CDMQ_CONFIGS = {
+	"bootstrap_servers": "cdmqszentry01.data.mig:10005,cdmqszentry02.data.mig:10069,cdmqszentry05.data.mig:10033,cdmqszentry06.data.mig:10021",
+	"client_id": "cg_VIDEOSAMPLE",
+	"group_id": "cg_VIDEOSAMPLE",
+	'enable_auto_commit': True,  # 是否自动提交消费进度，默认为true。
+	'auto_commit_interval_ms': 3000,  # 自动提交消费进度的间隔，默认为5000毫秒。
+	'auto_offset_reset': 'latest',  # 一个消费组在首次消费时，从哪个位置开始拉取消息，默认为latest（即最新的位置）。
+	'max_poll_records': 100,  # 单次拉取（poll）的最大消息条数，默认500条。
+	'fetch_max_bytes': 1048576,  # 单次拉取（poll）的最大消息大小，根据经验，这里设置100K~1M比较合适。
+	'max_partition_fetch_bytes': 524288,  # 单次拉取请求中，单个分区最大返回消息大小。一次拉取请求可能返回多个分区的数据，这里限定单个分区的最大数据大小。
+	'fetch_max_wait_ms': 100,  # 单次拉取请求最长等待时间，最长等待时间仅在没有最新数据时才会等待。此值应当设置较大点，减少空请求对服务端QPS的消耗。
+}
+CDMQ_TOPIC = "U_TOPIC_VIDEOSAMPLE"
+
 def cdmq_gen_init():
-	cdmq_configs = {
-		"bootstrap_servers": "cdmqszentry01.data.mig:10005,cdmqszentry02.data.mig:10069,cdmqszentry05.data.mig:10033,cdmqszentry06.data.mig:10021",
-		"client_id": "cg_VIDEOSAMPLE",
-		"group_id": "cg_VIDEOSAMPLE",
-		'enable_auto_commit': True,  # 是否自动提交消费进度，默认为true。
-		'auto_commit_interval_ms': 3000,  # 自动提交消费进度的间隔，默认为5000毫秒。
-		'auto_offset_reset': 'latest',  # 一个消费组在首次消费时，从哪个位置开始拉取消息，默认为latest（即最新的位置）。
-		'max_poll_records': 100,  # 单次拉取（poll）的最大消息条数，默认500条。
-		'fetch_max_bytes': 1048576,  # 单次拉取（poll）的最大消息大小，根据经验，这里设置100K~1M比较合适。
-		'max_partition_fetch_bytes': 524288,  # 单次拉取请求中，单个分区最大返回消息大小。一次拉取请求可能返回多个分区的数据，这里限定单个分区的最大数据大小。
-		'fetch_max_wait_ms': 100,  # 单次拉取请求最长等待时间，最长等待时间仅在没有最新数据时才会等待。此值应当设置较大点，减少空请求对服务端QPS的消耗。
-	}
-	cdmq_topic = "U_TOPIC_VIDEOSAMPLE"
+	cdmq_configs = CDMQ_CONFIGS
+	cdmq_topic = CDMQ_TOPIC
 
 	consumer = None
 	while not consumer:
@@ -127,6 +136,40 @@ def input_fn3():
 #	dataset = dataset.map(data_map_fn)
 	return dataset
 
+# 高吞吐的流式输入: 批量 poll cdmq, 多进程解码为按列的 numpy batch, 见 stream_ingest.StreamIngest
+#   stream_batch_size    每个batch的样本数
+#   stream_poll_records  单次 poll 的最大消息数
+#   stream_workers       解码进程数, 0 时在拉取线程中解码
+#   stream_max_pending   等待训练消费的batch数上限
+def cdmq_consumer():
+	config = dict(CDMQ_CONFIGS)
+	config['max_poll_records'] = int(os.getenv('stream_poll_records', 5000))
+	config['fetch_max_bytes'] = 16 * 1048576
+	config['max_partition_fetch_bytes'] = 4 * 1048576
+	return KafkaConsumer(CDMQ_TOPIC, **config)
+
+def input_fn6(input_context=None, consumer_fn=None):
+	from stream_ingest import StreamIngest
+
+	def stream_gen():
+		ingest = StreamIngest(consumer_fn or cdmq_consumer,
+							  batch_size=int(os.getenv('stream_batch_size', 1024)),
+							  max_poll_records=int(os.getenv('stream_poll_records', 5000)),
+							  workers=int(os.getenv('stream_workers', 4)),
+							  max_pending=int(os.getenv('stream_max_pending', 16)))
+		try:
+			for batch in ingest.batches():
+				yield batch
+		finally:
+			ingest.stop()
+
+	dataset = tf.data.Dataset.from_generator(generator = stream_gen,
+												 output_signature={
+													'movie_id':tf.TensorSpec(shape=(None,), dtype=tf.int64),
+													'user_id':tf.TensorSpec(shape=(None,), dtype=tf.int64),
+													'user_rating':tf.TensorSpec(shape=(None,), dtype=tf.float32)})
+	return dataset.prefetch(tf.data.AUTOTUNE)
+
 def inc_gen():
 	for i in range(10000000):
 		if i % 1000 == 0:
@@ -145,6 +188,91 @@ def input_fn4():
                                                     'user_rating':tf.TensorSpec(shape=(), dtype=tf.float32)}).batch(10000)
     return dataset
 
+# 高吞吐的输入方式: 读取分片的 TFRecord/Parquet 文件
+#   data_files  文件的glob, 如 /data/movielens/part-*.tfrecord 或 /data/movielens/*.parquet
+#   batch_size  每个batch的样本数
+FEATURE_SPEC = {
+	'movie_id': tf.io.FixedLenFeature([], tf.int64),
+	'user_id': tf.io.FixedLenFeature([], tf.int64),
+	'user_rating': tf.io.FixedLenFeature([], tf.float32),
+}
+
+def parse_batch_fn(serialized):
+	# 一次解析整个batch的 tf.train.Example
+	return tf.io.parse_example(serialized, FEATURE_SPEC)
+
+def parquet_batches(file_name, batch_size):
+	# 按 row group 读取 Parquet 的列, 每次产出一个batch的 numpy 数组, 而不是逐行产出
+	import pyarrow.parquet as pq
+	parquet_file = pq.ParquetFile(file_name.decode() if isinstance(file_name, bytes) else file_name)
+	for batch in parquet_file.iter_batches(batch_size=int(batch_size), columns=list(FEATURE_SPEC)):
+		yield {
+			'movie_id': batch.column('movie_id').to_numpy().astype('int64'),
+			'user_id': batch.column('user_id').to_numpy().astype('int64'),
+			'user_rating': batch.column('user_rating').to_numpy().astype('float32'),
+		}
+
+def parquet_dataset(file_name, batch_size):
+	return tf.data.Dataset.from_generator(parquet_batches, args=(file_name, batch_size),
+												 output_signature={
+													'movie_id':tf.TensorSpec(shape=(None,), dtype=tf.int64),
+													'user_id':tf.TensorSpec(shape=(None,), dtype=tf.int64),
+													'user_rating':tf.TensorSpec(shape=(None,), dtype=tf.float32)})
+
+def input_fn5(input_context=None, data_files=None, batch_size=None, repeat=True):
+	data_files = data_files or os.getenv('data_files')
+	batch_size = batch_size or int(os.getenv('batch_size', 1024))
+	if not data_files or not glob.glob(data_files):
+		raise RuntimeError("data_files not found")
+
+	# 分片之前文件顺序必须固定, 否则各worker的分片会重叠; 分片后再打乱本worker的文件, 每个epoch顺序不同
+	files = tf.data.Dataset.list_files(data_files, shuffle=False)
+	# 每个worker只读取自己的文件分片
+	if input_context:
+		files = files.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+	files = files.shuffle(len(glob.glob(data_files)), reshuffle_each_iteration=True)
+	if repeat:
+		files = files.repeat()
+
+	if data_files.endswith('.parquet'):
+		dataset = files.interleave(lambda file_name: parquet_dataset(file_name, batch_size),
+								   cycle_length=tf.data.AUTOTUNE,
+								   num_parallel_calls=tf.data.AUTOTUNE,
+								   deterministic=False)
+	else:
+		dataset = files.interleave(lambda file_name: tf.data.TFRecordDataset(file_name, buffer_size=8 * 1024 * 1024),
+								   cycle_length=tf.data.AUTOTUNE,
+								   num_parallel_calls=tf.data.AUTOTUNE,
+								   deterministic=False)
+		# 先batch再解析, 每个batch只调用一次 parse_example
+		dataset = dataset.batch(batch_size, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+		dataset = dataset.map(parse_batch_fn, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+	return dataset.prefetch(tf.data.AUTOTUNE)
+
+def write_tfrecords(dataset, output_dir, num_shards=16):
+	# 将 dict 形式的 dataset 写成 input_fn5 可以读取的 TFRecord 分片
+	if not os.path.exists(output_dir):
+		os.makedirs(output_dir)
+	writers = [tf.io.TFRecordWriter(os.path.join(output_dir, 'part-%05d.tfrecord' % i)) for i in range(num_shards)]
+	try:
+		for i, line in enumerate(dataset.as_numpy_iterator()):
+			example = tf.train.Example(features=tf.train.Features(feature={
+				'movie_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(line['movie_id'])])),
+				'user_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(line['user_id'])])),
+				'user_rating': tf.train.Feature(float_list=tf.train.FloatList(value=[float(line['user_rating'])])),
+			}))
+			writers[i % num_shards].write(example.SerializeToString())
+	finally:
+		for writer in writers:
+			writer.close()
+	return os.path.join(output_dir, 'part-*.tfrecord')
+
+def movielens_to_tfrecords(output_dir, num_shards=16):
+	# 将 movielens/100k-ratings 转换为 TFRecord 分片
+	data_path = os.getenv('data_path') + '/'
+	dataset = tfds.load("movielens/100k-ratings", split="train", data_dir=data_path).map(data_map_fn)
+	return write_tfrecords(dataset, output_dir, num_shards)
+
 if __name__ == '__main__':
 #	dataset = input_fn()
 #	tf.print(list(dataset.take(1)))
@@ -11,6 +11,7 @@ import logging
 
 from input_fn_builder import *
 from model_fn_builder import *
+from incremental_export import IncrementalExporter
 
 def redis_config_init():
     redis_config_file_path = os.getenv('model_tfra_redis_config_path')
@@ -128,6 +129,14 @@ def export_for_serving(checkpoint_path, model_fn, export_dir, ps_num):
 
     logging.info("Waiting 60s brfore start saving...")
     time.sleep(60)
+    # 增量导出: 每 incremental_export_delta_secs 秒只导出更新过的 embedding 行, 每 incremental_export_full_secs 秒全量导出
+    if os.getenv('incremental_export'):
+        def export_full_fn():
+            return os.path.basename(estimator.export_saved_model(export_dir, serving_input_receiver_dense_fn()).decode())
+        lookup_fn, upsert_fn = embedding_table_fns({"ps_num": ps_num})
+        IncrementalExporter(export_dir, export_full_fn, lookup_fn,
+                            delta_secs=float(os.getenv('incremental_export_delta_secs', 10)),
+                            full_secs=float(os.getenv('incremental_export_full_secs', 600))).run()
     while True:
         start = time.time()
         estimator.export_saved_model(export_dir, serving_input_receiver_dense_fn())
@@ -148,7 +157,14 @@ if __name__ == '__main__':
     role = tf_config["task"]["type"]
     if role != "saver":
         try:
-            train_and_evaluate(checkpoint_path, model_fn, input_fn4, ps_num)
+            # 配置了 data_files 时读取分片的 TFRecord/Parquet 文件, 配置了 stream_ingest 时批量消费 cdmq
+            if os.getenv('data_files'):
+                train_input_fn = input_fn5
+            elif os.getenv('stream_ingest'):
+                train_input_fn = input_fn6
+            else:
+                train_input_fn = input_fn4
+            train_and_evaluate(checkpoint_path, model_fn, train_input_fn, ps_num)
         except Exception as e:
             traceback.print_exc()
     else:
@@ -1,17 +1,109 @@
 # -*- coding: utf-8 -*-
 import common
 import sys,os
+import functools
 import numpy as np
 from tensorflow.keras.layers import Dense
 import tensorflow as tf
 import tensorflow_recommenders_addons as tfra
 
-def model_fn(features, labels, mode, params):
-	embedding_size = 36
-	movie_id = features["movie_id"]
-	user_id = features["user_id"]
-	rating = features["user_rating"]
+from embedding_cache import get_cache
+from incremental_export import get_tracker, CHANGES_DIR
+
+# worker 本地热点 embedding 缓存, 只在训练时使用, 见 embedding_cache.EmbeddingCache
+#   embedding_cache_capacity     每个 embedding 表缓存的行数, 0 时不使用缓存
+#   embedding_cache_policy       lru 或 lfu
+#   embedding_cache_lr           缓存中 embedding 的 SGD 学习率
+#   embedding_cache_flush_steps  每隔多少步把更新过的行写回 Redis
+#   embedding_cache_max_stale_flushes  连续多少次写回没有更新过的行移出缓存, 重新读取 Redis
+def embedding_cache_init(name, dim):
+	capacity = int(os.getenv('embedding_cache_capacity', 0))
+	if capacity <= 0:
+		return None
+	return get_cache(name, dim,
+					 capacity=capacity,
+					 policy=os.getenv('embedding_cache_policy', 'lru'),
+					 learning_rate=float(os.getenv('embedding_cache_lr', 0.01)),
+					 flush_steps=int(os.getenv('embedding_cache_flush_steps', 100)),
+					 max_stale_flushes=int(os.getenv('embedding_cache_max_stale_flushes', 10)))
+
+def cached_embedding_lookup(cache, embeddings, ids, name):
+	"""
+	经过本地缓存的 embedding 查询, ids 需已去重
+		只有未命中的 id 访问 Redis, 查询结果放入缓存。embedding 的梯度不经过 optimizer,
+		由一个取值恒为0的锚点变量的自定义梯度交给缓存在本地更新
+	"""
+	hit, cached = tf.numpy_function(cache.lookup, [ids], [tf.bool, tf.float32], name=name + "-cache-lookup")
+	hit.set_shape(ids.shape)
+	cached.set_shape([None, embeddings.dim])
+	miss = tf.logical_not(hit)
+	miss_ids = tf.boolean_mask(ids, miss)
+	miss_values = embeddings.lookup(miss_ids)
+	inserted = tf.numpy_function(cache.insert, [miss_ids, miss_values], tf.int64, name=name + "-cache-insert")
+	positions = tf.range(tf.size(ids))
+	with tf.control_dependencies([inserted]):
+		values = tf.dynamic_stitch([tf.boolean_mask(positions, hit), tf.boolean_mask(positions, miss)],
+								   [tf.boolean_mask(cached, hit), miss_values])
+
+	anchor = tf.compat.v1.get_variable(name + "-cache-anchor", shape=[], initializer=tf.zeros_initializer())
+
+	@tf.custom_gradient
+	def attach(anchor_value):
+		def grad(dy):
+			applied = tf.numpy_function(cache.apply_gradients, [ids, tf.convert_to_tensor(dy)], tf.int64, name=name + "-cache-apply")
+			with tf.control_dependencies([applied]):
+				return tf.zeros_like(anchor_value)
+		return values + 0.0 * anchor_value, grad
+
+	return attach(anchor)
+
+def cache_write_back(cache, embeddings, tracker=None, force=False):
+	# 缓存中需要写回的行的增量加到 Redis 中的当前值上, 与本步直接写回的行一起一次 upsert, 不覆盖其他 worker 的更新,
+	# Redis 中还没有的 id 直接写入缓存中的取值; 合并后的取值放回缓存。直接写回的行本步刚从 Redis 读过, 不再读取
+	ids, deltas, values, through_ids, through_values = tf.numpy_function(
+		functools.partial(cache.drain, force), [], [tf.int64, tf.float32, tf.float32, tf.int64, tf.float32])
+	ids.set_shape([None])
+	deltas.set_shape([None, embeddings.dim])
+	values.set_shape([None, embeddings.dim])
+	through_ids.set_shape([None])
+	through_values.set_shape([None, embeddings.dim])
+	current, exists = embeddings.lookup(ids, return_exists=True)
+	merged = tf.where(tf.expand_dims(exists, -1), current + deltas, values)
+	written_ids = tf.concat([ids, through_ids], 0)
+	upsert = embeddings.upsert(written_ids, tf.concat([merged, through_values], 0))
+	with tf.control_dependencies([upsert]):
+		refreshed = tf.numpy_function(cache.refresh, [ids, merged], tf.int64)
+	if tracker is None:
+		return refreshed
+	with tf.control_dependencies([refreshed]):
+		return record_changes(tracker, embeddings, written_ids)
+
+# 增量导出, 见 incremental_export.IncrementalExporter
+#   incremental_export               非空时训练侧记录更新过的 key, saver 增量导出
+#   incremental_export_flush_secs    训练侧每隔多少秒写出一次更新过的 key
+def change_tracker_init():
+	if not os.getenv('incremental_export'):
+		return None
+	return get_tracker(os.path.join(os.getenv('model_path'), CHANGES_DIR),
+					   flush_secs=float(os.getenv('incremental_export_flush_secs', 5)))
+
+def record_changes(tracker, embeddings, ids):
+	# 写入 Redis 之后再记录, saver 读到 key 时一定能查到新的取值
+	return tf.numpy_function(functools.partial(tracker.record, embeddings.name), [ids], tf.int64, name=embeddings.name + "-record-changes")
+
+class WriteBackHook(tf.estimator.SessionRunHook):
+	"""训练结束时把缓存中还没有写回的行写回 Redis, 并写出还没有写出的更新过的 key"""
+	def __init__(self, flush_op, tracker=None):
+		self.flush_op = flush_op
+		self.tracker = tracker
+
+	def end(self, session):
+		if self.flush_op is not None:
+			session.run(self.flush_op)
+		if self.tracker is not None:
+			self.tracker.flush()
 
+def embedding_variables(mode, params, embedding_size=36):
 	if mode == tf.estimator.ModeKeys.TRAIN:
 		lookup_node_list = [
 			"/job:ps/replica:0/task:{}/CPU:0".format(i)
@@ -37,21 +129,63 @@ def model_fn(features, labels, mode, params):
 		devices=lookup_node_list,
 		initializer=initializer,
 		kv_creator=redis_creator)
+	return user_embeddings, movie_embeddings
+
+def embedding_table_fns(params):
+	"""
+	在本地会话中读写 embedding 表, 供 saver 增量导出与 serving 应用增量
+	:return lookup_fn(表名, ids) -> values, upsert_fn(表名, ids, values)"""
+	graph = tf.Graph()
+	with graph.as_default():
+		variables = embedding_variables(tf.estimator.ModeKeys.PREDICT, params)
+		keys = tf.compat.v1.placeholder(tf.int64, [None])
+		values = tf.compat.v1.placeholder(tf.float32, [None, variables[0].dim])
+		lookups = dict((var.name, var.lookup(keys)) for var in variables)
+		upserts = dict((var.name, var.upsert(keys, values)) for var in variables)
+	session = tf.compat.v1.Session(graph=graph)
+
+	def lookup_fn(table, ids):
+		return session.run(lookups[table], {keys: ids})
+
+	def upsert_fn(table, ids, table_values):
+		session.run(upserts[table], {keys: ids, values: table_values})
+
+	return lookup_fn, upsert_fn
+
+def model_fn(features, labels, mode, params):
+	embedding_size = 36
+	movie_id = features["movie_id"]
+	user_id = features["user_id"]
+	rating = features["user_rating"]
+
+	user_embeddings, movie_embeddings = embedding_variables(mode, params, embedding_size)
+
+	user_cache = movie_cache = None
+	if mode == tf.estimator.ModeKeys.TRAIN:
+		user_cache = embedding_cache_init(user_embeddings.name, embedding_size)
+		movie_cache = embedding_cache_init(movie_embeddings.name, embedding_size)
+	caches = [(cache, var) for cache, var in ((user_cache, user_embeddings), (movie_cache, movie_embeddings)) if cache is not None]
 
 	user_id_val, user_id_idx = tf.unique(tf.concat(user_id, axis=0))
-	user_id_weights, user_id_trainable_wrapper = tfra.dynamic_embedding.embedding_lookup(
-		params=user_embeddings,
-		ids=user_id_val,
-		name="user-id-weights",
-		return_trainable=True)
+	if user_cache is not None:
+		user_id_weights = cached_embedding_lookup(user_cache, user_embeddings, user_id_val, "user-id-weights")
+	else:
+		user_id_weights, user_id_trainable_wrapper = tfra.dynamic_embedding.embedding_lookup(
+			params=user_embeddings,
+			ids=user_id_val,
+			name="user-id-weights",
+			return_trainable=True)
 	user_id_weights = tf.gather(user_id_weights, user_id_idx)
 
 	movie_id_val, movie_id_idx = tf.unique(tf.concat(movie_id, axis=0))
-	movie_id_weights, movie_id_trainable_wrapper = tfra.dynamic_embedding.embedding_lookup(
-		params=movie_embeddings,
-		ids=movie_id_val,
-		name="movie-id-weights",
-		return_trainable=True)
+	if movie_cache is not None:
+		movie_id_weights = cached_embedding_lookup(movie_cache, movie_embeddings, movie_id_val, "movie-id-weights")
+	else:
+		movie_id_weights, movie_id_trainable_wrapper = tfra.dynamic_embedding.embedding_lookup(
+			params=movie_embeddings,
+			ids=movie_id_val,
+			name="movie-id-weights",
+			return_trainable=True)
 	movie_id_weights = tf.gather(movie_id_weights, movie_id_idx)
 
 	embeddings = tf.concat([user_id_weights, movie_id_weights], axis=1)
@@ -80,6 +214,10 @@ def model_fn(features, labels, mode, params):
 	acc.update_state([0.1, 1.0], [1.0, 0.1])
 
 	tensors_to_log = {"user_id_val": user_id_val.name}
+	for cache, var in caches:
+		hit_rate = tf.numpy_function(cache.hit_rate, [], tf.float32, name=var.name + "-cache-hit-rate")
+		tf.compat.v1.summary.scalar(var.name + "_cache_hit_rate", hit_rate)
+		tensors_to_log[var.name + "_cache_hit_rate"] = hit_rate.name
 	hook = tf.estimator.LoggingTensorHook(tensors_to_log, every_n_iter=100)
 
 	if mode == tf.estimator.ModeKeys.EVAL:
@@ -93,11 +231,26 @@ def model_fn(features, labels, mode, params):
 		optimizer = tfra.dynamic_embedding.DynamicEmbeddingOptimizer(optimizer)
 		train_op = optimizer.minimize(
 			loss, global_step=tf.compat.v1.train.get_or_create_global_step())
+		training_hooks = [hook]
+		tracker = change_tracker_init()
+		updates = []
+		# 梯度更新进缓存(或 Redis)之后再写回、记录更新过的 key
+		with tf.control_dependencies([train_op]):
+			for cache, var, ids in ((user_cache, user_embeddings, user_id_val), (movie_cache, movie_embeddings, movie_id_val)):
+				if cache is not None:
+					updates.append(cache_write_back(cache, var, tracker))
+				elif tracker is not None:
+					updates.append(record_changes(tracker, var, ids))
+		if updates:
+			train_op = tf.group(updates)
+		if caches or tracker is not None:
+			flush_op = tf.group([cache_write_back(cache, var, tracker, force=True) for cache, var in caches]) if caches else None
+			training_hooks.append(WriteBackHook(flush_op, tracker))
 		return tf.estimator.EstimatorSpec(mode=mode,
 										  predictions=predictions,
 										  loss=loss,
 										  train_op=train_op,
-											training_hooks=[hook])
+											training_hooks=training_hooks)
 
 	if mode == tf.estimator.ModeKeys.PREDICT:
 		predictions_for_net = {"out": out}
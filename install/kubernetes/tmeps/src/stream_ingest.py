@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import common
+import time
+import queue
+import logging
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, Future
+
+import numpy as np
+from sample_pb2 import Sample
+
+# 训练特征 -> (Sample.csv 中的字段, 类型), 与 cdmq_gen_init 中的 mask 一致
+CSV_COLUMNS = {
+	'user_rating': ('qv_avg_pt_7d', np.float32),
+	'user_id': ('sex', np.int64),
+	'movie_id': ('age', np.int64),
+}
+
+def _to_numpy(values, dtype):
+	# 整列一次转换, 出现无法转换的值时逐个转换, 返回数组与是否有效
+	# 缺少的字段(None)与 nan/inf 都是无效值, 需在转为整数之前判断
+	valid = np.array([value is not None for value in values], dtype=bool)
+	try:
+		array = np.asarray(values if valid.all() else [value if value is not None else 'nan' for value in values], dtype=np.float64)
+	except ValueError:
+		array = np.full(len(values), np.nan)
+		for i, value in enumerate(values):
+			try:
+				array[i] = float(value)
+			except (TypeError, ValueError):
+				pass
+	valid &= np.isfinite(array)
+	array[~valid] = 0
+	return array.astype(dtype), valid
+
+def decode_samples(messages, columns=CSV_COLUMNS):
+	"""将一批 Sample 的序列化结果解码为按列存放的 numpy 数组
+	直接读取 csv 字段, 不经过 json_format.MessageToDict, 缺少字段或无法转换的样本被丢弃"""
+	raw = dict((name, []) for name in columns)
+	sample = Sample()
+	for message in messages:
+		sample.ParseFromString(message)
+		csv = sample.csv
+		for name, (key, _) in columns.items():
+			raw[name].append(csv.get(key))
+
+	batch = {}
+	valid = np.ones(len(messages), dtype=bool)
+	for name, (_, dtype) in columns.items():
+		batch[name], column_valid = _to_numpy(raw[name], dtype)
+		valid &= column_valid
+	if not valid.all():
+		batch = dict((name, array[valid]) for name, array in batch.items())
+	return batch
+
+def _done_future(result):
+	future = Future()
+	future.set_result(result)
+	return future
+
+
+class StreamIngest(object):
+	"""
+	Kafka 流式样本的批量读取
+		后台线程每次 poll 至多 max_poll_records 条消息, 按 batch_size 切分后交给进程池解码为按列存放的 numpy 数组,
+		解码任务按拉取顺序放入长度为 max_pending 的有界队列。训练消费较慢时队列被填满,
+		拉取线程阻塞在入队处, 不再继续 poll, 内存中最多只有 max_pending 个batch
+	"""
+
+	def __init__(self, consumer_fn, columns=CSV_COLUMNS, batch_size=256, max_poll_records=5000,
+				 workers=4, max_pending=16, poll_timeout_ms=200):
+		self.consumer_fn = consumer_fn        # 创建 consumer 的函数, consumer 需提供 poll(timeout_ms, max_records) 与 close()
+		self.columns = columns
+		self.batch_size = batch_size
+		self.max_poll_records = max_poll_records
+		self.workers = workers
+		self.poll_timeout_ms = poll_timeout_ms
+		self.pending = queue.Queue(maxsize=max_pending)
+		self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+		self.stopped = threading.Event()
+		self.thread = None
+		self.polled = 0
+
+	def _decode(self, messages):
+		if self.executor is None:
+			return _done_future(decode_samples(messages, self.columns))
+		return self.executor.submit(decode_samples, messages, self.columns)
+
+	def _put(self, item):
+		# 队列满时等待消费, 期间可以被 stop 打断
+		while not self.stopped.is_set():
+			try:
+				self.pending.put(item, timeout=0.5)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def _poll_loop(self):
+		consumer = None
+		try:
+			while consumer is None and not self.stopped.is_set():
+				try:
+					consumer = self.consumer_fn()
+				except Exception as e:
+					logging.error("create consumer failed: %s, retry..." % e)
+					time.sleep(1)
+
+			while not self.stopped.is_set():
+				try:
+					records = consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_poll_records)
+				except Exception as e:
+					logging.error(traceback.format_exc())
+					time.sleep(1)
+					continue
+				messages = [record.value for partition_records in records.values() for record in partition_records]
+				self.polled += len(messages)
+				for start in range(0, len(messages), self.batch_size):
+					if not self._put(self._decode(messages[start: start + self.batch_size])):
+						return
+		finally:
+			if consumer is not None:
+				consumer.close()
+			# 通知消费者结束, 已经 stop 时没有人再消费, 先清空队列
+			while True:
+				try:
+					self.pending.put(None, timeout=0.5)
+					break
+				except queue.Full:
+					if self.stopped.is_set():
+						self._cancel_pending()
+
+	def _cancel_pending(self):
+		# 取出队列中所有的解码任务, 还没有开始的直接取消
+		while True:
+			try:
+				future = self.pending.get_nowait()
+			except queue.Empty:
+				return
+			if future is not None:
+				future.cancel()
+
+	def start(self):
+		self.thread = threading.Thread(target=self._poll_loop, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self._cancel_pending()
+		if self.executor is not None:
+			self.executor.shutdown(wait=False)
+		if self.thread is not None:
+			self.pending.put_nowait(None)
+
+	def batches(self):
+		"""按拉取顺序产出解码后的batch, 每个batch为 {特征名: numpy数组}"""
+		if self.thread is None:
+			self.start()
+		while True:
+			future = self.pending.get()
+			if future is None:
+				return
+			try:
+				batch = future.result()
+			except Exception as e:
+				logging.error("decode samples failed: %s" % e)
+				continue
+			if len(next(iter(batch.values()))):
+				yield batch
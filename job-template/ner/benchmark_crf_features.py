@@ -0,0 +1,62 @@
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from models.CRF import word2features, extract_features
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark CRF feature extraction throughput against core count")
+    parser.add_argument("-n", "--n_sentences", type=int, default=100000, help="number of synthetic sentences")
+    parser.add_argument("-l", "--max_len", type=int, default=60, help="max sentence length")
+    parser.add_argument("-j", "--jobs", type=str, default="1,2,4,8", help="comma separated process counts")
+    parser.add_argument("-c", "--chunk_size", type=int, default=1000, help="sentences per task")
+    parser.add_argument("-s", "--seed", type=int, default=13, help="random seed")
+    return parser.parse_args()
+
+
+### 生成模拟语料，字从常用汉字区间中随机抽取
+def make_corpus(n_sentences, max_len, seed):
+    rng = np.random.RandomState(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    lengths = rng.randint(1, max_len + 1, size=n_sentences)
+    ids = rng.randint(0, len(chars), size=lengths.sum())
+    tokens = [chars[i] for i in ids]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return [tokens[offsets[i]: offsets[i + 1]] for i in range(n_sentences)]
+
+
+### 逐句消费特征（与 CRF.fit 相同的方式），统计耗时
+def consume(features):
+    start = time.perf_counter()
+    n_chars = 0
+    for sent_features in features:
+        n_chars += len(sent_features)
+    return time.perf_counter() - start, n_chars
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    sentences = make_corpus(args.n_sentences, args.max_len, args.seed)
+
+    # 原先逐字调用 word2features 的方式作为基准
+    elapsed, n_chars = consume([word2features(sent, i) for i in range(len(sent))] for sent in sentences)
+    baseline = elapsed
+    print("%-24s %8.3fs  %10.0f chars/s  speedup %5.2fx" % ("word2features per char", elapsed, n_chars / elapsed, 1.0))
+
+    for n_jobs in [int(j) for j in args.jobs.split(",")]:
+        elapsed, n_chars = consume(extract_features(sentences, n_jobs=n_jobs, chunk_size=args.chunk_size))
+        print("%-24s %8.3fs  %10.0f chars/s  speedup %5.2fx"
+              % ("n_jobs=%d" % n_jobs, elapsed, n_chars / elapsed, baseline / elapsed))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        n_jobs = max(int(j) for j in args.jobs.split(","))
+        for name in ["cache write", "cache read"]:
+            elapsed, n_chars = consume(extract_features(sentences, n_jobs=n_jobs, chunk_size=args.chunk_size, cache_dir=cache_dir))
+            print("%-24s %8.3fs  %10.0f chars/s  speedup %5.2fx" % (name, elapsed, n_chars / elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(cache_dir)
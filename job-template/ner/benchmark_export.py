@@ -0,0 +1,125 @@
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from config import BiLSTMCRFTrainConfig
+from bilstm_opration import BiLSTM_opration
+from bilstm_crf_opration import BiLSTM_CRF_opration
+from export import export_model, ExportedNER
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare eager and TorchScript latency of the NER models")
+    parser.add_argument('-pp', "--pklpath", type=str, default='', help='benchmark a model written by save_model instead of random BiLSTM / BiLSTM_CRF models')
+    parser.add_argument("-n", "--n_sentences", type=int, default=512, help="number of synthetic sentences")
+    parser.add_argument("-l", "--max_len", type=int, default=60, help="max sentence length")
+    parser.add_argument("-b", "--batch_sizes", type=str, default="1,8,64", help="comma separated batch sizes")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="repeat each measurement and keep the best")
+    parser.add_argument("-t", "--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the torch default")
+    parser.add_argument("-s", "--seed", type=int, default=13, help="random seed")
+    parser.add_argument("--bert", action='store_true', help="also export a BERT_BiLSTM_CRF model, needs transformers and the pretrained BERT")
+    return parser.parse_args()
+
+
+### 生成模拟语料，字从常用汉字区间中随机抽取，标签为 BIO
+def make_corpus(n_sentences, max_len, seed):
+    rng = np.random.RandomState(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    tags = ['O', 'B-PER', 'I-PER', 'B-LOC', 'I-LOC', 'B-ORG', 'I-ORG']
+    lengths = rng.randint(1, max_len + 1, size=n_sentences)
+    word_lists = [[chars[i] for i in rng.randint(0, len(chars), size=length)] for length in lengths]
+    tag_lists = [[tags[i] for i in rng.randint(0, len(tags), size=length)] for length in lengths]
+    return word_lists, tag_lists
+
+
+### 以随机初始化的参数构造 BiLSTM 与 BiLSTM_CRF
+def make_models(word_lists, tag_lists):
+    word2id = {word: id for id, word in enumerate(sorted(set(w for words in word_lists for w in words)))}
+    tag2id = {tag: id for id, tag in enumerate(sorted(set(t for tags in tag_lists for t in tags)))}
+    data = (word_lists, tag_lists)
+    models = {'BiLSTM': BiLSTM_opration(data, data, data, dict(word2id), dict(tag2id))}
+    for lean_crf in (False, True):
+        BiLSTMCRFTrainConfig.lean_crf = lean_crf
+        crf_data = ([words + ['<end>'] for words in word_lists], [tags + ['<end>'] for tags in tag_lists])
+        name = 'BiLSTM_CRF_Lean' if lean_crf else 'BiLSTM_CRF'
+        models[name] = BiLSTM_CRF_opration(crf_data, crf_data, crf_data, dict(word2id), dict(tag2id))
+    return models
+
+
+### BERT_BiLSTM_CRF, BiLSTM 与 CRF 的参数随机初始化
+def make_bert_model(word_lists, tag_lists):
+    from bert_bilstm_crf_opration import BiLSTM_opration as BERT_BiLSTM_opration
+    tag2id = {tag: id for id, tag in enumerate(sorted(set(t for tags in tag_lists for t in tags)))}
+    data = (word_lists, tag_lists)
+    return BERT_BiLSTM_opration(data, data, data, {}, tag2id)
+
+
+### 逐 batch 调用 predict_batch，返回最好的一次耗时
+def measure(model, sentences, batch_size, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(0, len(sentences), batch_size):
+            model.predict_batch(sentences[i: i + batch_size], batch_size=batch_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def eager_tags(model, sentences):
+    tag_lists = model.predict_batch(sentences, batch_size=64)
+    # BERT 模型对 id2tag 中不存在的 id 返回 None, 导出的模型统一按 'O' 处理
+    return [[tag if tag is not None else 'O' for tag in tags] for tags in tag_lists]
+
+
+### 分别以单句和长度不同的整个 batch 对比 eager 与导出模型, 返回结果不一致的长度
+def check_lengths(model, exported, word_lists, lengths):
+    chars = ''.join(''.join(words) for words in word_lists)
+    sentences = [chars[:length] for length in lengths]
+    differs = [len(sentence) for sentence in sentences
+               if eager_tags(model, [sentence]) != exported.predict_batch([sentence], batch_size=1)]
+    if eager_tags(model, sentences) != exported.predict_batch(sentences, batch_size=len(sentences)):
+        differs.append('batch')
+    return differs
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    word_lists, tag_lists = make_corpus(args.n_sentences, args.max_len, args.seed)
+    sentences = [''.join(words) for words in word_lists]
+
+    if args.pklpath:
+        with open(args.pklpath, 'rb') as f:
+            models = {os.path.basename(args.pklpath): pickle.load(f)}
+    else:
+        models = make_models(word_lists, tag_lists)
+        if args.bert:
+            models['BERT_BiLSTM_CRF'] = make_bert_model(word_lists, tag_lists)
+
+    export_dir = tempfile.mkdtemp()
+    try:
+        for name, model in models.items():
+            file_name = os.path.join(export_dir, name + '.pt')
+            export_model(model, file_name)
+            exported = ExportedNER(file_name)
+            same = eager_tags(model, sentences) == exported.predict_batch(sentences, batch_size=64)
+            print("%s  exported to %.1f MB, same predictions as eager: %s"
+                  % (name, os.path.getsize(file_name) / 2 ** 20, same))
+            differs = check_lengths(model, exported, word_lists, [1, 2, 5, 17, args.max_len, 3 * args.max_len])
+            print("  lengths differing from eager: %s" % (differs or 'none'))
+
+            for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+                eager = measure(model, sentences, batch_size, args.repeat)
+                scripted = measure(exported, sentences, batch_size, args.repeat)
+                print("  batch_size=%-4d eager %8.2f ms/sentence  torchscript %8.2f ms/sentence  speedup %5.2fx"
+                      % (batch_size, eager * 1000 / len(sentences), scripted * 1000 / len(sentences), eager / scripted))
+    finally:
+        shutil.rmtree(export_dir)
@@ -1,21 +1,52 @@
 import os
+import tempfile
+import numpy as np
 import torch
 from tqdm import tqdm
 from transformers import BertTokenizer
 
-from config import BiLSTMCRFTrainConfig, BiLSTMConfig
+from config import BiLSTMCRFTrainConfig, BiLSTMConfig, BertTrainConfig
 from models.BERT_BiLSTM_CRF import BiLSTM_CRF
 from utils.utils import expand_vocabulary
+from utils.dataset import WordTagDataset, build_dataloader, pack_sequences
 from evaluating import Metrics
 from data import token_to_str
 
-# torch.cuda.set_device(3, 4)
-
-
-os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-os.environ["CUDA_VISIBLE_DEVICES"] = "4,7"
-device_ids = [0, 1]
-
+class FrozenOutputCache:
+    """BERT 冻结层输出的缓存
+    每个样本的输出按 dataset.word_offsets 连续存放在 float16 的 memmap 文件中,
+    第一次遇到时计算并写入, 之后的 epoch 直接读取, 内存占用由操作系统页缓存控制"""
+
+    def __init__(self, offsets, hidden_size, cache_dir=None):
+        self.offsets = offsets
+        fd, self.path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+        os.close(fd)
+        self.values = np.lib.format.open_memmap(
+            self.path, mode='w+', dtype=np.float16, shape=(int(offsets[-1]), hidden_size)
+        )
+        self.filled = np.zeros(len(offsets) - 1, dtype=bool)
+
+    def lookup(self, indices, max_len):
+        """batch 中的样本都已缓存时返回 [B, max_len, hidden_size], 否则返回 None"""
+        indices = indices.tolist()
+        if not self.filled[indices].all():
+            return None
+        hidden = np.zeros((len(indices), max_len, self.values.shape[1]), dtype=np.float32)
+        for row, i in enumerate(indices):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            hidden[row, :end - start] = self.values[start: end]
+        return torch.from_numpy(hidden)
+
+    def store(self, indices, hidden, lengths):
+        hidden = hidden.float().cpu().numpy()
+        for row, i in enumerate(indices.tolist()):
+            start, length = self.offsets[i], int(lengths[row])
+            self.values[start: start + length] = hidden[row, :length]
+            self.filled[i] = True
+
+    def close(self):
+        del self.values
+        os.remove(self.path)
 
 
 class BiLSTM_opration:
@@ -31,100 +62,85 @@ class BiLSTM_opration:
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         # self.device = torch.device('cuda')
 
-        model = BiLSTM_CRF(
+        self.net = BiLSTM_CRF(
                 vocab_size=len(self.word2id),
                 tagset_size=len(self.tag2id),
                 config=BiLSTMConfig,
                 tag2id=tag2id
         )
-        self.model = torch.nn.DataParallel(
-            module=model,
-            device_ids=device_ids
-        )
+        if BertTrainConfig.freeze_layers > 0:
+            self.net.freeze_bert_layers(BertTrainConfig.freeze_layers)
+        # 多张卡时才使用 DataParallel, 可见设备由 CUDA_VISIBLE_DEVICES 环境变量控制
+        if torch.cuda.device_count() > 1:
+            self.model = torch.nn.DataParallel(module=self.net)
+        else:
+            self.model = self.net
         self.model.to(self.device)
-        self.optimizer = torch.nn.DataParallel(
-            torch.optim.Adam(params=self.model.parameters(), lr=BiLSTMCRFTrainConfig.lr),
-            device_ids=device_ids
+        self.optimizer = torch.optim.Adam(
+            params=[param for param in self.net.parameters() if param.requires_grad],
+            lr=BiLSTMCRFTrainConfig.lr
         )
-        # self.optimizer = torch.optim.Adam(params=self.model.parameters(), lr=BiLSTMCRFTrainConfig.lr)
-
-
-
-    def _sort_by_sentence_lengths(self, word_lists, tag_lists):
-        """将 word_lists和tag_lists 根据sentence序列的长度
-        降序排序, 此举可以有效保证每个batch中的sentence序列
-        长度相近, 减少< pad> 占位符的用量
-        """
-        pairs = list(zip(word_lists, tag_lists))
-        indices = sorted(range(len(pairs)), key=lambda x:len(pairs[x][0]), reverse=True)
-        
-        pairs = [pairs[i] for i in indices]
-        word_lists, tag_lists = list(zip(*pairs))
-
-        return word_lists, tag_lists
-
-    def _tokenizer(self, word_lists, tag_lists=None):
-        """将 word和tag 转换为 词表(word2id)和标签表(tag2id)中对应的id
-        :params word_lists    文本（以单个汉字为单位）序列    类型: python.List
-        :params tag_lists     标签序列                      类型: python.List
-        :return wordID_lists  文本id序列                    类型: pytorch.LongTensor
-        :return tagID_lists   标签id序列                    类型: pytorch.LongTensor
-        """
-
-        if tag_lists is None:
-            # 用于 predict函数
-            assert len(word_lists == 1)
-            # sentence = word_lists[0]
-            # wordID_lists = torch.LongTensor(size=(1, len(sentence))).to(self.device)
-            # for i, word in enumerate(sentence):
-            #     wordID_lists[0][i] = self.word2id.get(word, self.word2id['<unk>'])
-            # return wordID_lists
-
-            sentence = token_to_str(word_lists)[0]
-
-            token = self.tokenizer(
-                text=sentence,
-                padding='max_length',
-                max_length=max_len+2,
-                return_tensors='pt'
-            )['input_ids'].to(self.device)
-            return token
-
-
-        else:
-            # 用于 train、validate、evaluate函数
-
-            max_len = len(word_lists[0])
-            # print('max_len:', max_len)
-            
-            sentences = token_to_str(word_lists)
-            # print(sentences)
-            token = self.tokenizer(
-                text=sentences,
-                padding='max_length',
-                max_length=max_len+2 if (max_len+2) < 512 else 512,
-                truncation=True,
-                return_tensors='pt'
-            )['input_ids'].to(self.device)
-            # print(token.device)
-
 
-            if len(tag_lists[0]) > 512: seq_len = 512
-            else: seq_len = len(tag_lists[0])
-
-            tagID_lists = (torch.ones(size=(len(tag_lists), seq_len), dtype=torch.long) * self.tag2id['<pad>']).to(self.device)
-            for i in range(len(tag_lists)):
-
-                if len(tag_lists[i]) > 512: seq_len = 512
-                else: seq_len = len(tag_lists[i])
+        # 语料只在此处编码一次, 训练时由 DataLoader 按长度分桶并动态填补
+        self.train_dataset = self._encode(self.train_word_lists, self.train_tag_lists)
+        self.dev_dataset = self._encode(self.dev_word_lists, self.dev_tag_lists)
+
+    def _encode(self, word_lists, tag_lists, max_length=512):
+        """使用 BertTokenizer 一次性编码整个语料, 打包为 WordTagDataset
+        token 序列包含 [CLS]/[SEP], 与 expand_4_bert 后的标签序列对齐"""
+        token_ids = self.tokenizer(
+            text=token_to_str(word_lists),
+            truncation=True,
+            max_length=max_length
+        )['input_ids']
+        word_ids, word_offsets = pack_sequences(token_ids)
+        tag_ids, tag_offsets = pack_sequences(
+            [[self.tag2id[tag] for tag in tag_list[:max_length]] for tag_list in tag_lists]
+        )
+        dataset = WordTagDataset.from_packed(word_ids, word_offsets, tag_ids, tag_offsets)
+        # 返回样本下标, 用于查找冻结层输出缓存
+        dataset.return_index = True
+        return dataset
+
+    def _frozen_cache(self, dataset):
+        """冻结了 BERT 前若干层且开启缓存时, 为数据集创建冻结层输出缓存"""
+        if BertTrainConfig.freeze_layers <= 0 or not BertTrainConfig.cache_frozen:
+            return None
+        return FrozenOutputCache(
+            dataset.word_offsets,
+            self.net.word_embeds.config.hidden_size,
+            cache_dir=BertTrainConfig.cache_dir
+        )
 
-                for j in range(seq_len):
-                    # wordID_lists[i][j] = self.word2id.get(word_lists[i][j], self.word2id['<unk>'])      # 遇到词表中不存在的字符，使用<unk>代替
-                    tagID_lists[i][j] = self.tag2id[tag_lists[i][j]]
-                # wordID_lists[i][-1] = self.word2id.get(word_lists[i][-1], self.word2id['<unk>'])
-            # print(tagID_lists.device)
+    def _batch_loss(self, sentences, targets, lengths, indices, cache=None):
+        """一个batch的前向计算与损失
+        前向在 bf16 autocast 下进行(BertTrainConfig.bf16), CRF 损失在 fp32 下计算"""
+        sentences = sentences.to(self.device, non_blocking=True)
+        targets = targets.to(self.device, non_blocking=True)
+        attention_mask = (torch.arange(sentences.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)).long().to(self.device)
+
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=BertTrainConfig.bf16):
+            frozen_hidden = None
+            if cache is not None:
+                frozen_hidden = cache.lookup(indices, sentences.shape[1])
+                if frozen_hidden is None:
+                    frozen_hidden = self.net.frozen_features(sentences, attention_mask)
+                    cache.store(indices, frozen_hidden, lengths)
+                frozen_hidden = frozen_hidden.to(self.device, non_blocking=True)
+            prediction = self.model(sentences, attention_mask=attention_mask, frozen_hidden=frozen_hidden)
+
+        return self.net.neg_log_likelihood(prediction.float(), targets)
+
+    def _dataloader(self, dataset, batch_size, shuffle):
+        return build_dataloader(
+            dataset,
+            batch_size=batch_size,
+            word_pad_id=self.tokenizer.pad_token_id,
+            tag_pad_id=self.tag2id['<pad>'],
+            shuffle=shuffle,
+            num_workers=BiLSTMCRFTrainConfig.num_workers
+        )
 
-            return token, tagID_lists
 
     def _predtion_to_tags(self, prediction):
         """将模型给出的预测结果转化为标签序列"""
@@ -137,121 +153,126 @@ class BiLSTM_opration:
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        # 根据sentence的长度 重排train_data
+        # 按sentence的长度分桶组成batch
         # 此举可以减少同一个batch中的每个sentence之间
         # 的长度差距，这意味只需添加最少数量的 <pad>
-        train_word_lists, train_tag_lists = self._sort_by_sentence_lengths(self.train_word_lists, self.train_tag_lists)
-
         epochs = BiLSTMCRFTrainConfig.epochs
         batch_size = BiLSTMCRFTrainConfig.batch_size
-        iteration_size = round(len(train_word_lists) / batch_size + 0.49)
-
-        for epoch in range(epochs):
-        # for epoch in range(5):
-            losses = 0.
-            with tqdm(total=iteration_size, desc='Epoch %d/%d Training' %(epoch, epochs)) as pbar:
-                # one batch
-                for step in range(iteration_size):
-                    # batch data
-                    batch_sentences, batch_targets = self._tokenizer(
-                        train_word_lists[batch_size * step: min(batch_size * (step+1), len(train_word_lists))],
-                        train_tag_lists[batch_size * step: min(batch_size * (step+1), len(train_tag_lists))]
-                    )
-                #     # forword
-                    self.model.train()
-                    self.model.zero_grad()
-                    # prediction = self.model.module.forward(batch_sentences)
-                    prediction = self.model(batch_sentences)
-
-                    # loss
-                    loss = self.model.module.neg_log_likelihood(prediction, batch_targets).to(self.device)
-                    loss.backward()
-                    self.optimizer.module.step()
-                    losses += loss.item()
-                    
-                    if step % 2 == 0 and step != 0: pbar.set_postfix(ave_loss=losses/(step+1))
-                    pbar.update(1)
-
-                # 每个epoch结束后，使用验证集测试
-                val_loss = self.validate(batch_size)
-                pbar.set_postfix(ave_loss='{0:.3f}'.format(losses/iteration_size), val_loss='{0:.3f}'.format(val_loss))
-            
-
-    def validate(self, batch_size):
+        # 梯度累积, 每 accumulation_steps 个batch更新一次参数
+        accumulation_steps = max(BertTrainConfig.accumulation_steps, 1)
+        train_loader = self._dataloader(self.train_dataset, batch_size, shuffle=True)
+        dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
+        iteration_size = len(train_loader)
+        train_cache = self._frozen_cache(self.train_dataset)
+        dev_cache = self._frozen_cache(self.dev_dataset)
+
+        try:
+            for epoch in range(epochs):
+                losses = 0.
+                self.optimizer.zero_grad()
+                with tqdm(total=iteration_size, desc='Epoch %d/%d Training' %(epoch, epochs)) as pbar:
+                    # one batch
+                    for step, (batch_sentences, batch_targets, lengths, indices) in enumerate(train_loader):
+                        # forword
+                        self.model.train()
+                        loss = self._batch_loss(batch_sentences, batch_targets, lengths, indices, train_cache)
+                        # 最后一组不足 accumulation_steps 个batch时按实际个数求平均
+                        group_size = min(accumulation_steps, iteration_size - step // accumulation_steps * accumulation_steps)
+                        (loss / group_size).backward()
+                        if (step + 1) % accumulation_steps == 0 or step + 1 == iteration_size:
+                            self.optimizer.step()
+                            self.optimizer.zero_grad()
+                        losses += loss.item()
+
+                        if step % 2 == 0 and step != 0: pbar.set_postfix(ave_loss=losses/(step+1))
+                        pbar.update(1)
+
+                    # 每个epoch结束后，使用验证集测试
+                    val_loss = self.validate(batch_size, dev_loader, dev_cache)
+                    pbar.set_postfix(ave_loss='{0:.3f}'.format(losses/iteration_size), val_loss='{0:.3f}'.format(val_loss))
+        finally:
+            for cache in (train_cache, dev_cache):
+                if cache is not None:
+                    cache.close()
+
+
+    def validate(self, batch_size, dev_loader=None, dev_cache=None):
         """验证
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        dev_word_lists, dev_tag_lists = self._sort_by_sentence_lengths(self.dev_word_lists, self.dev_tag_lists)
-
-        # print(dev_word_lists)
+        if dev_loader is None:
+            dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
 
         self.model.eval()
         with torch.no_grad():
             val_losses = 0
-            iteration_size = round(len(self.dev_word_lists) / batch_size + 0.5)
-            for step in range(iteration_size):
-                # validate batch data
-
-                val_sentences, val_targets = self._tokenizer(
-                    dev_word_lists[batch_size * step: min(batch_size * (step+1), len(dev_word_lists))],
-                    dev_tag_lists[batch_size * step: min(batch_size * (step+1), len(dev_tag_lists))]
-                )
-                # forward
-                # prediction = self.model.module.forward(val_sentences)
-                prediction = self.model(val_sentences)
-                # loss
-                loss = self.model.module.neg_log_likelihood(prediction, val_targets).to(self.device)
+            iteration_size = len(dev_loader)
+            for val_sentences, val_targets, lengths, indices in dev_loader:
+                # forward & loss
+                loss = self._batch_loss(val_sentences, val_targets, lengths, indices, dev_cache)
                 val_losses += loss.item()
             val_losses = val_losses / iteration_size
 
             return val_losses
 
-    def evaluate(self, file_path: str):
+    def evaluate(self, file_path: str, batch_size=None):
         """评估
-        一个batch只有一条序列, 无需<pad>"""
+        按序列长度分桶, 以batch的形式前向计算并解码"""
+        batch_size = batch_size or BiLSTMCRFTrainConfig.batch_size
+        # 每次解码若干个batch, 结果直接累加进混淆矩阵, 不保留全部预测结果
+        chunk_size = batch_size * 64
+        metrics = Metrics(file_path)
+        for start in range(0, len(self.test_word_lists), chunk_size):
+            # 测试集的标签序列两端为 <cls>/<seq>, 与包含 [CLS]/[SEP] 位置的路径对齐
+            best_paths = self._batch_decoding(self.test_word_lists[start: start + chunk_size], batch_size, keep_special=True)
+            metrics.update(
+                self.test_tag_lists[start: start + chunk_size],
+                [self._predtion_to_tags(best_path) for best_path in best_paths]
+            )
+
+        # 计算评估值
+        metrics.report_scores(dtype='BiLSTM-CRF')
+
+    def _batch_decoding(self, word_lists, batch_size, keep_special=False):
+        """按序列长度分桶, 以 batch 形式前向计算并解码
+        返回与 word_lists 顺序一致的 tag id 序列, keep_special 为 False 时不含 [CLS]/[SEP] 位置"""
+        indices = sorted(range(len(word_lists)), key=lambda x: len(word_lists[x]), reverse=True)
+        best_paths = [None] * len(word_lists)
+
         self.model.eval()
         with torch.no_grad():
-            pred_tag_lists = []
-            for i, (word_list, tag_list) in enumerate(zip(self.test_word_lists, self.test_tag_lists)):
-                # test data
-                wordID_list, tagID_list = self._tokenizer([word_list], [tag_list])
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start: start + batch_size]
+                token = self.tokenizer(
+                    text=token_to_str([word_lists[i] for i in batch_indices]),
+                    padding=True,
+                    truncation=True,
+                    max_length=512,
+                    return_tensors='pt'
+                ).to(self.device)
+                lengths = token['attention_mask'].sum(dim=1)
                 # forward
-                prediction = self.model.forward(wordID_list)
-                # loss
-                # loss = cal_bilstm_crf_loss(prediction, tagID_list, self.tag2id)
-                
-                # if i % 100 == 0: print(f'{i}/{len(self.test_word_lists)} : loss={loss}')
-
-                # print(prediction.shape)
-
-                # best_path = self.model.test(prediction, [prediction.shape[1]], self.tag2id)
-                best_path = self.model.module.vibiter_decoding(prediction[0])
-                pred_tag_lists.append(
-                    self._predtion_to_tags(
-                        best_path
-                    )
-                )
-
-                
-                print(word_list)
-                print(tag_list)
-                print(self._predtion_to_tags(
-                        best_path
-                    ))
-
-            # 计算评估值
-            metrics = Metrics(file_path, self.test_tag_lists, pred_tag_lists)
-            metrics.report_scores(dtype='BiLSTM-CRF')
+                crf_scores = self.model(token['input_ids'], attention_mask=token['attention_mask'])
+                # decoding
+                batch_paths = self.net.batch_viterbi_decoding(crf_scores, lengths).tolist()
+                for row, i in enumerate(batch_indices):
+                    best_paths[i] = batch_paths[row][:lengths[row]] if keep_special else batch_paths[row][1:lengths[row] - 1]
+        return best_paths
+
+    def predict_batch(self, sentences, batch_size=None):
+        """批量预测
+        : params sentences 文本列表, 按长度分桶后以batch的形式解码"""
+        batch_size = batch_size or BiLSTMCRFTrainConfig.batch_size
+        best_paths = self._batch_decoding([list(sentence) for sentence in sentences], batch_size)
+        return [self._predtion_to_tags(best_path) for best_path in best_paths]
 
     def predict(self, sentence):
         """预测
         : params sentence 单个文本"""
-        sentence_token = self._tokenizer([sentence])
-        torch.no_grad()
-        prediction = self.model.forward(sentence_token)
-        pred_tags = self._predtion_to_tags(prediction)
-        return pred_tags, prediction
+        best_path = self._batch_decoding([list(sentence)], batch_size=1)[0]
+        pred_tags = self._predtion_to_tags(best_path)
+        return pred_tags, best_path
 
 
 
@@ -271,6 +292,10 @@ if __name__ == '__main__':
     dev_tag_lists = expand_4_bert(dev_tag_lists)
     test_tag_lists = expand_4_bert(test_tag_lists)
 
+    # 没有 GPU 时使用 bf16 + 梯度累积 + 冻结 BERT 前若干层的高效训练模式
+    if not torch.cuda.is_available():
+        BertTrainConfig.cpu_efficient()
+
 
     # print(test_word_lists)
 
@@ -2,8 +2,9 @@ import torch
 from tqdm import tqdm
 
 from config import BiLSTMCRFTrainConfig, BiLSTMConfig
-from models.BiLSTM_CRF import BiLSTM_CRF
+from models.BiLSTM_CRF import BiLSTM_CRF, BiLSTM_CRF_Lean
 from utils.utils import expand_vocabulary
+from utils.dataset import WordTagDataset, build_dataloader, tokenize_words
 from evaluating import Metrics
 
 
@@ -24,7 +25,9 @@ class BiLSTM_CRF_opration:
         self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
         # self.device = 'cpu'
 
-        self.model = BiLSTM_CRF(
+        # lean_crf 时不展开 [B, L, T, T] 的 crf_scores, 训练与解码结果不变
+        model_cls = BiLSTM_CRF_Lean if BiLSTMCRFTrainConfig.lean_crf else BiLSTM_CRF
+        self.model = model_cls(
             vocab_size=len(self.word2id),
             tagset_size=len(self.tag2id),
             config=BiLSTMConfig,
@@ -32,46 +35,39 @@ class BiLSTM_CRF_opration:
         ).to(self.device)
         self.optimizer = torch.optim.Adam(params=self.model.parameters(), lr=BiLSTMCRFTrainConfig.lr)
 
+        # 语料只在此处编码一次, 训练时由 DataLoader 按长度分桶并动态填补
+        self.train_dataset = WordTagDataset(self.train_word_lists, self.train_tag_lists, self.word2id, self.tag2id)
+        self.dev_dataset = WordTagDataset(self.dev_word_lists, self.dev_tag_lists, self.word2id, self.tag2id)
+
+    def _dataloader(self, dataset, batch_size, shuffle):
+        return build_dataloader(
+            dataset,
+            batch_size=batch_size,
+            word_pad_id=self.word2id['<pad>'],
+            tag_pad_id=self.tag2id['<pad>'],
+            shuffle=shuffle,
+            num_workers=BiLSTMCRFTrainConfig.num_workers
+        )
+
+    def _batch_decoding(self, word_lists, batch_size):
+        """按序列长度分桶, 以 batch 形式前向计算并解码
+        每条序列须以<end>结尾, 返回与 word_lists 顺序一致的 tag id 序列(不含<end>)"""
+        indices = sorted(range(len(word_lists)), key=lambda x: len(word_lists[x]), reverse=True)
+        best_paths = [None] * len(word_lists)
 
-    def _sort_by_sentence_lengths(self, word_lists, tag_lists):
-        """将 word_lists和tag_lists 根据sentence序列的长度
-        降序排序, 此举可以有效保证每个batch中的sentence序列
-        长度相近, 减少< pad> 占位符的用量
-        """
-        pairs = list(zip(word_lists, tag_lists))
-        indices = sorted(range(len(pairs)), key=lambda x:len(pairs[x][0]), reverse=True)
-        
-        pairs = [pairs[i] for i in indices]
-        word_lists, tag_lists = list(zip(*pairs))
-
-        return word_lists, tag_lists
-
-    def _tokenizer(self, word_lists, tag_lists=None):
-        """将 word和tag 转换为 词表(word2id)和标签表(tag2id)中对应的id
-        :params word_lists    文本（以单个汉字为单位）序列    类型: python.List
-        :params tag_lists     标签序列                      类型: python.List
-        :return wordID_lists  文本id序列                    类型: pytorch.LongTensor
-        :return tagID_lists   标签id序列                    类型: pytorch.LongTensor
-        """
-        if tag_lists is None:
-            # 用于 predict函数
-            assert len(word_lists == 1)
-            sentence = word_lists[0]
-            wordID_lists = torch.LongTensor(size=(1, len(sentence))).to(self.device)
-            for i, word in enumerate(sentence):
-                wordID_lists[0][i] = self.word2id.get(word, self.word2id['<unk>'])
-            return wordID_lists
-        else:
-            # 用于 train、validate、evaluate函数
-            # print(word_lists)
-            wordID_lists = (torch.ones(size=(len(word_lists), len(word_lists[0])), dtype=torch.long) * self.word2id['<pad>']).to(self.device)
-            tagID_lists = (torch.ones(size=(len(tag_lists), len(tag_lists[0])), dtype=torch.long) * self.tag2id['<pad>']).to(self.device)
-            for i in range(len(tag_lists)):
-                for j in range(len(tag_lists[i])):
-                    wordID_lists[i][j] = self.word2id.get(word_lists[i][j], self.word2id['<unk>'])      # 遇到词表中不存在的字符，使用<unk>代替
-                    tagID_lists[i][j] = self.tag2id[tag_lists[i][j]]
-                wordID_lists[i][-1] = self.word2id.get(word_lists[i][-1], self.word2id['<unk>'])
-            return wordID_lists, tagID_lists
+        self.model.eval()
+        with torch.no_grad():
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start: start + batch_size]
+                wordID_lists, lengths = tokenize_words([word_lists[i] for i in batch_indices], self.word2id)
+                wordID_lists = wordID_lists.to(self.device)
+                # forward
+                crf_scores = self.model.forward(wordID_lists, lengths)
+                # decoding
+                batch_paths = self.model.batch_viterbi_decoding(crf_scores, lengths).tolist()
+                for row, i in enumerate(batch_indices):
+                    best_paths[i] = batch_paths[row][:lengths[row] - 1]
+        return best_paths
 
     def _predtion_to_tags(self, prediction):
         """将模型给出的预测结果转化为标签序列"""
@@ -84,30 +80,28 @@ class BiLSTM_CRF_opration:
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        # 根据sentence的长度 重排train_data
+        # 按sentence的长度分桶组成batch
         # 此举可以减少同一个batch中的每个sentence之间
         # 的长度差距，这意味只需添加最少数量的 <pad>
-        train_word_lists, train_tag_lists = self._sort_by_sentence_lengths(self.train_word_lists, self.train_tag_lists)
-
         epochs = BiLSTMCRFTrainConfig.epochs
         batch_size = BiLSTMCRFTrainConfig.batch_size
-        iteration_size = round(len(train_word_lists) / batch_size + 0.49)
+        train_loader = self._dataloader(self.train_dataset, batch_size, shuffle=True)
+        dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
+        iteration_size = len(train_loader)
 
         for epoch in range(epochs):
         # for epoch in range(1):
             losses = 0.
             with tqdm(total=iteration_size, desc='Epoch %d/%d Training' %(epoch, epochs)) as pbar:
                 # one batch
-                for step in range(iteration_size):
+                for step, (batch_sentences, batch_targets, lengths) in enumerate(train_loader):
                     # batch data
-                    batch_sentences, batch_targets = self._tokenizer(
-                        train_word_lists[batch_size * step: min(batch_size * (step+1), len(train_word_lists))],
-                        train_tag_lists[batch_size * step: min(batch_size * (step+1), len(train_tag_lists))]
-                    )
+                    batch_sentences = batch_sentences.to(self.device, non_blocking=True)
+                    batch_targets = batch_targets.to(self.device, non_blocking=True)
                     # forword
                     self.model.train()
                     self.model.zero_grad()
-                    prediction = self.model.forward(batch_sentences)
+                    prediction = self.model.forward(batch_sentences, lengths)
                     # loss
                     loss = self.model.loss(prediction, batch_targets).to(self.device)
 
@@ -119,32 +113,28 @@ class BiLSTM_CRF_opration:
                     pbar.update(1)
 
                 # 每个epoch结束后，使用验证集测试
-                val_loss = self.validate(batch_size)
+                val_loss = self.validate(batch_size, dev_loader)
                 pbar.set_postfix(ave_loss='{0:.3f}'.format(losses/iteration_size), val_loss='{0:.3f}'.format(val_loss))
             
 
-    def validate(self, batch_size):
+    def validate(self, batch_size, dev_loader=None):
         """验证
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        dev_word_lists, dev_tag_lists = self._sort_by_sentence_lengths(self.dev_word_lists, self.dev_tag_lists)
-
-        # print(dev_word_lists)
+        if dev_loader is None:
+            dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
 
         self.model.eval()
         with torch.no_grad():
             val_losses = 0
-            iteration_size = round(len(self.dev_word_lists) / batch_size + 0.5)
-            for step in range(iteration_size):
+            iteration_size = len(dev_loader)
+            for val_sentences, val_targets, lengths in dev_loader:
                 # validate batch data
-
-                val_sentences, val_targets = self._tokenizer(
-                    dev_word_lists[batch_size * step: min(batch_size * (step+1), len(dev_word_lists))],
-                    dev_tag_lists[batch_size * step: min(batch_size * (step+1), len(dev_tag_lists))]
-                )
+                val_sentences = val_sentences.to(self.device, non_blocking=True)
+                val_targets = val_targets.to(self.device, non_blocking=True)
                 # forward
-                prediction = self.model.forward(val_sentences)
+                prediction = self.model.forward(val_sentences, lengths)
                 # loss
                 loss = self.model.loss(prediction, val_targets).to(self.device)
                 val_losses += loss.item()
@@ -152,46 +142,41 @@ class BiLSTM_CRF_opration:
 
             return val_losses
 
-    def evaluate(self, file_path: str):
+    def evaluate(self, file_path: str, batch_size=None):
         """评估
-        一个batch只有一条序列, 无需<pad>"""
-        self.model.eval()
-        with torch.no_grad():
-            pred_tag_lists = []
-            for i, (word_list, tag_list) in enumerate(zip(self.test_word_lists, self.test_tag_lists)):
-                # test data
-                wordID_list, tagID_list = self._tokenizer([word_list], [tag_list])
-                # forward
-                prediction = self.model.forward(wordID_list)
-                # loss
-                # loss = cal_bilstm_crf_loss(prediction, tagID_list, self.tag2id)
-                
-                # if i % 100 == 0: print(f'{i}/{len(self.test_word_lists)} : loss={loss}')
-                best_path = self.model.viterbi_decoding(prediction[0])
-                pred_tag_lists.append(
-                    self._predtion_to_tags(
-                        best_path
-                    )
-                )
-
-                # print(word_list)
-                # print(tag_list)
-                # print(self._predtion_to_tags(
-                #         best_path
-                #     ))
-
-            # 计算评估值
-            metrics = Metrics(file_path, self.test_tag_lists, pred_tag_lists)
-            metrics.report_scores(dtype='BiLSTM-CRF')
+        按序列长度分桶, 以batch的形式前向计算并解码"""
+        batch_size = batch_size or BiLSTMCRFTrainConfig.batch_size
+        # 每次解码若干个batch, 结果直接累加进混淆矩阵, 不保留全部预测结果
+        chunk_size = batch_size * 64
+        metrics = Metrics(file_path)
+        for start in range(0, len(self.test_word_lists), chunk_size):
+            best_paths = self._batch_decoding(self.test_word_lists[start: start + chunk_size], batch_size)
+            metrics.update(
+                self.test_tag_lists[start: start + chunk_size],
+                [self._predtion_to_tags(best_path) for best_path in best_paths]
+            )
+
+        # 计算评估值
+        metrics.report_scores(dtype='BiLSTM-CRF')
+
+    def _with_end_tag(self, sentence):
+        """句尾补充<end>"""
+        word_list = list(sentence)
+        return word_list if word_list[-1:] == ['<end>'] else word_list + ['<end>']
+
+    def predict_batch(self, sentences, batch_size=None):
+        """批量预测
+        : params sentences 文本列表, 按长度分桶后以batch的形式解码"""
+        batch_size = batch_size or BiLSTMCRFTrainConfig.batch_size
+        best_paths = self._batch_decoding([self._with_end_tag(sentence) for sentence in sentences], batch_size)
+        return [self._predtion_to_tags(best_path) for best_path in best_paths]
 
     def predict(self, sentence):
         """预测
         : params sentence 单个文本"""
-        sentence_token = self._tokenizer([sentence])
-        torch.no_grad()
-        prediction = self.model.forward(sentence_token)
-        pred_tags = self._predtion_to_tags(prediction)
-        return pred_tags, prediction
+        best_path = self._batch_decoding([self._with_end_tag(sentence)], batch_size=1)[0]
+        pred_tags = self._predtion_to_tags(best_path)
+        return pred_tags, best_path
 
 
 
@@ -4,6 +4,7 @@ from tqdm import tqdm
 from config import TrainingConfig, BiLSTMConfig
 from models.BiLSTM import BiLSTM, cal_loss
 from utils.utils import expand_vocabulary
+from utils.dataset import WordTagDataset, build_dataloader, tokenize_words
 from evaluating import Metrics
 
 
@@ -26,19 +27,19 @@ class BiLSTM_opration:
         ).to(self.device)
         self.optimizer = torch.optim.Adam(params=self.model.parameters(), lr=TrainingConfig.lr)
 
+        # 语料只在此处编码一次, 训练时由 DataLoader 按长度分桶并动态填补
+        self.train_dataset = WordTagDataset(self.train_word_lists, self.train_tag_lists, self.word2id, self.tag2id)
+        self.dev_dataset = WordTagDataset(self.dev_word_lists, self.dev_tag_lists, self.word2id, self.tag2id)
 
-    def _sort_by_sentence_lengths(self, word_lists, tag_lists):
-        """将 word_lists和tag_lists 根据sentence序列的长度
-        降序排序, 此举可以有效保证每个batch中的sentence序列
-        长度相近, 减少< pad> 占位符的用量
-        """
-        pairs = list(zip(word_lists, tag_lists))
-        indices = sorted(range(len(pairs)), key=lambda x:len(pairs[x][0]), reverse=True)
-        
-        pairs = [pairs[i] for i in indices]
-        word_lists, tag_lists = list(zip(*pairs))
-
-        return word_lists, tag_lists
+    def _dataloader(self, dataset, batch_size, shuffle):
+        return build_dataloader(
+            dataset,
+            batch_size=batch_size,
+            word_pad_id=self.word2id['<pad>'],
+            tag_pad_id=self.tag2id['<pad>'],
+            shuffle=shuffle,
+            num_workers=TrainingConfig.num_workers
+        )
 
     def _tokenizer(self, word_lists, tag_lists=None):
         """将 word和tag 转换为 词表(word2id)和标签表(tag2id)中对应的id
@@ -49,7 +50,7 @@ class BiLSTM_opration:
         """
         if tag_lists is None:
             # 用于 predict函数
-            assert len(word_lists == 1)
+            assert len(word_lists) == 1
             sentence = word_lists[0]
             wordID_lists = torch.LongTensor(size=(1, len(sentence))).to(self.device)
             for i, word in enumerate(sentence):
@@ -76,29 +77,27 @@ class BiLSTM_opration:
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        # 根据sentence的长度 重排train_data
+        # 按sentence的长度分桶组成batch
         # 此举可以减少同一个batch中的每个sentence之间
         # 的长度差距，这意味只需添加最少数量的 <pad>
-        train_word_lists, train_tag_lists = self._sort_by_sentence_lengths(self.train_word_lists, self.train_tag_lists)
-
         epochs = TrainingConfig.epochs
         batch_size = TrainingConfig.batch_size
-        iteration_size = round(len(train_word_lists) / batch_size + 0.49)
+        train_loader = self._dataloader(self.train_dataset, batch_size, shuffle=True)
+        dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
+        iteration_size = len(train_loader)
 
         for epoch in range(epochs):
             losses = 0.
             with tqdm(total=iteration_size, desc='Epoch %d/%d Training' %(epoch, epochs)) as pbar:
                 # one batch
-                for step in range(iteration_size):
+                for step, (batch_sentences, batch_targets, lengths) in enumerate(train_loader):
                     # batch data
-                    batch_sentences, batch_targets = self._tokenizer(
-                        train_word_lists[batch_size * step: min(batch_size * (step+1), len(train_word_lists))],
-                        train_tag_lists[batch_size * step: min(batch_size * (step+1), len(train_tag_lists))]
-                    )
+                    batch_sentences = batch_sentences.to(self.device, non_blocking=True)
+                    batch_targets = batch_targets.to(self.device, non_blocking=True)
                     # forword
                     self.model.train()
                     self.model.zero_grad()
-                    prediction = self.model.forward(batch_sentences)
+                    prediction = self.model.forward(batch_sentences, lengths)
                     # loss
                     loss = cal_loss(prediction, batch_targets, self.tag2id).to(self.device)
                     loss.backward()
@@ -109,32 +108,28 @@ class BiLSTM_opration:
                     pbar.update(1)
 
                 # 每个epoch结束后，使用验证集测试
-                val_loss = self.validate(batch_size)
+                val_loss = self.validate(batch_size, dev_loader)
                 pbar.set_postfix(ave_loss='{0:.3f}'.format(losses/iteration_size), val_loss='{0:.3f}'.format(val_loss))
             
 
-    def validate(self, batch_size):
+    def validate(self, batch_size, dev_loader=None):
         """验证
         数据以batch的形式输入模型, 同一个batch中的序列使
         用<pad>填补至与该batch中最长序列相同的长度, 故每
         个batch的序列长度为不同"""
-        dev_word_lists, dev_tag_lists = self._sort_by_sentence_lengths(self.dev_word_lists, self.dev_tag_lists)
-
-        # print(dev_word_lists)
+        if dev_loader is None:
+            dev_loader = self._dataloader(self.dev_dataset, batch_size, shuffle=False)
 
         self.model.eval()
         with torch.no_grad():
             val_losses = 0
-            iteration_size = round(len(self.dev_word_lists) / batch_size + 0.5)
-            for step in range(iteration_size):
+            iteration_size = len(dev_loader)
+            for val_sentences, val_targets, lengths in dev_loader:
                 # validate batch data
-
-                val_sentences, val_targets = self._tokenizer(
-                    dev_word_lists[batch_size * step: min(batch_size * (step+1), len(dev_word_lists))],
-                    dev_tag_lists[batch_size * step: min(batch_size * (step+1), len(dev_tag_lists))]
-                )
+                val_sentences = val_sentences.to(self.device, non_blocking=True)
+                val_targets = val_targets.to(self.device, non_blocking=True)
                 # forward
-                prediction = self.model.forward(val_sentences)
+                prediction = self.model.forward(val_sentences, lengths)
                 # loss
                 loss = cal_loss(prediction, val_targets, self.tag2id).to(self.device)
                 val_losses += loss.item()
@@ -147,7 +142,7 @@ class BiLSTM_opration:
         一个batch只有一条序列, 无需<pad>"""
         self.model.eval()
         with torch.no_grad():
-            pred_tag_lists = []
+            metrics = Metrics(file_path)
             for i, (word_list, tag_list) in enumerate(zip(self.test_word_lists, self.test_tag_lists)):
                 # test data
                 wordID_list, tagID_list = self._tokenizer([word_list], [tag_list])
@@ -157,17 +152,37 @@ class BiLSTM_opration:
                 loss = cal_loss(prediction, tagID_list, self.tag2id)
                 
                 if i % 100 == 0: print(f'{i}/{len(self.test_word_lists)} : loss={loss}')
-                pred_tag_lists.append(self._predtion_to_tags(prediction))
+                metrics.update([tag_list], [self._predtion_to_tags(prediction)])
             # 计算评估值
-            metrics = Metrics(file_path, self.test_tag_lists, pred_tag_lists)
             metrics.report_scores(dtype='BiLSTM')
 
+    def predict_batch(self, sentences, batch_size=None):
+        """批量预测
+        : params sentences 文本列表, 按长度分桶后以batch的形式前向计算"""
+        batch_size = batch_size or TrainingConfig.batch_size
+        indices = sorted(range(len(sentences)), key=lambda x: len(sentences[x]), reverse=True)
+        pred_tag_lists = [None] * len(sentences)
+
+        self.model.eval()
+        with torch.no_grad():
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start: start + batch_size]
+                wordID_lists, lengths = tokenize_words([list(sentences[i]) for i in batch_indices], self.word2id)
+                wordID_lists = wordID_lists.to(self.device)
+                # forward
+                prediction = self.model.forward(wordID_lists, lengths)
+                tag_ids = torch.argmax(prediction, dim=2).tolist()
+                for row, i in enumerate(batch_indices):
+                    pred_tag_lists[i] = [self.id2tag.get(id, 'O') for id in tag_ids[row][:lengths[row]]]
+        return pred_tag_lists
+
     def predict(self, sentence):
         """预测
         : params sentence 单个文本"""
         sentence_token = self._tokenizer([sentence])
-        torch.no_grad()
-        prediction = self.model.forward(sentence_token)
+        self.model.eval()
+        with torch.no_grad():
+            prediction = self.model.forward(sentence_token)
         pred_tags = self._predtion_to_tags(prediction)
         return pred_tags, prediction
 
@@ -2,6 +2,7 @@ class TrainingConfig(object):
     epochs = 10
     batch_size = 16  # batch_size != 1
     lr = 0.0005
+    num_workers = 2  # DataLoader 工作进程数
 
 class BiLSTMConfig(object):
     input_size = 768   # embedding size
@@ -10,4 +11,21 @@ class BiLSTMConfig(object):
 class BiLSTMCRFTrainConfig(object):
     epochs = 10
     batch_size = 16  # batch_size != 1
-    lr = 0.0005
\ No newline at end of file
+    lr = 0.0005
+    num_workers = 2  # DataLoader 工作进程数
+    lean_crf = False  # 使用省内存的 CRF 实现 BiLSTM_CRF_Lean
+
+class BertTrainConfig(object):
+    bf16 = False              # 以 bf16 autocast 前向计算, CRF 损失仍为 fp32
+    accumulation_steps = 1    # 梯度累积步数, 等效 batch_size = batch_size * accumulation_steps
+    freeze_layers = 0         # 冻结 BERT embedding 及前 freeze_layers 层 encoder
+    cache_frozen = True       # 缓存冻结层的输出, 仅在 freeze_layers > 0 时生效
+    cache_dir = None          # 冻结层输出缓存目录, 默认为系统临时目录
+
+    @classmethod
+    def cpu_efficient(cls, freeze_layers=8, accumulation_steps=8):
+        """CPU 节点上的高效训练模式: bf16 + 梯度累积 + 冻结并缓存 BERT 前若干层"""
+        cls.bf16 = True
+        cls.accumulation_steps = accumulation_steps
+        cls.freeze_layers = freeze_layers
+        cls.cache_frozen = True
@@ -1,81 +1,186 @@
-from collections import Counter
+import os
+from itertools import chain
+
+import numpy as np
+
+# 实体标注方案中标签前缀的含义，其余标签（O、<pad>、<end> 等）均视为非实体
+OUTSIDE, BEGIN, INSIDE, END, SINGLE = 0, 1, 2, 3, 4
+PREFIX_KIND = {'B': BEGIN, 'I': INSIDE, 'M': INSIDE, 'E': END, 'S': SINGLE}
 
-from utils.utils import flatten_lists
 
 class Metrics:
-    """模型评价模块，计算每个标签的精确率、召回率、F1分数"""
-    def __init__(self, file_path, golden_tags, predict_tags, remove_O=False) -> None:
+    """模型评价模块，计算每个标签的精确率、召回率、F1分数，以及实体级别的分数
+
+    标签只在第一次出现时映射为id，之后每个batch的真实/预测标签
+    通过 np.bincount(gold*T+pred) 累加进同一个 T×T 混淆矩阵，
+    所有标签级别的指标都由该矩阵得到。可以在构造时一次性给出全部结果，
+    也可以逐batch调用 update()，无需保留全部预测结果。
+    file_path 目录下有 labels.txt 时，report_scores 按其中的顺序打印各标签。
+    """
+    def __init__(self, file_path, golden_tags=None, predict_tags=None, remove_O=False, tags=None) -> None:
         self.file_path = file_path
+        self.remove_O = remove_O
+
+        self.tag2id = {}
+        self.id2tag = []
+        self._kind = []                   # 每个标签id的前缀类型
+        self._entity_type = []            # 每个标签id对应的实体类型id, 非实体为 -1
+        self.entity_type2id = {}
+        self.confusion = np.zeros((0, 0), dtype=np.int64)
+        self.entity_counts = np.zeros((3, 0), dtype=np.int64)   # 真实 / 预测 / 正确 的实体数量
+        for tag in tags or []:
+            self._tag_id(tag)
+
+        if golden_tags is not None:
+            self.update(golden_tags, predict_tags)
+
+    def _tag_id(self, tag):
+        tag_id = self.tag2id.get(tag)
+        if tag_id is None:
+            tag_id = self.tag2id[tag] = len(self.id2tag)
+            self.id2tag.append(tag)
+            prefix, _, entity = tag.partition('-')
+            kind = PREFIX_KIND.get(prefix, OUTSIDE) if entity else OUTSIDE
+            self._kind.append(kind)
+            if kind == OUTSIDE:
+                self._entity_type.append(-1)
+            else:
+                if entity not in self.entity_type2id:
+                    self.entity_type2id[entity] = len(self.entity_type2id)
+                self._entity_type.append(self.entity_type2id[entity])
+        return tag_id
+
+    def _encode(self, tag_lists):
+        """将 list of list 的标签转换为一维id数组，并返回每条序列的长度"""
+        lengths = np.fromiter((len(tags) for tags in tag_lists), dtype=np.int64, count=len(tag_lists))
+        tag_id = self._tag_id
+        ids = np.fromiter((tag_id(tag) for tag in chain.from_iterable(tag_lists)), dtype=np.int64, count=int(lengths.sum()))
+        return ids, lengths
+
+    def _grow(self):
+        """出现新标签时扩充混淆矩阵与实体计数"""
+        n_tags, n_types = len(self.id2tag), len(self.entity_type2id)
+        if self.confusion.shape[0] < n_tags:
+            confusion = np.zeros((n_tags, n_tags), dtype=np.int64)
+            confusion[:self.confusion.shape[0], :self.confusion.shape[1]] = self.confusion
+            self.confusion = confusion
+        if self.entity_counts.shape[1] < n_types:
+            entity_counts = np.zeros((3, n_types), dtype=np.int64)
+            entity_counts[:, :self.entity_counts.shape[1]] = self.entity_counts
+            self.entity_counts = entity_counts
+
+    def update(self, golden_tags, predict_tags):
+        """累加一个batch的结果
+        :param golden_tags   真实标签序列 list of list
+        :param predict_tags  预测标签序列 list of list
+        """
+        gold, gold_lengths = self._encode(golden_tags)
+        pred, pred_lengths = self._encode(predict_tags)
+        self._grow()
+        n_tags = len(self.id2tag)
+
+        # 与逐字比较相同，按展开后的位置对齐
+        size = min(len(gold), len(pred))
+        self.confusion += np.bincount(
+            gold[:size] * n_tags + pred[:size], minlength=n_tags * n_tags
+        ).reshape(n_tags, n_tags)
+
+        # 实体级别：抽取 (起点, 终点, 类型) 完全一致才算预测正确
+        # 两边使用相同的基数编码，位置相同的实体编码才相同
+        base = max(len(gold), len(pred))
+        gold_spans, gold_types = self._spans(gold, gold_lengths, base)
+        pred_spans, pred_types = self._spans(pred, pred_lengths, base)
+        n_types = len(self.entity_type2id)
+        _, gold_index, _ = np.intersect1d(gold_spans, pred_spans, assume_unique=True, return_indices=True)
+        self.entity_counts[0] += np.bincount(gold_types, minlength=n_types)
+        self.entity_counts[1] += np.bincount(pred_types, minlength=n_types)
+        self.entity_counts[2] += np.bincount(gold_types[gold_index], minlength=n_types)
+        return self
+
+    def _spans(self, ids, lengths, base):
+        """向量化抽取实体片段（BIO/BIOES/BMES，非严格模式）
+        :param base    位置编码的基数，不小于 len(ids)
+        :return keys   每个实体的唯一编码 (起点, 终点, 类型)
+        :return types  每个实体的类型id"""
+        kinds = np.asarray(self._kind, dtype=np.int64)[ids]
+        types = np.asarray(self._entity_type, dtype=np.int64)[ids]
+        n = len(ids)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        first = np.zeros(n, dtype=bool)
+        first[np.cumsum(lengths)[:-1][lengths[1:] > 0]] = True
+        first[0] = True
+        last = np.roll(first, -1)
+        last[-1] = True
+
+        prev_kind, prev_type = np.roll(kinds, 1), np.roll(types, 1)
+        next_kind, next_type = np.roll(kinds, -1), np.roll(types, -1)
+        entity = kinds != OUTSIDE
+        starts = entity & (
+            first | np.isin(kinds, [BEGIN, SINGLE]) | np.isin(prev_kind, [OUTSIDE, END, SINGLE]) | (prev_type != types)
+        )
+        ends = entity & (
+            last | np.isin(kinds, [END, SINGLE]) | np.isin(next_kind, [OUTSIDE, BEGIN, SINGLE]) | (next_type != types)
+        )
+        start_index, end_index = np.flatnonzero(starts), np.flatnonzero(ends)
+        span_types = types[start_index]
+        keys = (start_index * base + end_index) * max(len(self.entity_type2id), 1) + span_types
+        return keys, span_types
+
+    # 由混淆矩阵得到的统计量
+    @property
+    def tagset(self):
+        """真实标签中出现过的标签"""
+        tags = [tag for tag, count in zip(self.id2tag, self.confusion.sum(axis=1)) if count > 0]
+        if self.remove_O:
+            tags = [tag for tag in tags if tag != 'O']
+        return set(tags)
+
+    @property
+    def correct_tags_number(self):
+        """每种tag 预测正确的数量"""
+        return {tag: int(count) for tag, count in zip(self.id2tag, np.diag(self.confusion)) if count > 0}
 
-        self.golden_tags = flatten_lists(golden_tags)
-        self.predict_tags = flatten_lists(predict_tags)
-
-        # 不统计非实体标记
-        if remove_O:
-            pass
-
-        # 统计tag总数
-        self.tagset = set(self.golden_tags)
-        self.correct_tags_number = self.count_correct_tags()            # 每种tag 预测正确的数量
-        self.predict_tags_count = Counter(self.predict_tags)
-        self.golden_tags_count = Counter(self.golden_tags)
-
-        # TP (True Positive) 真实-->0 预测-->0
-        # FN (False Negative) 真实-->0 预测-->1
-        # FP (False Positive) 真实-->1 预测-->0
-        # TN (True Negative) 真实-->1 预测-->1
-
-        # 精确率  p = len(gold_tag==predict_tag) / len(predict_tag)
-        self.precision_scores = self.cal_precision()
-        # 召回率  r = len(gold_tag==predict_tag) / len(gold_tag)
-        self.recall_scores = self.cal_recall()
-        # F1     F1 = (2*p*c) / (p+c)
-        self.f1_scores = self.cal_f1()
-
-    def count_correct_tags(self):
-        """计算每个tag 预测正确的数量
-        calculate the number of the every kind of tag that be predictded correctly"""
-        correct_dict = {}
-        for gold_tag, predict_tag in zip(self.golden_tags, self.predict_tags):
-            if gold_tag == predict_tag:
-                if gold_tag in correct_dict:
-                    correct_dict[gold_tag] += 1
-                else:
-                    correct_dict[gold_tag] = 1
-        return correct_dict
-
-    def cal_precision(self):
-        """计算每个标签的精确率"""
-        precision_score = {}
-        for tag in self.tagset:
-            if tag not in self.correct_tags_number: 
-                precision_score[tag] = -1
-                continue
-            if tag not in self.predict_tags_count: 
-                precision_score[tag] = -2
-                continue
-            precision_score[tag] = self.correct_tags_number[tag] / self.predict_tags_count[tag] * 1.0
-        return precision_score
-
-    def cal_recall(self):
-        """计算每个标签的召回率"""
-        recall_score = {}
-        for tag in self.tagset:
-            if tag not in self.correct_tags_number: 
-                recall_score[tag] = -1
-                continue
-            if tag not in self.golden_tags_count: 
-                recall_score[tag] = -2
-                continue
-            recall_score[tag] = self.correct_tags_number[tag] / self.golden_tags_count[tag] * 1.0
-        return recall_score
-
-    def cal_f1(self):
-        """计算f1分数"""
-        f1_score = {}
-        for tag in self.tagset:
-            f1_score[tag] = 2*self.precision_scores[tag]*self.recall_scores[tag] / (self.precision_scores[tag] + self.recall_scores[tag])
-        return f1_score
+    @property
+    def golden_tags_count(self):
+        return dict(zip(self.id2tag, self.confusion.sum(axis=1).tolist()))
+
+    @property
+    def predict_tags_count(self):
+        return dict(zip(self.id2tag, self.confusion.sum(axis=0).tolist()))
+
+    def _tag_scores(self):
+        """每个标签的精确率、召回率、F1分数，分母为0时记为0"""
+        correct = np.diag(self.confusion).astype(np.float64)
+        predict = self.confusion.sum(axis=0)
+        golden = self.confusion.sum(axis=1)
+        return _prf(correct, predict, golden)
+
+    @property
+    def precision_scores(self):
+        return self._scores_of(self._tag_scores()[0])
+
+    @property
+    def recall_scores(self):
+        return self._scores_of(self._tag_scores()[1])
+
+    @property
+    def f1_scores(self):
+        return self._scores_of(self._tag_scores()[2])
+
+    def _scores_of(self, values):
+        tagset = self.tagset
+        return {tag: float(value) for tag, value in zip(self.id2tag, values) if tag in tagset}
+
+    def entity_scores(self):
+        """每种实体类型的精确率、召回率、F1分数以及 (真实, 预测, 正确) 数量"""
+        golden, predict, correct = self.entity_counts
+        precision, recall, f1 = _prf(correct.astype(np.float64), predict, golden)
+        return {
+            entity: (float(precision[i]), float(recall[i]), float(f1[i]), int(golden[i]), int(predict[i]), int(correct[i]))
+            for entity, i in self.entity_type2id.items()
+        }
 
     def report_scores(self, dtype='HMM'):
         """将结果用表格的形式打印出来，像这个样子：
@@ -95,69 +200,83 @@ class Metrics:
         # 打印表头
         header_format = '{:>9s}  {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'
         header = ['precision', 'recall', 'f1-score', 'support', 'predict', '==']
+        row_format = '{:>9s}  {:>9.4f} {:>9.4f} {:>9.4f} {:>9} {:>9} {:>9}'
+
+        precision, recall, f1 = self._tag_scores()
+        golden = self.confusion.sum(axis=1)
+        predict = self.confusion.sum(axis=0)
+        correct = np.diag(self.confusion)
+        tagset = self.tagset
+        rows = [i for i, tag in enumerate(self.id2tag) if tag in tagset]
+
+        lines = [header_format.format('', *header)]
+        # 打印每个标签的 精确率、召回率、f1分数
+        for i in self._report_order(rows):
+            lines.append(row_format.format(
+                self.id2tag[i], precision[i], recall[i], f1[i], golden[i], predict[i], correct[i]
+            ))
+
+        # 计算并打印平均值
+        avg_metrics = self._cal_weighted_average()
+        lines.append(row_format.format(
+            'avg/total',
+            avg_metrics['precision'],
+            avg_metrics['recall'],
+            avg_metrics['f1_score'],
+            int(golden[rows].sum()),
+            int(predict[rows].sum()),
+            int(correct[rows].sum())
+        ))
+
+        # 实体级别的分数
+        entity_scores = self.entity_scores()
+        if entity_scores:
+            lines.append('')
+            lines.append(header_format.format('entity', *header))
+            for entity, scores in entity_scores.items():
+                lines.append(row_format.format(entity, *scores))
+            golden_total, predict_total, correct_total = self.entity_counts.sum(axis=1)
+            total = _prf(np.float64(correct_total), predict_total, golden_total)
+            lines.append(row_format.format('micro', *total, golden_total, predict_total, correct_total))
+
         with open('result.txt', 'a') as fout:
             fout.write('\n')
             fout.write('='*100)
             fout.write('\n')
             fout.write('模型：{}，test结果如下：'.format(dtype))
             fout.write('\n')
-            fout.write(header_format.format('', *header))
-            print(header_format.format('', *header))
-
-            with open(f'{self.file_path}labels.txt', 'r') as f:
-                tag_list = f.read().split()
-
-            row_format = '{:>9s}  {:>9.4f} {:>9.4f} {:>9.4f} {:>9} {:>9} {:>9}'
-            # 打印每个标签的 精确率、召回率、f1分数
-            for tag in tag_list:
-                if tag not in self.tagset: continue
-                content = row_format.format(
-                    tag,
-                    self.precision_scores[tag],
-                    self.recall_scores[tag],
-                    self.f1_scores[tag],
-                    self.golden_tags_count[tag],
-                    self.predict_tags_count[tag],
-                    self.correct_tags_number[tag] if tag in self.correct_tags_number else 0
-                )
-                fout.write('\n')
-                fout.write(content)
-                print(content)
-
-            # 计算并打印平均值
-            avg_metrics = self._cal_weighted_average()
-            content = row_format.format(
-                'avg/total',
-                avg_metrics['precision'],
-                avg_metrics['recall'],
-                avg_metrics['f1_score'],
-                len(self.golden_tags),
-                len(self.predict_tags),
-                sum(self.correct_tags_number.values())
-            )
+            fout.write('\n'.join(lines))
             fout.write('\n')
-            fout.write(content)
-            fout.write('\n')
-            print(content)
-
+        print('\n'.join(lines))
 
+    def _report_order(self, rows):
+        """有 labels.txt 时按其中的顺序排列并只保留其中的标签，否则按标签第一次出现的顺序"""
+        labels_file = f'{self.file_path}labels.txt'
+        if not self.file_path or not os.path.exists(labels_file):
+            return rows
+        with open(labels_file, 'r') as f:
+            tag_list = f.read().split()
+        rows = set(rows)
+        return [self.tag2id[tag] for tag in tag_list if tag in self.tag2id and self.tag2id[tag] in rows]
 
     def _cal_weighted_average(self):
+        """以每个标签的真实数量为权重的加权平均"""
+        precision, recall, f1 = self._tag_scores()
+        golden = self.confusion.sum(axis=1).astype(np.float64)
+        tagset = self.tagset
+        weights = np.array([golden[i] if tag in tagset else 0. for i, tag in enumerate(self.id2tag)])
+        total = weights.sum()
 
         weighted_average = {}
-        total = len(self.golden_tags)
-
-        # 计算weighted precisions：
-        weighted_average['precision'] = 0.
-        weighted_average['recall'] = 0.
-        weighted_average['f1_score'] = 0.
-        for tag in self.tagset:
-            size = self.golden_tags_count[tag]
-            weighted_average['precision'] += self.precision_scores[tag] * size
-            weighted_average['recall'] += self.recall_scores[tag] * size
-            weighted_average['f1_score'] += self.f1_scores[tag] * size
-        
-        for metric in weighted_average.keys():
-            weighted_average[metric] /= total
-
-        return weighted_average
\ No newline at end of file
+        for metric, values in (('precision', precision), ('recall', recall), ('f1_score', f1)):
+            weighted_average[metric] = float(np.dot(values, weights) / total) if total else 0.
+        return weighted_average
+
+
+def _prf(correct, predict, golden):
+    """由正确数、预测数、真实数计算精确率、召回率、F1分数，分母为0时记为0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predict > 0, correct / np.maximum(predict, 1), 0.)
+        recall = np.where(golden > 0, correct / np.maximum(golden, 1), 0.)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / np.where(precision + recall > 0, precision + recall, 1), 0.)
+    return precision, recall, f1
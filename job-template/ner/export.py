@@ -0,0 +1,291 @@
+import os
+import sys
+
+dir_common = os.path.split(os.path.realpath(__file__))[0]
+sys.path.append(dir_common)   # 将NER根目录添加到系统目录, pickle 才能找到模型类
+import argparse
+import json
+import pickle
+import unicodedata
+from typing import List
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+# 导出文件内附带的元数据(词表、标签表等)
+META_FILE = 'meta.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a pickled NER model to TorchScript")
+    parser.add_argument('-pp', "--pklpath", type=str, default='./model.pkl', help='the .pkl file written by save_model')
+    parser.add_argument('-o', '--output', type=str, default='./model.pt', help='the TorchScript file to write')
+    return parser.parse_args()
+
+
+@torch.jit.script
+def batch_viterbi(emission: torch.Tensor, transition: torch.Tensor, lengths: torch.Tensor,
+                  start_id: int, end_id: int, end_token: bool) -> torch.Tensor:
+    """batch viterbi decoding
+    每个时间步只构造 [B, T, T] 的转移得分, 不展开 [B, L, T, T] 的 crf_scores,
+    加法顺序与 forward 中的 emission + transition 相同, 解码结果与 eager 模式一致
+
+    :param emission    [B, L, T]
+    :param transition  [T, T]
+    :param lengths     [B] 每条序列的实际长度
+    :param end_token   序列以<end>结尾(BiLSTM_CRF)时由<end>开始回溯,
+                       否则取最后一个字转移到<end>得分最高的tag(BERT_BiLSTM_CRF)
+    :return            LongTensor [B, L], 第 i 条序列的路径为 [i, :lengths[i]]"""
+    batch_size = emission.size(0)
+    max_len = emission.size(1)
+    tagset_size = emission.size(2)
+    device = emission.device
+    lengths = lengths.to(device)
+    identity = torch.arange(tagset_size, device=device).unsqueeze(0).expand(batch_size, tagset_size)
+
+    # 第一个字
+    viterbi = (emission[:, 0, :].unsqueeze(1) + transition.unsqueeze(0))[:, start_id, :]
+    backpointers: List[torch.Tensor] = []
+    for step in range(1, max_len):
+        max_scores, prev_tags_id = torch.max(
+            viterbi.unsqueeze(2) + (emission[:, step, :].unsqueeze(1) + transition.unsqueeze(0)),
+            dim=1
+        )
+        step_mask = (lengths > step).unsqueeze(1)
+        viterbi = torch.where(step_mask, max_scores, viterbi)
+        backpointers.append(torch.where(step_mask, prev_tags_id, identity))
+
+    if end_token:
+        best_tags = torch.full([batch_size], end_id, dtype=torch.long, device=device)
+    else:
+        best_tags = torch.argmax(viterbi + transition[:, end_id].unsqueeze(0), dim=1)
+    best_path = [best_tags]
+    for i in range(len(backpointers) - 1, -1, -1):
+        best_tags = backpointers[i].gather(1, best_tags.unsqueeze(1)).squeeze(1)
+        best_path.append(best_tags)
+    best_path.reverse()
+    return torch.stack(best_path, dim=1)
+
+
+class LSTMEncoder(nn.Module):
+    """字 embedding + BiLSTM + 线性层, 按实际长度打包, 输出 emission [B, L, T]"""
+
+    def __init__(self, word_embeds, bilstm, hidden2tag):
+        super(LSTMEncoder, self).__init__()
+        self.word_embeds = word_embeds
+        self.bilstm = bilstm
+        self.hidden2tag = hidden2tag
+
+    def forward(self, word_ids, lengths):
+        embeds = self.word_embeds(word_ids)
+        packed = pack_padded_sequence(embeds, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        lstm_out, _ = self.bilstm(packed)
+        lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=word_ids.size(1))
+        return self.hidden2tag(lstm_out)
+
+
+class BertLastHidden(nn.Module):
+    """BertModel 最后一层的输出, 用于 torch.jit.trace"""
+
+    def __init__(self, bert):
+        super(BertLastHidden, self).__init__()
+        self.bert = bert
+
+    def forward(self, input_ids, attention_mask):
+        return self.bert(input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class BertEncoder(nn.Module):
+    """BERT(trace 得到) + BiLSTM + 线性层, 输出 emission [B, L, T]"""
+
+    def __init__(self, bert, bilstm, hidden2tag):
+        super(BertEncoder, self).__init__()
+        self.bert = bert
+        self.bilstm = bilstm
+        self.hidden2tag = hidden2tag
+
+    def forward(self, word_ids, lengths):
+        attention_mask = (torch.arange(word_ids.size(1)).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        embeds = self.bert(word_ids, attention_mask)
+        packed = pack_padded_sequence(embeds, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        lstm_out, _ = self.bilstm(packed)
+        lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=word_ids.size(1))
+        return self.hidden2tag(lstm_out)
+
+
+class ExportedTagger(nn.Module):
+    """导出的完整计算图: word ids [B, L] + lengths [B] -> tag ids [B, L]
+    有 transition 时以 batch_viterbi 解码, 否则逐字取 argmax"""
+
+    def __init__(self, encoder, transition=None, start_id=0, end_id=0, end_token=False):
+        super(ExportedTagger, self).__init__()
+        self.encoder = encoder
+        self.crf = transition is not None
+        self.register_buffer('transition', transition.detach().clone() if self.crf else torch.zeros(0, 0))
+        self.start_id = start_id
+        self.end_id = end_id
+        self.end_token = end_token
+
+    def forward(self, word_ids, lengths):
+        emission = self.encoder(word_ids, lengths)
+        if not self.crf:
+            return torch.argmax(emission, dim=2)
+        return batch_viterbi(emission, self.transition, lengths, self.start_id, self.end_id, self.end_token)
+
+
+def _bert_example(tokenizer, lengths):
+    """按 lengths 构造填补后的 [CLS] ... [SEP] 输入与 attention mask"""
+    lengths = torch.tensor(lengths, dtype=torch.long)
+    input_ids = torch.full((len(lengths), int(lengths.max())), tokenizer.pad_token_id, dtype=torch.long)
+    for row, length in enumerate(lengths.tolist()):
+        input_ids[row, 0] = tokenizer.cls_token_id
+        input_ids[row, 1: length - 1] = tokenizer.unk_token_id
+        input_ids[row, length - 1] = tokenizer.sep_token_id
+    attention_mask = (torch.arange(input_ids.size(1)).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    return input_ids, attention_mask
+
+
+def _trace_bert(bert, tokenizer):
+    """trace BERT
+    以长度不同、mask 中有0的 batch 作为示例, 全为1的 mask 会让 transformers 跳过 mask 的分支被固化到图中;
+    trace 后在另一组形状不同的输入上与 eager 对比, 不一致时报错"""
+    with torch.no_grad():
+        traced = torch.jit.trace(bert, _bert_example(tokenizer, [6, 3, 2]), strict=False)
+        check = _bert_example(tokenizer, [11, 4, 9, 2])
+        expected, actual = bert(*check), traced(*check)
+    mask = check[1].unsqueeze(2).bool()
+    if not torch.allclose(expected.masked_fill(~mask, 0), actual.masked_fill(~mask, 0), atol=1e-4):
+        raise RuntimeError('traced BERT differs from eager on padded inputs')
+    return traced
+
+
+def _build_tagger(model):
+    """由 save_model 保存的 BiLSTM_opration / BiLSTM_CRF_opration / BERT 的 BiLSTM_opration 构造 ExportedTagger
+    :return tagger, meta"""
+    id2tag = {int(id): tag for id, tag in model.id2tag.items()}
+    if hasattr(model, 'tokenizer'):
+        # BERT_BiLSTM_CRF, token 序列两端为 [CLS]/[SEP]
+        net = model.net.cpu().eval()
+        tokenizer = model.tokenizer
+        bert = _trace_bert(BertLastHidden(net.word_embeds), tokenizer)
+        tagger = ExportedTagger(
+            BertEncoder(bert, net.bilstm, net.hidden2tag),
+            net.transition, net.tag2id['<start>'], net.tag2id['<end>'], end_token=False
+        )
+        meta = {
+            'kind': 'BERT_BiLSTM_CRF',
+            'word2id': tokenizer.get_vocab(),
+            'pad': tokenizer.pad_token_id,
+            'unk': tokenizer.unk_token_id,
+            'cls': tokenizer.cls_token_id,
+            'sep': tokenizer.sep_token_id,
+            'lowercase': bool(getattr(tokenizer, 'do_lower_case', True)),
+            'max_length': 512,
+        }
+    elif hasattr(model.model, 'transition'):
+        # BiLSTM_CRF / BiLSTM_CRF_Lean, 序列以<end>结尾
+        net = model.model.cpu().eval()
+        tagger = ExportedTagger(
+            LSTMEncoder(net.bilstm.word_embeds, net.bilstm.bilstm, net.bilstm.hidden2tag),
+            net.transition, net.tag2id['<start>'], net.tag2id['<end>'], end_token=True
+        )
+        meta = {'kind': 'BiLSTM_CRF', 'word2id': model.word2id}
+    else:
+        net = model.model.cpu().eval()
+        tagger = ExportedTagger(LSTMEncoder(net.word_embeds, net.bilstm, net.hidden2tag))
+        meta = {'kind': 'BiLSTM', 'word2id': model.word2id}
+
+    meta['id2tag'] = {str(id): tag for id, tag in id2tag.items()}
+    return tagger.eval(), meta
+
+
+def export_model(model, file_name):
+    """将 save_model 保存的模型导出为 TorchScript, 词表等元数据一并写入同一个文件"""
+    tagger, meta = _build_tagger(model)
+    with torch.no_grad():
+        scripted = torch.jit.script(tagger)
+    torch.jit.save(scripted, file_name, _extra_files={META_FILE: json.dumps(meta, ensure_ascii=False)})
+    return scripted
+
+
+class ExportedNER(object):
+    """加载 export_model 导出的 TorchScript 模型, 只依赖 torch, 不需要训练代码
+    接口与各 opration 的 predict_batch / predict 相同, 可直接用于 server.py"""
+
+    def __init__(self, file_name, batch_size=64):
+        extra_files = {META_FILE: ''}
+        self.module = torch.jit.load(file_name, map_location='cpu', _extra_files=extra_files)
+        self.module.eval()
+        meta = json.loads(extra_files[META_FILE])
+        self.kind = meta['kind']
+        self.word2id = meta['word2id']
+        self.id2tag = {int(id): tag for id, tag in meta['id2tag'].items()}
+        self.batch_size = batch_size
+        if self.kind == 'BERT_BiLSTM_CRF':
+            self.pad_id, self.unk_id = meta['pad'], meta['unk']
+            self.cls_id, self.sep_id = meta['cls'], meta['sep']
+            self.lowercase = meta['lowercase']
+            self.max_length = meta['max_length']
+        else:
+            self.pad_id, self.unk_id = self.word2id['<pad>'], self.word2id['<unk>']
+
+    def _normalize(self, char):
+        """与 BertTokenizer 对单个字的处理一致: 小写并去除重音符号"""
+        if not self.lowercase:
+            return char
+        char = unicodedata.normalize('NFD', char.lower())
+        return ''.join(c for c in char if unicodedata.category(c) != 'Mn')
+
+    def _to_ids(self, sentence):
+        if self.kind == 'BERT_BiLSTM_CRF':
+            ids = [self.word2id.get(self._normalize(char), self.unk_id) for char in sentence]
+            return [self.cls_id] + ids[:self.max_length - 2] + [self.sep_id]
+        ids = [self.word2id.get(char, self.unk_id) for char in sentence]
+        if self.kind == 'BiLSTM_CRF':
+            # 句尾补充<end>
+            ids.append(self.word2id['<end>'])
+        return ids
+
+    def _tag_range(self, length):
+        """输出路径中对应原始文本的区间, 去除<end>或[CLS]/[SEP]"""
+        if self.kind == 'BiLSTM_CRF':
+            return 0, length - 1
+        if self.kind == 'BERT_BiLSTM_CRF':
+            return 1, length - 1
+        return 0, length
+
+    def predict_batch(self, sentences, batch_size=None):
+        """批量预测
+        : params sentences 文本列表, 按长度分桶后以batch的形式前向计算并解码"""
+        batch_size = batch_size or self.batch_size
+        id_lists = [self._to_ids(list(sentence)) for sentence in sentences]
+        indices = sorted(range(len(id_lists)), key=lambda x: len(id_lists[x]), reverse=True)
+        pred_tag_lists = [None] * len(sentences)
+
+        with torch.no_grad():
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start: start + batch_size]
+                lengths = torch.tensor([len(id_lists[i]) for i in batch_indices], dtype=torch.long)
+                word_ids = torch.full((len(batch_indices), int(lengths.max())), self.pad_id, dtype=torch.long)
+                for row, i in enumerate(batch_indices):
+                    word_ids[row, :lengths[row]] = torch.tensor(id_lists[i], dtype=torch.long)
+                tag_ids = self.module(word_ids, lengths).tolist()
+                for row, i in enumerate(batch_indices):
+                    begin, end = self._tag_range(int(lengths[row]))
+                    pred_tag_lists[i] = [self.id2tag.get(id, 'O') for id in tag_ids[row][begin: end]]
+        return pred_tag_lists
+
+    def predict(self, sentence):
+        """预测
+        : params sentence 单个文本"""
+        return self.predict_batch([sentence], batch_size=1)[0]
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(args)
+    with open(args.pklpath, 'rb') as f:
+        model = pickle.load(f)
+    export_model(model, args.output)
+    print('exported %s to %s' % (type(model).__name__, args.output))
@@ -1,9 +1,8 @@
 import argparse
 from minio import Minio
 
-from data import build_corpus
 from train_evaluate import hmm_train_eval, crf_train_eval, bilstm_train_eval, bilstm_crf_train_eval
-from utils.preprocessing import Preprocessing
+from utils.corpus_cache import CorpusCache
 from utils.utils import save_model
 from config import TrainingConfig, BiLSTMCRFTrainConfig
 
@@ -17,6 +16,7 @@ def parse_args():
     parser.add_argument('-e', '--epochs', type=int, default=10, help='train epoch')
     parser.add_argument('-b', '--batch_size', type=int, default=16, help='batch size')
     parser.add_argument('-lr', '--learning_rate', type=float, default=0.0005, help='learning rate')
+    parser.add_argument('-lc', '--lean_crf', action='store_true', help='use the memory-lean CRF head for BiLSTM_CRF')
     parser.add_argument('-pp', "--pklpath", type=str, default='./model.pkl', help='the path and filename to save .pkl file')
     return parser.parse_args()
  
@@ -26,18 +26,18 @@ if __name__ == "__main__":
     print(args)
 
     # preprocessing data
-    data_preprocessing = Preprocessing(
+    # 首次运行单次遍历标注文件并写出二进制缓存, 之后直接 mmap 加载
+    corpus = CorpusCache(
         file_path=args.path,
         file_name=args.filename
-    )
-    data_preprocessing.train_test_dev_split(data_rate=args.datarate)
-    data_preprocessing.construct_vocabulary_labels()
+    ).load_or_build()
+    corpus.write_vocabulary_labels()
     
     # load data
     print('long data ...')
-    train_word_lists, train_tag_lists, word2id, tag2id = build_corpus("train", data_dir=args.path)
-    dev_word_lists, dev_tag_lists = build_corpus("dev", make_vocab=False, data_dir=args.path)
-    test_word_lists, test_tag_lists = build_corpus("test", make_vocab=False, data_dir=args.path)
+    train_word_lists, train_tag_lists, word2id, tag2id = corpus.build_corpus("train", data_rate=args.datarate)
+    dev_word_lists, dev_tag_lists = corpus.build_corpus("dev", data_rate=args.datarate, make_vocab=False)
+    test_word_lists, test_tag_lists = corpus.build_corpus("test", data_rate=args.datarate, make_vocab=False)
 
     if args.model == 'HMM':
         # train and evaluate HMM model
@@ -73,6 +73,7 @@ if __name__ == "__main__":
         BiLSTMCRFTrainConfig.batch_size = args.batch_size
         BiLSTMCRFTrainConfig.epochs = args.epochs
         BiLSTMCRFTrainConfig.lr = args.learning_rate
+        BiLSTMCRFTrainConfig.lean_crf = args.lean_crf
         model = bilstm_crf_train_eval(
             file_path=args.path,
             train_data=(train_word_lists, train_tag_lists),
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from transformers import BertModel, BertTokenizer
 
 
@@ -31,20 +32,83 @@ class BiLSTM_CRF(nn.Module):
         )
 
 
-    def _get_lstm_features(self, sentences):
+    def freeze_bert_layers(self, num_layers):
+        """冻结 BERT 的 embedding 层以及前 num_layers 层 encoder
+        冻结部分始终以 eval 模式运行(关闭 dropout), 其输出只依赖输入, 可以缓存复用"""
+        self.frozen_layers = num_layers
+        frozen = [self.word_embeds.embeddings] + list(self.word_embeds.encoder.layer[:num_layers])
+        for module in frozen:
+            module.eval()
+            for param in module.parameters():
+                param.requires_grad = False
+
+    def train(self, mode=True):
+        super(BiLSTM_CRF, self).train(mode)
+        if getattr(self, 'frozen_layers', 0) > 0:
+            self.word_embeds.embeddings.eval()
+            for layer in self.word_embeds.encoder.layer[:self.frozen_layers]:
+                layer.eval()
+        return self
+
+    def _extended_attention_mask(self, sentences, attention_mask):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(sentences)
+        return self.word_embeds.get_extended_attention_mask(attention_mask, sentences.shape)
+
+    def _run_layers(self, hidden_states, layers, extended_attention_mask):
+        for layer in layers:
+            outputs = layer(hidden_states, attention_mask=extended_attention_mask)
+            hidden_states = outputs[0] if isinstance(outputs, tuple) else outputs
+        return hidden_states
+
+    def frozen_features(self, sentences, attention_mask=None):
+        """冻结部分(embedding + 前 frozen_layers 层)的输出 [B, L, 768], 不计算梯度"""
+        with torch.no_grad():
+            hidden_states = self.word_embeds.embeddings(input_ids=sentences)
+            return self._run_layers(
+                hidden_states,
+                self.word_embeds.encoder.layer[:self.frozen_layers],
+                self._extended_attention_mask(sentences, attention_mask)
+            )
+
+    def _bert_features(self, sentences, attention_mask=None, frozen_hidden=None):
+        """BERT 最后一层的输出
+        冻结了前若干层时, 只对之后的层计算梯度, frozen_hidden 为缓存的冻结部分输出"""
+        if getattr(self, 'frozen_layers', 0) <= 0:
+            return self.word_embeds(sentences, attention_mask=attention_mask).last_hidden_state
+        if frozen_hidden is None:
+            frozen_hidden = self.frozen_features(sentences, attention_mask)
+        return self._run_layers(
+            frozen_hidden,
+            self.word_embeds.encoder.layer[self.frozen_layers:],
+            self._extended_attention_mask(sentences, attention_mask)
+        )
+
+    def _get_lstm_features(self, sentences, attention_mask=None, frozen_hidden=None):
+        """
+        :param sentences       [B, L]
+        :param attention_mask  [B, L] 给出时 <pad> 不参与 BERT attention, LSTM 按实际长度打包
+        :param frozen_hidden   [B, L, 768] 缓存的冻结层输出, 仅在冻结了 BERT 前若干层时使用
+        """
         # self.hidden = self._init_hidden()
         # print('sentence:  ', type(sentences))
         # print(sentences.device)
         # embeds = self.word_embeds(sentences).last_hidden_state[:, 1:-1, :]
-        embeds = self.word_embeds(sentences).last_hidden_state
+        embeds = self._bert_features(sentences, attention_mask, frozen_hidden)
         # print(embeds.shape)
-        lstm_out, _ = self.bilstm(embeds)
+        if attention_mask is None:
+            lstm_out, _ = self.bilstm(embeds)
+        else:
+            lengths = attention_mask.sum(dim=1).cpu()
+            packed = pack_padded_sequence(embeds, lengths, batch_first=True, enforce_sorted=False)
+            lstm_out, _ = self.bilstm(packed)
+            lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=sentences.shape[1])
         lstm_feats = self.hidden2tag(lstm_out)
         return lstm_feats
 
-    def forward(self, sentences):
+    def forward(self, sentences, attention_mask=None, frozen_hidden=None):
         # B, L, out_size(tagset_size)
-        emission =  self._get_lstm_features(sentences)
+        emission =  self._get_lstm_features(sentences, attention_mask, frozen_hidden)
 
         # calculate CRF scores 这个scores的大小为[B, L, out_size, out_size]
         # every Chinese Character map to a matrix of [tagset_size, tagset_size]
@@ -160,4 +224,40 @@ class BiLSTM_CRF(nn.Module):
             best_path.append(backpointer[step, best_path[-1]].item())
         best_path.reverse()
 
-        return best_path
\ No newline at end of file
+        return best_path
+
+    def batch_viterbi_decoding(self, crf_scores, lengths):
+        """batch viterbi decoding
+        超出实际长度的时间步保持 viterbi 不变且回溯指针指向自身,
+        每条序列最后一个字符继续转移到<end>标签得分最高的tag作为回溯起点
+        :param crf_scores  [B, L, T, T]
+        :param lengths     [B] 每条序列的实际长度
+        :return            LongTensor [B, L], 第 i 条序列的路径为 [i, :lengths[i]]"""
+        start_id = self.tag2id['<start>']
+        end_id = self.tag2id['<end>']
+
+        device = crf_scores.device
+        batch_size, max_len = crf_scores.shape[:2]
+        lengths = lengths.to(device)
+        identity = torch.arange(self.tagset_size, device=device).unsqueeze(0).expand(batch_size, -1)
+
+        # 第一个字
+        viterbi = crf_scores[:, 0, start_id, :]
+        backpointers = []
+        for step in range(1, max_len):
+            max_scores, prev_tags_id = torch.max(
+                viterbi.unsqueeze(2) + crf_scores[:, step, :, :],
+                dim=1
+            )
+            step_mask = (lengths > step).unsqueeze(1)
+            viterbi = torch.where(step_mask, max_scores, viterbi)
+            backpointers.append(torch.where(step_mask, prev_tags_id, identity))
+
+        best_tags = torch.argmax(viterbi + self.transition[:, end_id].unsqueeze(0), dim=1)
+        best_path = [best_tags]
+        for prev_tags_id in reversed(backpointers):
+            best_tags = prev_tags_id.gather(dim=1, index=best_tags.unsqueeze(1)).squeeze(1)
+            best_path.append(best_tags)
+        best_path.reverse()
+
+        return torch.stack(best_path, dim=1)
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class BiLSTM(nn.Module):
@@ -27,15 +28,24 @@ class BiLSTM(nn.Module):
         return (torch.randn(2, 1, self.hidden_dim // 2),
                 torch.randn(2, 1, self.hidden_dim // 2))
 
-    def _get_lstm_features(self, sentence):
+    def _get_lstm_features(self, sentence, lengths=None):
+        """
+        :param sentence [B, L]
+        :param lengths  [B] 每条序列的实际长度，给出时按实际长度打包，<pad> 不参与反向 LSTM 计算
+        """
         # self.hidden = self._init_hidden()
         embeds = self.word_embeds(sentence)
-        lstm_out, _ = self.bilstm(embeds)
+        if lengths is None:
+            lstm_out, _ = self.bilstm(embeds)
+        else:
+            packed = pack_padded_sequence(embeds, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            lstm_out, _ = self.bilstm(packed)
+            lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=sentence.shape[1])
         lstm_feats = self.hidden2tag(lstm_out)
         return lstm_feats
 
-    def forward(self, sentence):
-        return self._get_lstm_features(sentence)
+    def forward(self, sentence, lengths=None):
+        return self._get_lstm_features(sentence, lengths)
 
 def cal_loss(prediction, targets, tag2id):
     """损失计算
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from models.BiLSTM import BiLSTM
 
@@ -27,9 +28,9 @@ class BiLSTM_CRF(nn.Module):
         )
 
 
-    def forward(self, sentences):
+    def forward(self, sentences, lengths=None):
         # B, L, out_size(tagset_size)
-        emission =  self.bilstm._get_lstm_features(sentences)
+        emission =  self.bilstm._get_lstm_features(sentences, lengths)
 
         # calculate CRF scores 这个scores的大小为[B, L, out_size, out_size]
         # every Chinese Character map to a matrix of [tagset_size, tagset_size]
@@ -72,6 +73,47 @@ class BiLSTM_CRF(nn.Module):
 
         return best_path
 
+    def batch_viterbi_decoding(self, crf_scores, lengths):
+        """batch viterbi decoding
+        每个时间步对整个 batch 做一次 max/argmax, 超出实际长度的时间步
+        保持 viterbi 不变且回溯指针指向自身, 回溯全程在 crf_scores 所在设备上完成
+
+        :param crf_scores  [B, L, T, T]
+        :param lengths     [B] 每条序列的实际长度（包含句尾 <end>）
+        :return            LongTensor [B, L-1], 第 b 条序列的前 lengths[b]-1 个位置为最优路径
+        """
+        start_id = self.tag2id['<start>']
+        end_id = self.tag2id['<end>']
+
+        device = crf_scores.device
+        batch_size, max_len = crf_scores.shape[:2]
+        lengths = lengths.to(device)
+        identity = torch.arange(self.tagset_size, device=device).unsqueeze(0).expand(batch_size, -1)
+
+        # 第一个字
+        viterbi = crf_scores[:, 0, start_id, :]
+        backpointers = []
+        for step in range(1, max_len):
+            max_scores, prev_tags_id = torch.max(
+                viterbi.unsqueeze(2) + crf_scores[:, step, :, :],
+                dim=1
+            )
+            step_mask = (lengths > step).unsqueeze(1)
+            viterbi = torch.where(step_mask, max_scores, viterbi)
+            backpointers.append(torch.where(step_mask, prev_tags_id, identity))
+
+        # 每条序列均以 <end> 结尾, 由 <end> 开始回溯
+        best_tags = torch.full(size=(batch_size, ), fill_value=end_id, dtype=torch.long, device=device)
+        best_path = []
+        for prev_tags_id in reversed(backpointers):
+            best_tags = prev_tags_id.gather(dim=1, index=best_tags.unsqueeze(1)).squeeze(1)
+            best_path.append(best_tags)
+        best_path.reverse()
+
+        if not best_path:
+            return torch.zeros(size=(batch_size, 0), dtype=torch.long, device=device)
+        return torch.stack(best_path, dim=1)
+
     def loss(self, crf_scores, targets):
         """计算双向LSTM-CRF模型的损失
         以 batch 形式输入"""
@@ -134,3 +176,105 @@ class BiLSTM_CRF(nn.Module):
 
         loss = (all_scores - gold_score) / batch_size
         return loss
+
+
+class BiLSTM_CRF_Lean(BiLSTM_CRF):
+    """省内存的 CRF 实现
+    forward 只返回 [B, L, T] 的发射分数, 转移分数始终为单个 [T, T] 矩阵,
+    不再展开 [B, L, T, T] 的 crf_scores, 峰值显存约降低为原来的 1/T。
+    参数与 BiLSTM_CRF 完全相同, 损失与解码结果保持一致"""
+
+    def forward(self, sentences, lengths=None):
+        # B, L, out_size(tagset_size)
+        return self.bilstm._get_lstm_features(sentences, lengths)
+
+    def _step_scores(self, emission_step):
+        """单个时间步的 crf 分数 [B, T, T], 与 BiLSTM_CRF.forward 中的计算方式相同"""
+        return emission_step.unsqueeze(1) + self.transition.unsqueeze(0)
+
+    def viterbi_decoding(self, emission):
+        """viterbi decoding
+        不支持 batch
+        :param emission [L, T]"""
+        lengths = torch.tensor([emission.shape[0]], dtype=torch.long)
+        return self.batch_viterbi_decoding(emission.unsqueeze(0), lengths)[0].tolist()
+
+    def batch_viterbi_decoding(self, emission, lengths):
+        """batch viterbi decoding
+        :param emission  [B, L, T]
+        :param lengths   [B] 每条序列的实际长度（包含句尾 <end>）
+        :return          LongTensor [B, L-1]"""
+        start_id = self.tag2id['<start>']
+        end_id = self.tag2id['<end>']
+
+        device = emission.device
+        batch_size, max_len = emission.shape[:2]
+        lengths = lengths.to(device)
+        identity = torch.arange(self.tagset_size, device=device).unsqueeze(0).expand(batch_size, -1)
+
+        # 第一个字
+        viterbi = self._step_scores(emission[:, 0])[:, start_id, :]
+        backpointers = []
+        for step in range(1, max_len):
+            max_scores, prev_tags_id = torch.max(
+                viterbi.unsqueeze(2) + self._step_scores(emission[:, step]),
+                dim=1
+            )
+            step_mask = (lengths > step).unsqueeze(1)
+            viterbi = torch.where(step_mask, max_scores, viterbi)
+            backpointers.append(torch.where(step_mask, prev_tags_id, identity))
+
+        best_tags = torch.full(size=(batch_size, ), fill_value=end_id, dtype=torch.long, device=device)
+        best_path = []
+        for prev_tags_id in reversed(backpointers):
+            best_tags = prev_tags_id.gather(dim=1, index=best_tags.unsqueeze(1)).squeeze(1)
+            best_path.append(best_tags)
+        best_path.reverse()
+
+        if not best_path:
+            return torch.zeros(size=(batch_size, 0), dtype=torch.long, device=device)
+        return torch.stack(best_path, dim=1)
+
+    def _log_sum_exp_step(self, current_scores, emission_step):
+        """前向算法的单步递推, 广播得到的 [B, T, T] 只在本步内存在"""
+        return torch.logsumexp(
+            current_scores.unsqueeze(2) + self._step_scores(emission_step),
+            dim=1
+        )
+
+    def loss(self, emission, targets):
+        """计算双向LSTM-CRF模型的损失
+        以 batch 形式输入
+        :param emission [B, L, T]
+        :param targets  [B, L]"""
+        pad_id = self.tag2id.get('<pad>')
+        start_id = self.tag2id.get('<start>')
+        end_id = self.tag2id.get('<end>')
+
+        mask = (targets != pad_id)
+        batch_size, max_len = targets.size()
+        lengths = mask.sum(dim=1)
+
+        # Golden scores 正确标签得分的和
+        # 当前字正确标签的发射分数 + 前一个字正确标签转移到当前字正确标签的转移分数
+        former_targets = torch.zeros_like(targets)
+        former_targets[:, 0] = start_id
+        former_targets[:, 1:max_len] = targets[:, 0:max_len-1]
+
+        emission_j = emission.gather(dim=2, index=targets.unsqueeze(-1)).squeeze(-1)
+        crf_score_i_j = emission_j + self.transition[former_targets, targets]
+        gold_score = crf_score_i_j.masked_select(mask).sum()
+
+        # 计算所有可能的值的和
+        # 每一步重新计算 [B, T, T] 的中间结果, 反向传播时不保存, 只保留 [B, T] 的递推状态
+        current_scores = self._step_scores(emission[:, 0])[:, start_id, :]
+        for step in range(1, max_len):
+            if torch.is_grad_enabled():
+                next_scores = checkpoint(self._log_sum_exp_step, current_scores, emission[:, step], use_reentrant=False)
+            else:
+                next_scores = self._log_sum_exp_step(current_scores, emission[:, step])
+            current_scores = torch.where((lengths > step).unsqueeze(1), next_scores, current_scores)
+        all_scores = current_scores[:, end_id].sum()
+
+        loss = (all_scores - gold_score) / batch_size
+        return loss
@@ -1,5 +1,15 @@
+import os
+import pickle
+import hashlib
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 from sklearn_crfsuite import CRF
 
+# word2features 有变动时需要递增, 使旧的特征缓存失效
+FEATURE_VERSION = 1
+
 class CRFModel:
 
     def __init__(
@@ -8,13 +18,29 @@ class CRFModel:
         c1=0.1, 
         c2=0.1, 
         max_iterations=100, 
-        all_possible_transitions=False):
+        all_possible_transitions=False,
+        n_jobs=1,
+        chunk_size=1000,
+        cache_dir=None):
         self.model = CRF(
             algorithm=algorithm,
             c1=c1,
             c2=c2,
             max_iterations=max_iterations,
             all_possible_states=all_possible_transitions)
+        # 特征抽取的进程数、每个任务的句子数以及特征缓存目录
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
+
+    def _features(self, sentences):
+        """流式生成每个句子的特征, CRF.fit/predict 逐句消费, 整个特征列表不会同时驻留内存"""
+        return extract_features(
+            sentences,
+            n_jobs=getattr(self, 'n_jobs', 1),
+            chunk_size=getattr(self, 'chunk_size', 1000),
+            cache_dir=getattr(self, 'cache_dir', None)
+        )
 
     def train(self, sentences, tag_lists):
         """训练模型
@@ -22,12 +48,10 @@ class CRFModel:
         :param sentences --> train_word_lists is a list of lists of sentence
         :param tag_lists --> train_tag_lists
         """
-        features = [sent2features(sent) for sent in sentences]
-        self.model.fit(features, tag_lists)
+        self.model.fit(self._features(sentences), tag_lists)
 
     def test(self,sentences):
-        features = [sent2features(s) for s in sentences]
-        pred_tag_lists = self.model.predict(features)
+        pred_tag_lists = self.model.predict(self._features(sentences))
         return pred_tag_lists
 
 def word2features(sent, i):
@@ -49,5 +73,108 @@ def word2features(sent, i):
     return feature
 
 def sent2features(sent):
-    """抽取序列特征"""
-    return [word2features(sent, i) for i in range(len(sent))]
\ No newline at end of file
+    """抽取序列特征
+    与逐字调用 word2features 的结果相同, 一次性错位得到前后字, 避免逐字下标访问"""
+    sent = list(sent)
+    prev_words = ["<s>"] + sent[:-1]
+    next_words = sent[1:] + ["</s>"]
+    return [
+        {
+            'w': word,
+            'w-1': prev_word,
+            'w+1': next_word,
+            'w-1:w': prev_word + word,
+            'w:w+1': word + next_word,
+            'bias': 1
+        }
+        for prev_word, word, next_word in zip(prev_words, sent, next_words)
+    ]
+
+def _chunk_features(chunk):
+    """工作进程中抽取一批句子的特征"""
+    return [sent2features(sent) for sent in chunk]
+
+def _chunks(sentences, chunk_size):
+    chunk = []
+    for sent in sentences:
+        chunk.append(sent)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_feature_chunks(sentences, n_jobs=1, chunk_size=1000):
+    """按 chunk 流式抽取特征
+    n_jobs > 1 时在进程池中并行抽取, 同时在途的 chunk 不超过 2 * n_jobs 个,
+    按输入顺序产出, 内存占用与语料大小无关"""
+    if n_jobs <= 1:
+        for chunk in _chunks(sentences, chunk_size):
+            yield _chunk_features(chunk)
+        return
+
+    with ProcessPoolExecutor(n_jobs) as executor:
+        pending = deque()
+        for chunk in _chunks(sentences, chunk_size):
+            pending.append(executor.submit(_chunk_features, chunk))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def corpus_hash(sentences):
+    """语料的哈希值, 作为特征缓存的键"""
+    sha1 = hashlib.sha1(('v%d' % FEATURE_VERSION).encode('utf-8'))
+    for sent in sentences:
+        sha1.update('\x1f'.join(sent).encode('utf-8'))
+        sha1.update(b'\x1e')
+    return sha1.hexdigest()
+
+def _read_cached_chunks(path):
+    index = 0
+    while True:
+        chunk_file = os.path.join(path, 'chunk_%06d.pkl' % index)
+        if not os.path.exists(chunk_file):
+            return
+        with open(chunk_file, 'rb') as f:
+            yield pickle.load(f)
+        index += 1
+
+def _write_cached_chunks(chunks, path):
+    """边生成边写入缓存, 全部写完后才重命名为正式目录"""
+    tmp_path = path + '.tmp%d' % os.getpid()
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        for index, chunk in enumerate(chunks):
+            with open(os.path.join(tmp_path, 'chunk_%06d.pkl' % index), 'wb') as f:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            yield chunk
+        if not os.path.isdir(path):
+            os.rename(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def extract_features(sentences, n_jobs=1, chunk_size=1000, cache_dir=None):
+    """逐句产出特征
+    给出 cache_dir 时以语料哈希为键缓存在磁盘上, 再次遇到相同语料时直接读取缓存,
+    此时需要先遍历一遍语料计算哈希, sentences 须为可重复遍历的序列(如 list), 不能是生成器等迭代器"""
+    if cache_dir is not None and iter(sentences) is sentences:
+        raise TypeError('sentences must be a re-iterable sequence when cache_dir is given, got %s'
+                        % type(sentences).__name__)
+    if cache_dir is None:
+        if n_jobs <= 1:
+            # 单进程时逐句生成, 不必攒 chunk
+            for sent in sentences:
+                yield sent2features(sent)
+            return
+        chunks = iter_feature_chunks(sentences, n_jobs, chunk_size)
+    else:
+        path = os.path.join(cache_dir, corpus_hash(sentences))
+        if os.path.isdir(path):
+            chunks = _read_cached_chunks(path)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            chunks = _write_cached_chunks(iter_feature_chunks(sentences, n_jobs, chunk_size), path)
+    for chunk in chunks:
+        yield from chunk
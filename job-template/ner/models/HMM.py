@@ -13,6 +13,7 @@ class HMM:
         self.Pi = torch.zeros(size=(self.N, ))             # 初始概率分布
         self.A = torch.zeros(size=(self.N, self.N))      # 状态转移概率分布
         self.B = torch.zeros(size=(self.N, self.M))      # 观测概率分布
+        self._log_params = None                          # 缓存取对数后的 Pi A B
 
     def train(self, word_lists, tag_lists, word2id, tag2id):
         """训练算法：根据训练数据学习HMM模型的参数 Pi、 A、 B
@@ -25,51 +26,102 @@ class HMM:
         :param word2id     词典，词汇表（以 单个汉字 为颗粒度）
         :param tag2id      字典，标签表
         """
+        word_ids, tag_ids, lengths = self.encode_corpus(word_lists, tag_lists, word2id, tag2id)
+        self.train_from_counts(self.count(word_ids, tag_ids, lengths))
+
+        # print('N', self.N)
+        # print('M', self.M)
+        # print('Pi', self.Pi)
+        # print('A', self.A)
+        # print('B', self.B)
+
+
+    @staticmethod
+    def encode_corpus(word_lists, tag_lists, word2id, tag2id):
+        """将嵌套列表形式的语料一次性转换为扁平的 id 数组
+
+        :return word_ids  LongTensor [总字数]
+        :return tag_ids   LongTensor [总字数]
+        :return lengths   LongTensor [句子数]
+        """
         assert len(word_lists) == len(tag_lists)
+        word_ids = torch.tensor([word2id[word] for word_list in word_lists for word in word_list], dtype=torch.long)
+        tag_ids = torch.tensor([tag2id[tag] for tag_list in tag_lists for tag in tag_list], dtype=torch.long)
+        lengths = torch.tensor([len(tag_list) for tag_list in tag_lists], dtype=torch.long)
+        assert len(word_ids) == len(tag_ids)
+        return word_ids, tag_ids, lengths
+
+    def count(self, word_ids, tag_ids, lengths):
+        """根据扁平 id 数组统计 Pi、A、B 的频数，不做平滑和归一化
+        各分片语料可分别统计后用 merge_counts 合并
+
+        :return (Pi_count [N], A_count [N, N], B_count [N, M])
+        """
+        lengths = lengths[lengths > 0]
+        offsets = torch.cumsum(lengths, dim=0) - lengths
+
+        # Pi 每个句子第一个字的标签
+        Pi_count = torch.bincount(tag_ids[offsets], minlength=self.N)
+
+        # A 相邻两个字的标签组成二元组，跨句子的二元组不参与统计
+        bigram_mask = torch.ones(max(len(tag_ids) - 1, 0), dtype=torch.bool)
+        bigram_mask[offsets[1:] - 1] = False
+        bigram = tag_ids[:-1][bigram_mask] * self.N + tag_ids[1:][bigram_mask]
+        A_count = torch.bincount(bigram, minlength=self.N * self.N).view(self.N, self.N)
+
+        # B 标签-字 二元组
+        emission = tag_ids * self.M + word_ids
+        B_count = torch.bincount(emission, minlength=self.N * self.M).view(self.N, self.M)
+
+        return Pi_count, A_count, B_count
+
+    @staticmethod
+    def merge_counts(counts_list):
+        """合并多个分片统计得到的频数"""
+        return tuple(torch.stack(counts).sum(dim=0) for counts in zip(*counts_list))
+
+    def train_from_counts(self, counts):
+        """由频数估计 Pi、A、B，频数为 0 的位置平滑为 1e-10"""
+        Pi_count, A_count, B_count = counts
 
         # Pi 估计初始概率分布
-        for tag_list in tag_lists:
-            # 统计 累加
-            tag_idx = tag2id[tag_list[0]]
-            self.Pi[tag_idx] += 1
-        # smoth 平滑
+        self.Pi = Pi_count.float()
         self.Pi[self.Pi==0] = 1e-10
-        # 计算概率
         self.Pi = self.Pi / self.Pi.sum()
 
         # A 估计状态转移概率分布
-        for tag_list in tag_lists:
-            seq_len = len(tag_list)
-            for i in range(seq_len-1):
-                current_tag_idx = tag2id[tag_list[i]]
-                next_tag_idx = tag2id[tag_list[i+1]]
-                self.A[current_tag_idx][next_tag_idx] += 1
+        self.A = A_count.float()
         self.A[self.A==0.] = 1e-10
         self.A = self.A / torch.sum(self.A, dim=1, keepdim=True)
 
         # B 估计观测概率分布
-        for word_list, tag_list in zip(word_lists, tag_lists):
-            for word, tag in zip(word_list, tag_list):
-                word_idx = word2id[word]
-                tag_idx = tag2id[tag]
-                self.B[tag_idx][word_idx] += 1
+        self.B = B_count.float()
         self.B[self.B==0.] = 1e-10
         self.B = self.B / torch.sum(self.B, dim=1, keepdim=True)
+        # 参数已更新，清空对数参数缓存
+        self._log_params = None
 
-        # print('N', self.N)
-        # print('M', self.M)
-        # print('Pi', self.Pi)
-        # print('A', self.A)
-        # print('B', self.B)
+    def _get_log_params(self):
+        """将 Pi A B 取对数，可以将乘法转换为加法，log(ab) == log(a) + log(b)
+        训练完成后只计算一次并缓存，解码时直接复用
 
+        :return Pi  [N]
+        :return A   [N, N]
+        :return B   [N, M + 1]  最后一列对应词表外的字，取值为 1/N
+        """
+        if getattr(self, '_log_params', None) is None:
+            unk = torch.ones(size=(self.N, 1)) / self.N
+            self._log_params = (
+                torch.log(self.Pi),
+                torch.log(self.A),
+                torch.cat([torch.log(self.B), unk], dim=1)
+            )
+        return self._log_params
 
     def _viterbi_decoding(self, word_list, word2id, tag2id):
         
-        # 将 Pi A B 取对数，可以将乘风转换为加法，
-        # log(ab) == log(a) + log(b)
-        Pi = torch.log(self.Pi)
-        A = torch.log(self.A)
-        B = torch.log(self.B)
+        # 取对数后的 Pi A B
+        Pi, A, B = self._get_log_params()
         
         # viterbi矩阵      --> 《统计学习》例10.3中的 lambda函数
         # backpointer矩阵  --> 《统计学习》例10.3中的 psi函数
@@ -112,15 +164,65 @@ class HMM:
 
         return best_path
 
-    def test(self, word_lists, word2id, tag2id):
-        pre_tag_lists = []
+    def batch_viterbi_decoding(self, word_ids, lengths):
+        """batch 维特比解码，每个时间步对整个 batch 做一次 [B, N, N] 的 max/argmax
+
+        :param word_ids  LongTensor [B, L]，词表外的字取值为 M，<pad> 位置取任意合法值
+        :param lengths   LongTensor [B]，每条序列的实际长度
+        :return          LongTensor [B, L]，每条序列前 lengths[b] 个位置为最优路径
+        """
+        Pi, A, B = self._get_log_params()
+        batch_size, max_len = word_ids.shape
+
+        # 发射分数 [B, L, N]
+        emission = B.t()[word_ids]
+        # 超出实际长度的时间步不更新 viterbi，回溯指针指向自身
+        mask = torch.arange(max_len).unsqueeze(0) < lengths.unsqueeze(1)
+        identity = torch.arange(self.N).unsqueeze(0).expand(batch_size, -1)
+
+        # 初始化
+        viterbi = Pi.unsqueeze(0) + emission[:, 0]
+        backpointers = []
+
+        # 递推
+        for step in range(1, max_len):
+            # [B, N(前一时刻), N(当前时刻)]
+            scores = viterbi.unsqueeze(2) + A.unsqueeze(0)
+            max_scores, prev_tags = torch.max(scores, dim=1)
+            step_mask = mask[:, step].unsqueeze(1)
+            viterbi = torch.where(step_mask, max_scores + emission[:, step], viterbi)
+            backpointers.append(torch.where(step_mask, prev_tags, identity))
+
+        # 回溯
+        best_tag = torch.argmax(viterbi, dim=1)
+        best_path = [best_tag]
+        for prev_tags in reversed(backpointers):
+            best_tag = prev_tags.gather(1, best_tag.unsqueeze(1)).squeeze(1)
+            best_path.append(best_tag)
+        best_path.reverse()
+
+        return torch.stack(best_path, dim=1)
+
+    def test(self, word_lists, word2id, tag2id, batch_size=512):
+        """按句子长度排序后分 batch 解码，结果按输入顺序返回"""
+        pre_tag_lists = [None] * len(word_lists)
         id2tag = dict((id, tag) for tag, id in tag2id.items())
-        for word_list in word_lists:
-            predict_path = self._viterbi_decoding(word_list, word2id, tag2id)
-            
+        indices = sorted(range(len(word_lists)), key=lambda x: len(word_lists[x]))
+
+        for start in range(0, len(indices), batch_size):
+            batch_indices = indices[start: start + batch_size]
+            lengths = torch.tensor([len(word_lists[i]) for i in batch_indices], dtype=torch.long)
+            max_len = max(int(lengths.max()), 1)
+            # 词表外的字映射为 M，<pad> 位置同样填 M
+            word_ids = torch.full(size=(len(batch_indices), max_len), fill_value=self.M, dtype=torch.long)
+            for row, i in enumerate(batch_indices):
+                ids = [word2id.get(word, self.M) for word in word_lists[i]]
+                word_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+
+            predict_paths = self.batch_viterbi_decoding(word_ids, lengths).tolist()
+
             # 将tag_id组成的best_path转换为对应的tag
-            assert len(predict_path) == len(word_list)
-            predict_tag = [id2tag[tag_id] for tag_id in predict_path]
-            
-            pre_tag_lists.append(predict_tag)
+            for row, i in enumerate(batch_indices):
+                predict_path = predict_paths[row][:len(word_lists[i])]
+                pre_tag_lists[i] = [id2tag[tag_id] for tag_id in predict_path]
         return pre_tag_lists
\ No newline at end of file
@@ -0,0 +1,253 @@
+import os
+import sys
+
+dir_common = os.path.split(os.path.realpath(__file__))[0]
+sys.path.append(dir_common)   # 将NER根目录添加到系统目录, pickle 才能找到模型类
+import argparse
+import asyncio
+import logging
+import pickle
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from aiohttp import web
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="NER batched inference server")
+    parser.add_argument('-pp', "--pklpath", type=str, default='./model.pkl', help='the .pkl file written by save_model, or a .pt file written by export.py')
+    parser.add_argument('-H', '--host', type=str, default='0.0.0.0', help='listen host')
+    parser.add_argument('-P', '--port', type=int, default=8080, help='listen port')
+    parser.add_argument('-mb', '--max_batch_size', type=int, default=64, help='max sentences per micro-batch')
+    parser.add_argument('-ml', '--max_latency_ms', type=float, default=10, help='max time to wait for a micro-batch to fill')
+    parser.add_argument('-mq', '--max_queue', type=int, default=1024, help='max sentences waiting for a micro-batch, requests beyond it get 503')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='torch intra-op threads, 0 keeps the torch default')
+    return parser.parse_args()
+
+
+def load_model(file_name):
+    """加载 save_model 保存的模型, 模型需提供 predict_batch(sentences, batch_size)
+    .pt 文件为 export.py 导出的 TorchScript 模型"""
+    if file_name.endswith('.pt'):
+        from export import ExportedNER
+        return ExportedNER(file_name)
+    with open(file_name, 'rb') as f:
+        model = pickle.load(f)
+    if not hasattr(model, 'predict_batch'):
+        raise ValueError('%s does not support batched prediction' % type(model).__name__)
+    return model
+
+
+class SlidingStats(object):
+    """最近 window 个观测值的分位数, 以及全部观测值的计数与求和"""
+
+    def __init__(self, window=10000):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.values:
+            return float('nan')
+        return float(np.percentile(np.fromiter(self.values, dtype=np.float64), q * 100))
+
+    def render(self, name, description, quantiles=(0.5, 0.99)):
+        """Prometheus summary 格式"""
+        lines = ['# HELP %s %s' % (name, description), '# TYPE %s summary' % name]
+        for q in quantiles:
+            lines.append('%s{quantile="%s"} %s' % (name, q, self.quantile(q)))
+        lines.append('%s_sum %s' % (name, self.sum))
+        lines.append('%s_count %s' % (name, self.count))
+        return '\n'.join(lines)
+
+
+class MicroBatcher(object):
+    """动态微批
+    并发请求先进入队列, 攒够 max_batch_size 条或等待超过 max_latency_ms 后
+    合并为一个 batch, 在单独的线程中做一次 no_grad 前向与批量解码,
+    再把结果分发回各个请求。模型计算期间事件循环继续接收下一个 batch 的请求。
+    队列中最多有 max_queue 条文本, 放不下时整个请求被拒绝(asyncio.QueueFull)"""
+
+    def __init__(self, predict_fn, max_batch_size=64, max_latency_ms=10, max_queue=1024):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latency = SlidingStats()
+        self.batch_size = SlidingStats()
+        self.rejected = 0
+        self._pending = set()      # 还没有返回结果的请求
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        """停止微批, 还在等待结果的请求以异常结束"""
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+        for future in list(self._pending):
+            if not future.done():
+                future.set_exception(RuntimeError('server is shutting down'))
+        self._pending.clear()
+
+    async def submit(self, sentences):
+        """提交一个请求中的所有文本, 返回各自的标签序列
+        队列放不下全部文本时一条也不放入, 抛出 asyncio.QueueFull"""
+        if self.queue.maxsize and self.queue.qsize() + len(sentences) > self.queue.maxsize:
+            self.rejected += 1
+            raise asyncio.QueueFull()
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for _ in sentences]
+        start = time.perf_counter()
+        for sentence, future in zip(sentences, futures):
+            self._pending.add(future)
+            future.add_done_callback(self._pending.discard)
+            self.queue.put_nowait((sentence, future))
+        results = await asyncio.gather(*futures)
+        self.latency.observe(time.perf_counter() - start)
+        return results
+
+    async def _collect(self):
+        """等待第一条请求, 之后在 max_latency 内尽量攒满一个 batch"""
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            sentences = [sentence for sentence, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict_fn, sentences)
+            except Exception as e:
+                logging.exception('batch predict failed')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_size.observe(len(batch))
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def render_metrics(self):
+        return '\n'.join([
+            self.latency.render('ner_request_latency_seconds', 'latency of a request from enqueue to result'),
+            self.batch_size.render('ner_batch_size', 'number of sentences per micro-batch'),
+            '# HELP ner_queue_depth sentences waiting for a micro-batch',
+            '# TYPE ner_queue_depth gauge',
+            'ner_queue_depth %d' % self.queue.qsize(),
+            '# HELP ner_rejected_requests_total requests rejected with 503 because the queue was full',
+            '# TYPE ner_rejected_requests_total counter',
+            'ner_rejected_requests_total %d' % self.rejected,
+        ]) + '\n'
+
+
+routes = web.RouteTableDef()
+
+
+@routes.post('/predict')
+async def predict(request):
+    """请求体 {"sentence": "..."} 或 {"sentences": ["...", ...]}
+    请求格式错误时返回 400, 文本数超过队列长度时返回 413, 队列暂时已满时返回 503"""
+    try:
+        data = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text='invalid json')
+    batcher = request.app['batcher']
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest(text='need a json object')
+    if 'sentences' in data:
+        sentences = data['sentences']
+        if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+            raise web.HTTPBadRequest(text='"sentences" must be a list of strings')
+    elif 'sentence' in data:
+        sentences = [data['sentence']]
+        if not isinstance(sentences[0], str):
+            raise web.HTTPBadRequest(text='"sentence" must be a string')
+    else:
+        raise web.HTTPBadRequest(text='need "sentence" or "sentences"')
+
+    # 空文本无需进入模型
+    sentences_to_predict = [sentence for sentence in sentences if sentence]
+    # 超过队列长度的请求重试也不可能放下
+    if batcher.queue.maxsize and len(sentences_to_predict) > batcher.queue.maxsize:
+        raise web.HTTPRequestEntityTooLarge(
+            max_size=batcher.queue.maxsize, actual_size=len(sentences_to_predict),
+            text='at most %d non-empty sentences per request' % batcher.queue.maxsize)
+    try:
+        results = await batcher.submit(sentences_to_predict)
+    except asyncio.QueueFull:
+        raise web.HTTPServiceUnavailable(text='too many pending sentences, retry later')
+    results = iter(results)
+    tags = [next(results) if sentence else [] for sentence in sentences]
+    if 'sentences' in data:
+        return web.json_response({'tags': tags})
+    return web.json_response({'tags': tags[0]})
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    return web.Response(text=request.app['batcher'].render_metrics(), content_type='text/plain')
+
+
+@routes.get('/health')
+async def health(request):
+    return web.Response(text='ok')
+
+
+def build_app(model, max_batch_size=64, max_latency_ms=10, max_queue=1024):
+    batcher = MicroBatcher(
+        predict_fn=lambda sentences: model.predict_batch(sentences, batch_size=len(sentences)),
+        max_batch_size=max_batch_size,
+        max_latency_ms=max_latency_ms,
+        max_queue=max_queue
+    )
+
+    async def on_startup(app):
+        batcher.start()
+
+    async def on_cleanup(app):
+        await batcher.stop()
+
+    app = web.Application()
+    app['batcher'] = batcher
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = load_model(args.pklpath)
+    logging.info('loaded %s from %s' % (type(model).__name__, args.pklpath))
+    web.run_app(build_app(model, args.max_batch_size, args.max_latency_ms, args.max_queue), host=args.host, port=args.port)
@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+from array import array
+
+import numpy as np
+
+
+class CorpusCache:
+    """
+    标注语料的流式读取与二进制缓存：
+        单次遍历原始标注文件（每行 "字 标签", 空行分隔句子）, 同时完成
+        字/标签编码、计数, 以及划分训练集、验证集、测试集所需的句子偏移
+        缓存文件：
+            words.npy        uint32  所有句子的字id首尾相接
+            tags.npy         uint8   所有句子的标签id首尾相接
+            offsets.npy      int64   第 i 句为 [offsets[i], offsets[i+1])
+            word_seen.npy    uint32  读完第 i 句时出现过的不同字的数量
+            tag_seen.npy     uint8   读完第 i 句时出现过的不同标签的数量
+            word_counts.npy / tag_counts.npy  字/标签出现次数
+            id2word.txt / id2tag.txt          按首次出现顺序排列的字/标签
+        之后的运行直接以 mmap 方式加载, 不再解析文本
+    """
+
+    VERSION = 1
+    ARRAYS = ('words', 'tags', 'offsets', 'word_seen', 'tag_seen', 'word_counts', 'tag_counts')
+
+    def __init__(self, file_path: str, file_name: str, cache_dir: str = None) -> None:
+        self.file_path = file_path
+        self.file_name = file_name
+        self.source = os.path.join(file_path, file_name)
+        self.cache_dir = cache_dir or self.source + '.cache'
+
+    def _fingerprint(self):
+        stat = os.stat(self.source)
+        return {'version': self.VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def _is_valid(self):
+        meta_file = os.path.join(self.cache_dir, 'meta.json')
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file, 'r') as f:
+            return json.load(f) == self._fingerprint()
+
+    def load_or_build(self):
+        """缓存与原始文件一致时直接加载, 否则重新构建"""
+        if not self._is_valid():
+            self.build()
+        return self.load()
+
+    def build(self):
+        """单次遍历原始文件, 写出二进制缓存"""
+        word2id, tag2id = {}, {}
+        word_counts, tag_counts = [], []
+        words, tags = array('I'), array('B')
+        offsets, word_seen, tag_seen = array('q', [0]), array('I'), array('B')
+        skipped = 0
+
+        def end_sentence():
+            if len(words) > offsets[-1]:
+                offsets.append(len(words))
+                word_seen.append(len(word2id))
+                tag_seen.append(len(tag2id))
+
+        with open(self.source, 'r', encoding='utf-8') as file:
+            for line in file:
+                char_tag = line.split()
+                if not char_tag:
+                    end_sentence()
+                    continue
+                if len(char_tag) != 2:
+                    skipped += 1
+                    continue
+                char, tag = char_tag
+
+                word_id = word2id.get(char)
+                if word_id is None:
+                    word_id = word2id[char] = len(word2id)
+                    word_counts.append(0)
+                word_counts[word_id] += 1
+
+                tag_id = tag2id.get(tag)
+                if tag_id is None:
+                    if len(tag2id) > np.iinfo(np.uint8).max:
+                        raise ValueError('more than %d labels in %s' % (np.iinfo(np.uint8).max + 1, self.source))
+                    tag_id = tag2id[tag] = len(tag2id)
+                    tag_counts.append(0)
+                tag_counts[tag_id] += 1
+
+                words.append(word_id)
+                tags.append(tag_id)
+            end_sentence()
+        if skipped:
+            print('跳过格式错误的行数：', skipped)
+
+        # 先写入临时目录, 完成后再替换, 避免中断时留下不完整的缓存
+        tmp_dir = self.cache_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        arrays = {
+            'words': np.frombuffer(words, dtype=np.uint32),
+            'tags': np.frombuffer(tags, dtype=np.uint8),
+            'offsets': np.frombuffer(offsets, dtype=np.int64),
+            'word_seen': np.frombuffer(word_seen, dtype=np.uint32),
+            'tag_seen': np.frombuffer(tag_seen, dtype=np.uint8),
+            'word_counts': np.asarray(word_counts, dtype=np.int64),
+            'tag_counts': np.asarray(tag_counts, dtype=np.int64),
+        }
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), values)
+        with open(os.path.join(tmp_dir, 'id2word.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(word2id))
+        with open(os.path.join(tmp_dir, 'id2tag.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(tag2id))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(self._fingerprint(), f)
+
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.rename(tmp_dir, self.cache_dir)
+        print('样本数量：', len(offsets) - 1)
+        print('字数：', len(words))
+
+    def load(self, mmap_mode='r'):
+        """以 mmap 方式加载缓存"""
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(self.cache_dir, 'id2word.txt'), 'r', encoding='utf-8') as f:
+            self.id2word = f.read().split('\n') if len(self.word_counts) else []
+        with open(os.path.join(self.cache_dir, 'id2tag.txt'), 'r', encoding='utf-8') as f:
+            self.id2tag = f.read().split('\n') if len(self.tag_counts) else []
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def split_ranges(self, data_rate: list):
+        """按句子顺序划分 训练集 验证集 测试集, 返回各自的句子下标区间"""
+        assert len(data_rate) == 3 and abs(sum(data_rate) - 1) < 1e-6
+        n = len(self)
+        train_end = round(data_rate[0] * n)
+        dev_end = round((data_rate[0] + data_rate[1]) * n)
+        return {'train': (0, train_end), 'dev': (train_end, dev_end), 'test': (dev_end, n)}
+
+    def _decode(self, ids, id2token, start, end):
+        """将 [start, end) 句的 id 还原为 list of list 的字符串"""
+        offsets = self.offsets[start: end + 1]
+        tokens = np.asarray(id2token, dtype=object)[ids[offsets[0]: offsets[-1]]].tolist()
+        offsets = (offsets - offsets[0]).tolist()
+        return [tokens[offsets[i]: offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def build_corpus(self, split: str, data_rate: list, make_vocab=True):
+        """与 data.build_corpus 相同的返回格式
+        word2id/tag2id 只包含训练集中出现过的字/标签, 顺序为在训练集中首次出现的顺序"""
+        assert split.lower() in ["train", "dev", "test"]
+        start, end = self.split_ranges(data_rate)[split.lower()]
+        word_lists = self._decode(self.words, self.id2word, start, end)
+        tag_lists = self._decode(self.tags, self.id2tag, start, end)
+
+        if make_vocab:
+            # 训练集位于文件开头, 训练集中的字的全局id恰好为 [0, 训练集结束时出现过的字数)
+            train_end = self.split_ranges(data_rate)['train'][1]
+            n_words = int(self.word_seen[train_end - 1]) if train_end else 0
+            n_tags = int(self.tag_seen[train_end - 1]) if train_end else 0
+            word2id = {word: id for id, word in enumerate(self.id2word[:n_words])}
+            tag2id = {tag: id for id, tag in enumerate(self.id2tag[:n_tags])}
+            return word_lists, tag_lists, word2id, tag2id
+        else:
+            return word_lists, tag_lists
+
+    def write_vocabulary_labels(self):
+        """根据数量 降序 写入vocabulary.txt和labels.txt文件"""
+        word_order = np.argsort(-np.asarray(self.word_counts), kind='stable')
+        tag_order = np.argsort(-np.asarray(self.tag_counts), kind='stable')
+
+        with open(f'{self.file_path}vocabulary.txt', 'w') as vocabulary_file:
+            vocabulary_file.write('\n'.join(self.id2word[i] for i in word_order))
+        print('vocabulary.txt constructed')
+
+        with open(f'{self.file_path}labels.txt', 'w') as labels_file:
+            labels_file.write('\n'.join(self.id2tag[i] for i in tag_order))
+        print('labels.txt constructed')
+
+
+if __name__ == '__main__':
+    corpus = CorpusCache(file_path='./zdata/', file_name='annotated_data.txt').load_or_build()
+    corpus.write_vocabulary_labels()
@@ -1,44 +1,169 @@
-from inspect import classify_class_attrs
-from numpy import dtype
-from torch.utils.data import Dataset
+import numpy as np
 import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
+
+
+def pack_sequences(sequences, dtype=np.int64):
+    """将 list of list 的 id 序列打包为一维数组和偏移量
+    :return values   所有序列首尾相接的一维数组
+    :return offsets  第 i 条序列为 values[offsets[i]: offsets[i+1]]"""
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter((id for seq in sequences for id in seq), dtype=dtype, count=int(offsets[-1]))
+    return values, offsets
+
+
+def tokenize_words(word_lists, word2id):
+    """将 word 转换为 词表(word2id) 中对应的id, 以<pad>补齐至 batch 中最长序列的长度
+    :params word_lists    文本（以单个汉字为单位）序列    类型: python.List
+    :params word2id       词表, 须包含<pad>与<unk>
+    :return wordID_lists  文本id序列                    类型: pytorch.LongTensor [B, L]
+    :return lengths       每条序列的实际长度              类型: pytorch.LongTensor [B]
+    """
+    lengths = torch.tensor([len(word_list) for word_list in word_lists], dtype=torch.long)
+    wordID_lists = torch.full(size=(len(word_lists), int(lengths.max())), fill_value=word2id['<pad>'], dtype=torch.long)
+    for i, word_list in enumerate(word_lists):
+        wordID_lists[i, :len(word_list)] = torch.tensor(
+            [word2id.get(word, word2id['<unk>']) for word in word_list], dtype=torch.long
+        )
+    return wordID_lists, lengths
 
 class WordTagDataset(Dataset):
+    """预先编码好的 word/tag 数据集
+    整个语料只在构造时转换一次 id, 以一维数组加偏移量的形式保存,
+    __getitem__ 只做切片, 不再做 <pad> 填补, 填补由 PadCollate 按 batch 动态完成"""
 
-    def __init__(self, word_lists, tag_lists, vocabulary, tag2id) -> None:
-        super(WordTagDataset).__init__()
+    def __init__(self, word_lists, tag_lists, vocabulary, tag2id, max_len=None) -> None:
+        super(WordTagDataset, self).__init__()
         assert len(word_lists) == len(tag_lists)
 
-        # pairs = list(zip(word_lists,tag_lists))
-        # indices = sorted(range(len(pairs)),key=lambda x:len(pairs[x][0]),reverse=True)
-        # pairs = [pairs[i] for i in indices]
-        # self.word_lists, self.tag_lists = list(zip(*pairs))
+        unk_word = vocabulary['<unk>']
+        unk_tag = tag2id['<unk>']
+        word_ids, word_offsets = pack_sequences(
+            [[vocabulary.get(word, unk_word) for word in word_list[:max_len]] for word_list in word_lists]
+        )
+        tag_ids, tag_offsets = pack_sequences(
+            [[tag2id.get(tag, unk_tag) for tag in tag_list[:max_len]] for tag_list in tag_lists]
+        )
+        self._set_arrays(word_ids, word_offsets, tag_ids, tag_offsets)
+
+    @classmethod
+    def from_packed(cls, word_ids, word_offsets, tag_ids, tag_offsets):
+        """由已打包的 id 数组构造数据集, 如 BERT tokenizer 的输出"""
+        dataset = cls.__new__(cls)
+        dataset._set_arrays(word_ids, word_offsets, tag_ids, tag_offsets)
+        return dataset
 
-        self.word_lists = word_lists
-        self.tag_lists = tag_lists
-        self.vocabulary = vocabulary
-        self.tag2id = tag2id
+    def _set_arrays(self, word_ids, word_offsets, tag_ids, tag_offsets):
+        assert len(word_offsets) == len(tag_offsets)
+        self.word_ids = np.asarray(word_ids, dtype=np.int64)
+        self.word_offsets = np.asarray(word_offsets, dtype=np.int64)
+        self.tag_ids = np.asarray(tag_ids, dtype=np.int64)
+        self.tag_offsets = np.asarray(tag_offsets, dtype=np.int64)
+        # 为 True 时同时返回样本下标, 用于按样本查找缓存
+        self.return_index = False
+
+    @property
+    def lengths(self):
+        """每条序列的长度, 供 BucketBatchSampler 分桶使用"""
+        return np.diff(self.word_offsets)
 
     def __getitem__(self, index):
-        wordID_list = [self.vocabulary.get(word, self.vocabulary['<unk>']) for word in self.word_lists[index]]
-        tagID_list = [self.tag2id.get(tag, self.tag2id['<unk>']) for tag in self.tag_lists[index]]
-        MAX_PADDING = 64
-        seq_len = len(wordID_list)
-        if seq_len < MAX_PADDING:
-            for i in range(MAX_PADDING - seq_len):
-                wordID_list.append(self.vocabulary['<pad>'])
-                tagID_list.append(self.tag2id['<pad>'])
-        else:
-            wordID_list = wordID_list[0:MAX_PADDING]
-            tagID_list = tagID_list[0:MAX_PADDING]
-        # print(torch.tensor(wordID_list, dtype=torch.long))
-        # print(torch.tensor(tagID_list, dtype=torch.long))
-
-        return torch.tensor(wordID_list, dtype=torch.long), torch.tensor(tagID_list, dtype=torch.long)
+        word_start, word_end = self.word_offsets[index], self.word_offsets[index + 1]
+        tag_start, tag_end = self.tag_offsets[index], self.tag_offsets[index + 1]
+        if self.return_index:
+            return self.word_ids[word_start: word_end], self.tag_ids[tag_start: tag_end], index
+        return self.word_ids[word_start: word_end], self.tag_ids[tag_start: tag_end]
+
+    def __len__(self):
+        return len(self.word_offsets) - 1
+
 
+class BucketBatchSampler(Sampler):
+    """按序列长度分桶的 batch sampler
+    每个 epoch 先打乱样本, 再以 batch_size * bucket_size 个样本为一个桶,
+    桶内按长度排序后切分为 batch, 最后打乱 batch 的顺序。
+    同一个 batch 中的序列长度相近, 减少 <pad> 占位符的用量"""
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, drop_last=False, seed=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.rng = np.random.RandomState(seed)
+
+    def _batches(self):
+        if not self.shuffle:
+            # 不打乱时整体按长度降序, 与原先 _sort_by_sentence_lengths 的顺序一致
+            indices = np.argsort(-self.lengths, kind='stable')
+            return [indices[i: i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        indices = self.rng.permutation(len(self.lengths))
+        pool = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool):
+            bucket = indices[start: start + pool]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        self.rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for batch in self._batches():
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch.tolist()
 
     def __len__(self):
-        return len(self.word_lists)
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PadCollate(object):
+    """将一个 batch 的序列动态填补至该 batch 中最长序列的长度
+    batch 内按序列长度降序排列(CRF 损失按此顺序计算有效 batch)
+    :return wordID_lists  [B, L]
+    :return tagID_lists   [B, L]
+    :return lengths       [B] 每条序列的实际长度
+    :return indices       [B] 样本下标, 仅在 dataset.return_index 为 True 时返回"""
+
+    def __init__(self, word_pad_id, tag_pad_id):
+        self.word_pad_id = word_pad_id
+        self.tag_pad_id = tag_pad_id
+
+    def __call__(self, batch):
+        batch = sorted(batch, key=lambda item: len(item[0]), reverse=True)
+        max_len = max(max(len(item[0]), len(item[1])) for item in batch)
+
+        wordID_lists = np.full((len(batch), max_len), self.word_pad_id, dtype=np.int64)
+        tagID_lists = np.full((len(batch), max_len), self.tag_pad_id, dtype=np.int64)
+        lengths = np.empty(len(batch), dtype=np.int64)
+        for i, item in enumerate(batch):
+            words, tags = item[0], item[1]
+            wordID_lists[i, :len(words)] = words
+            tagID_lists[i, :len(tags)] = tags
+            lengths[i] = len(words)
+        collated = (torch.from_numpy(wordID_lists), torch.from_numpy(tagID_lists), torch.from_numpy(lengths))
+        if len(batch[0]) == 3:
+            collated += (torch.tensor([item[2] for item in batch], dtype=torch.long), )
+        return collated
 
 
-                
+def build_dataloader(dataset, batch_size, word_pad_id, tag_pad_id, shuffle=True, num_workers=2,
+                     bucket_size=100, pin_memory=None, seed=None):
+    """长度分桶 + 动态填补的 DataLoader
+    在 GPU 上训练时默认使用锁页内存, 配合 tensor.to(device, non_blocking=True) 异步拷贝"""
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    sampler = BucketBatchSampler(dataset.lengths, batch_size, shuffle=shuffle, bucket_size=bucket_size, seed=seed)
+    return DataLoader(
+        dataset,
+        batch_sampler=sampler,
+        collate_fn=PadCollate(word_pad_id, tag_pad_id),
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=num_workers > 0
+    )
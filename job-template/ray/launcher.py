@@ -12,6 +12,9 @@ k8s_client = K8s()
 import argparse, json
 import datetime, time
 import pysnooper
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
 
 # print(os.environ)
 base_dir = os.path.split(os.path.realpath(__file__))[0]
@@ -34,6 +37,9 @@ KFJ_TASK_VOLUME_MOUNT = os.getenv('KFJ_TASK_VOLUME_MOUNT', '')
 KFJ_TASK_RESOURCE_CPU = os.getenv('KFJ_TASK_RESOURCE_CPU', '')
 KFJ_TASK_RESOURCE_MEMORY = os.getenv('KFJ_TASK_RESOURCE_MEMORY', '')
 NUM_WORKER = 3
+MIN_WORKER = 0          # 快速启动时至少多少个worker加入集群后开始执行用户命令, 0时等待全部worker
+FAST_STARTUP = False
+STARTUP_TIMEOUT = 600
 RAY_HOST = f'ray-header-{KFJ_PIPELINE_NAME}-{KFJ_TASK_ID}'
 HEADER_NAME = RAY_HOST[0:54]
 WORKER_NAME = HEADER_NAME.replace('header', 'worker')
@@ -392,22 +398,132 @@ def create_worker_deploy(header_name,worker_name):
 
 
 # @pysnooper.snoop()
-def wait_for_nodes():
-    # Wait for all nodes to join the cluster.
+def wait_for_nodes(num_nodes_required=None, interval=1, timeout=None):
+    # Wait for all nodes (or num_nodes_required nodes) to join the cluster.
+    num_nodes_required = NUM_WORKER if num_nodes_required is None else num_nodes_required
+    deadline = time.time() + timeout if timeout is not None else None
     while True:
         resources = ray.cluster_resources()
         node_keys = [key for key in resources if "node" in key]
         num_nodes = sum(resources[node_key] for node_key in node_keys)
-        if num_nodes < NUM_WORKER:
-            print("{} nodes have joined so far, waiting for {} more.".format(num_nodes, NUM_WORKER - num_nodes))
+        if num_nodes < num_nodes_required:
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError("only {} nodes joined in {:.0f}s".format(num_nodes, timeout))
+            print("{} nodes have joined so far, waiting for {} more.".format(num_nodes, num_nodes_required - num_nodes))
             sys.stdout.flush()
-            time.sleep(1)
+            time.sleep(interval)
         else:
             break
 
 
+def run_concurrently(*calls):
+    # 并发执行k8s请求, 返回每个请求的异常, 成功时为None
+    def run(call):
+        try:
+            call()
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        return list(executor.map(run, calls))
+
+
+def watch_until(list_fn, name, condition, timeout):
+    # 先list一次, 不满足时从该resource_version开始watch, 直到condition(type, object)满足或超时
+    field_selector = 'metadata.name=%s' % name
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        objects = list_fn(KFJ_NAMESPACE, field_selector=field_selector)
+        if condition('LIST', objects.items[0] if objects.items else None):
+            return True
+        w = watch.Watch()
+        try:
+            for event in w.stream(list_fn, KFJ_NAMESPACE, field_selector=field_selector,
+                                  resource_version=objects.metadata.resource_version,
+                                  timeout_seconds=max(1, int(deadline - time.time()))):
+                if condition(event['type'], event['object']):
+                    w.stop()
+                    return True
+        except ApiException as e:
+            # resource_version 过期(410)时重新list
+            if e.status != 410:
+                raise
+        # apiserver 提前关闭了watch, 重新list
+    return False
+
+
+def wait_deleted(list_fn, name, timeout=60):
+    return watch_until(list_fn, name, lambda event_type, obj: obj is None or event_type == 'DELETED', timeout)
+
+
+def wait_deployment_ready(name, replicas, timeout=600):
+    def ready(event_type, deployment):
+        return event_type != 'DELETED' and deployment is not None and (deployment.status.ready_replicas or 0) >= replicas
+    return watch_until(k8s_client.AppsV1Api.list_namespaced_deployment, name, ready, timeout)
+
+
+def delete_cluster(wait=True):
+    # 并发删除header service、header deployment、worker deployment, wait时通过watch等待删除完成
+    print('begin delete ray cluster,%s ' % datetime.datetime.now())
+    errors = run_concurrently(
+        lambda: k8s_client.v1.delete_namespaced_service(HEADER_NAME, KFJ_NAMESPACE),
+        lambda: k8s_client.AppsV1Api.delete_namespaced_deployment(HEADER_NAME, KFJ_NAMESPACE),
+        lambda: k8s_client.AppsV1Api.delete_namespaced_deployment(WORKER_NAME, KFJ_NAMESPACE)
+    )
+    for e in errors:
+        if e is not None and getattr(e, 'status', None) != 404:
+            print(e)
+    if wait:
+        run_concurrently(
+            lambda: wait_deleted(k8s_client.v1.list_namespaced_service, HEADER_NAME),
+            lambda: wait_deleted(k8s_client.AppsV1Api.list_namespaced_deployment, HEADER_NAME),
+            lambda: wait_deleted(k8s_client.AppsV1Api.list_namespaced_deployment, WORKER_NAME)
+        )
+
+
+# @pysnooper.snoop()
+def launcher_cluster_fast(deal=None):
+    # 快速启动: 并发创建/删除, watch等待header就绪后立即连接, 达到MIN_WORKER个worker后即返回
+    # 删除旧集群、等待header就绪、等待worker加入共用一个STARTUP_TIMEOUT秒的期限
+    deadline = time.time() + STARTUP_TIMEOUT
+    delete_cluster(wait=deal == 'create')
+    if deal != 'create':
+        return
+
+    header_service = create_header_service(HEADER_NAME)
+    header_deploy = create_header_deploy(HEADER_NAME)
+    worker_deploy = create_worker_deploy(HEADER_NAME, WORKER_NAME)
+    try:
+        print('begin create ray cluster,%s ' % datetime.datetime.now())
+        errors = run_concurrently(
+            lambda: k8s_client.v1.create_namespaced_service(KFJ_NAMESPACE, header_service, pretty='true'),
+            lambda: k8s_client.AppsV1Api.create_namespaced_deployment(KFJ_NAMESPACE, header_deploy, pretty='true'),
+            lambda: k8s_client.AppsV1Api.create_namespaced_deployment(KFJ_NAMESPACE, worker_deploy, pretty='true')
+        )
+        for e in errors:
+            if e is not None:
+                raise e
+
+        if not wait_deployment_ready(HEADER_NAME, 1, max(0, deadline - time.time())):
+            raise TimeoutError('ray header not ready in %ss' % STARTUP_TIMEOUT)
+        header_host = "%s:10001" % HEADER_NAME
+        print('begin connect ray cluster %s,%s ' % (header_host, datetime.datetime.now()))
+        ray.util.connect(header_host, connection_retries=20)
+
+        # header 也是一个node
+        min_worker = MIN_WORKER if 0 < MIN_WORKER <= NUM_WORKER else NUM_WORKER
+        wait_for_nodes(min_worker + 1, interval=0.2, timeout=max(0, deadline - time.time()))
+        print('ray cluster %s workers ready,%s ' % (min_worker, datetime.datetime.now()))
+    except Exception as e:
+        print(e)
+        delete_cluster(wait=False)
+        # 如果出现错误，报错退出。不进行下一步代码
+        raise e
+
+
 # @pysnooper.snoop()
 def launcher_cluster(deal=None):
+    if FAST_STARTUP:
+        return launcher_cluster_fast(deal)
     # 清理一下之前存在的
     try:
         print('begin delete old header service')
@@ -485,6 +601,9 @@ if __name__ == '__main__':
     arg_parser.add_argument('--workdir', type=str, required=False, help="启动目录", default='/')
     arg_parser.add_argument('--init', type=str, required=False, help="每个worker的初始化脚本，用来安装环境", default='')
     arg_parser.add_argument('--command', type=str, help="运行job的命令", default='python3 mnist.py')
+    arg_parser.add_argument('--fast_startup', type=int, required=False, help="1时并发创建集群, 通过watch等待就绪", default=0)
+    arg_parser.add_argument('--min_workers', type=int, required=False, help="快速启动时至少多少个worker加入后开始执行命令, 0时等待全部worker", default=0)
+    arg_parser.add_argument('--startup_timeout', type=int, required=False, help="快速启动的超时时间(秒)", default=600)
 
     args = arg_parser.parse_args()
     print('NUM_WORKER',args.num_workers)
@@ -495,6 +614,9 @@ if __name__ == '__main__':
         exit(1)
     WORKDIR = args.workdir
     NUM_WORKER = int(args.num_workers)
+    MIN_WORKER = int(args.min_workers)
+    FAST_STARTUP = bool(args.fast_startup)
+    STARTUP_TIMEOUT = int(args.startup_timeout)
     if args.init.strip():
         INIT_FILE = "bash "+args.init.strip()+" && "
 